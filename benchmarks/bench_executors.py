@@ -0,0 +1,47 @@
+"""
+Benchmark serial, thread and process execution of clean_cube.
+
+Threads share the cube without pickling and need no worker
+start-up, but only the GIL-releasing kernels (median and
+Gaussian filters, large NumPy reductions) run in parallel.
+Processes parallelize everything but pay for pickling the
+tiles and starting the workers. Which one wins depends on
+the spectrum length and the number of spectra, so this
+times all three for a few spectrum lengths:
+
+    python benchmarks/bench_executors.py [workers]
+"""
+import os,sys
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),"..","rampsclean"))
+import time
+import numpy as np
+import clean_cube
+
+
+def make_cube(spec_length,ny=8,nx=8):
+    """
+    Simple in-memory cube: noise, a line and a sloped baseline
+    """
+    np.random.seed(0)
+    x = np.arange(spec_length)
+    line = 3.0*np.exp(-(x-spec_length/4.)**2/(2*50.**2))
+    cube = 0.2*np.random.randn(spec_length,ny,nx) + (line + 1e-5*x)[:,None,None]
+    return(cube)
+
+def time_run(cube,executor=None):
+    t0 = time.time()
+    clean_cube.clean_cube(cube,tile_shape=(2,8),executor=executor)
+    return(time.time()-t0)
+
+if __name__ == "__main__":
+    workers = int(sys.argv[1]) if len(sys.argv) > 1 else os.cpu_count()
+    print("workers = "+str(workers))
+    print("%12s %10s %10s %10s" % ("spec_length","serial","threads","processes"))
+    for spec_length in (4096,16384,65536):
+        cube = make_cube(spec_length)
+        serial = time_run(cube)
+        with clean_cube.make_executor(workers,"thread") as executor:
+            threads = time_run(cube,executor)
+        with clean_cube.make_executor(workers,"process") as executor:
+            processes = time_run(cube,executor)
+        print("%12d %10.2f %10.2f %10.2f" % (spec_length,serial,threads,processes))
@@ -0,0 +1,72 @@
+"""
+Benchmark naive (map order) against cost-sorted tile scheduling.
+
+The test cube has a NaN border (almost free to clean) and a
+region of bright, broad emission, where with a fallback
+cascade of basetypes the first fits are often rejected and
+retried. Every tile is first timed on its own, then for each
+number of workers the makespan of both orders is simulated
+with those times (greedy list scheduling, as the pool does:
+each idle worker takes the next tile). This does not depend
+on the number of CPUs of the machine running it. The real
+wall time of both orders with a process pool is also shown.
+
+    python benchmarks/bench_scheduling.py [workers]
+"""
+import os,sys
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),"..","rampsclean"))
+import heapq
+import time
+import numpy as np
+import clean_cube
+
+BASETYPE = ("spline","poly","smoothed_data")
+
+
+def make_cube(spec_length=16384,ny=24,nx=24):
+    """
+    Noise and a sloped baseline, bright lines in one corner and a NaN border
+    """
+    np.random.seed(0)
+    x = np.arange(spec_length)
+    cube = 0.2*np.random.randn(spec_length,ny,nx) + (1e-5*x)[:,None,None]
+    bright = sum(5.0*np.exp(-(x-c)**2/(2*400.**2)) for c in (3000,7000,11000))
+    cube[:,-ny//4:,-nx//4:] += bright[:,None,None] #Last in map order
+    cube[:,:,:2] = np.nan
+    cube[:,:2,:] = np.nan
+    return(cube)
+
+def makespan(durations,workers):
+    """
+    Finish time of tiles taken in order by the first idle worker
+    """
+    free = [0.]*workers
+    for d in durations:
+        heapq.heappush(free,heapq.heappop(free)+d)
+    return(max(free))
+
+if __name__ == "__main__":
+    workers = int(sys.argv[1]) if len(sys.argv) > 1 else os.cpu_count()
+    cube = make_cube()
+    tiles = clean_cube.make_tiles(cube.shape[1],cube.shape[2],(4,4))
+    durations = []
+    costs = []
+    for ys,xs in tiles:
+        t0 = time.time()
+        clean_cube.clean_tile(cube[:,ys,xs],basetype=BASETYPE)
+        durations.append(time.time()-t0)
+        costs.append(clean_cube.estimate_tile_cost(cube[::7,ys,xs],basetype=BASETYPE))
+    durations = np.array(durations)
+    order = np.argsort(-np.array(costs),kind="stable")
+    print("tiles = %d, total %.2fs, correlation of cost and time %.2f"
+          % (len(tiles),durations.sum(),np.corrcoef(costs,durations)[0,1]))
+    print("%8s %10s %10s %10s" % ("workers","naive","cost","ideal"))
+    for n in sorted(set((2,4,8,workers))):
+        print("%8d %10.2f %10.2f %10.2f" % (n,makespan(durations,n),
+              makespan(durations[order],n),max(durations.sum()/n,durations.max())))
+    with clean_cube.make_executor(workers,"process") as executor:
+        for schedule in (None,"cost"):
+            t0 = time.time()
+            clean_cube.clean_cube(cube,tile_shape=(4,4),executor=executor,
+                                  schedule=schedule,basetype=BASETYPE)
+            print("%d processes, schedule=%s: %.2fs" % (workers,schedule,time.time()-t0))
@@ -0,0 +1,149 @@
+"""
+Incremental cleaning of spectra arriving during observing.
+
+During OTF mapping the integrations for a pixel arrive
+over time. Each integration is median filtered and
+downsampled once when it arrives and added to running
+(noise-weighted) sums, so the downsampled average is
+always available without going back to earlier data.
+
+After each integration only the cheap statistics are
+updated: the y-array of the average (one cumulative-sum
+pass), and the moment signal mask, noise and mom0 of the
+average minus the baseline from the last full clean
+(another pass). The mask follows the data, as one kept
+from an earlier, noisier average misses line wings and
+biases mom0 low by more than mom0_err. The full clean
+(signal detection and baseline fit) is only re-run when
+the noise estimate has changed by more than reclean_tol
+since the last one, e.g. once the noise has come down
+by 20%. This gives near-real-time quick-look maps.
+"""
+import numpy as np
+import numpy.ma as ma
+import clean_spectrum
+import combine
+import moments
+
+
+class IncrementalSpectrum:
+    """
+    Running average and quick-look mom0 for one pixel
+    """
+
+    def __init__(self,filter_width=7,ww=20,basetype="spline",reclean_tol=0.2,**kwargs):
+        self.filter_width = filter_width
+        self.ww = ww
+        self.basetype = basetype
+        self.reclean_tol = reclean_tol
+        self.kwargs = kwargs
+        self.sum_wd = None
+        self.sum_w = None
+        self.count = 0
+        self.num_cleans = 0
+        self.baseline = None
+
+    def add(self,spec,weight=None):
+        """
+        Add one integration and update the quick-look results
+
+        weight defaults to 1/noise**2 of the integration.
+        Blank and all-NaN integrations (see 
+        clean_spectrum.prescreen_spectra) are skipped, as are
+        integrations whose estimated noise is zero or not
+        finite. A given weight must be finite and positive.
+        Returns True if a full re-clean was done.
+        """
+        if weight is not None and not (np.isfinite(weight) and weight > 0):
+            raise ValueError("weight must be finite and positive")
+        if clean_spectrum.prescreen_spectra(spec) < clean_spectrum.PARTIAL_NAN:
+            return(False)
+        if weight is None:
+            with np.errstate(divide='ignore'):
+                weight = 1./combine.estimate_noise(spec)[0]**2
+            if not np.isfinite(weight):
+                return(False)
+        d = clean_spectrum.downsample_spectrum(spec,filter_width=self.filter_width)
+        good = np.isfinite(d)
+        if self.sum_wd is None:
+            self.sum_wd = np.zeros(d.size)
+            self.sum_w = np.zeros(d.size)
+        self.sum_wd[good] += weight*d[good]
+        self.sum_w[good] += weight
+        self.count += 1
+        return(self.update())
+
+    @property
+    def spectrum(self):
+        """
+        Current weighted average downsampled spectrum
+        """
+        with np.errstate(invalid='ignore',divide='ignore'):
+            return(self.sum_wd/self.sum_w)
+
+    def update(self):
+        """
+        Update y-array statistics and mom0, re-cleaning if needed
+        """
+        avg = self.spectrum
+        good = self.sum_w > 0
+        if not good.all(): #Fill channels with no data for the y-array and fit
+            avg = np.interp(np.arange(avg.size),np.flatnonzero(good),avg[good])
+        self.k_est = np.median(clean_spectrum.make_local_stddevs(avg,[self.ww])[0])
+        recleaned = (self.baseline is None or
+                     abs(self.k_est/self.k_at_clean-1) > self.reclean_tol)
+        if recleaned:
+            self.reclean(avg)
+        self.cleaned = avg - self.baseline
+        self.cleaned[~good] = np.nan
+        signal_spec,self.noise = moments.identify_signal_estimate_noise(self.cleaned,ww=self.ww)
+        self.signal_mask = ~ma.getmaskarray(signal_spec)
+        self.mom0,self.mom0_err = moments.get_integrated_intensity(signal_spec,self.noise,
+                                        downsample_fact=self.filter_width)
+        return(recleaned)
+
+    def reclean(self,avg):
+        """
+        Full detection and baseline fit on the average
+        """
+        y = clean_spectrum.make_local_stddev(avg,ww=self.ww)
+        self.k_at_clean = np.median(y)
+        no_signal_spec = clean_spectrum.mask_spectrum(y,self.ww,avg,keep_signal=False,
+                                        **self.kwargs)
+        self.baseline = clean_spectrum.fit_baseline(no_signal_spec,self.k_at_clean,
+                                        basetype=self.basetype,**self.kwargs)
+        self.num_cleans += 1
+
+
+class IncrementalMap:
+    """
+    Quick-look mom0 map built up from integrations as they arrive
+
+    Pixels are created when their first integration arrives.
+    Keywords are passed to IncrementalSpectrum.
+    """
+
+    def __init__(self,ny,nx,**kwargs):
+        self.shape = (ny,nx)
+        self.kwargs = kwargs
+        self.pixels = {}
+
+    def add(self,iy,ix,spec,weight=None):
+        """
+        Add an integration for pixel (iy,ix)
+        """
+        if (iy,ix) not in self.pixels:
+            self.pixels[(iy,ix)] = IncrementalSpectrum(**self.kwargs)
+        return(self.pixels[(iy,ix)].add(spec,weight=weight))
+
+    def maps(self):
+        """
+        Current mom0, mom0 error and noise maps (NaN where no data)
+        """
+        mom0 = np.full(self.shape,np.nan)
+        mom0_err = np.full(self.shape,np.nan)
+        noise = np.full(self.shape,np.nan)
+        for (iy,ix),pixel in self.pixels.items():
+            if pixel.count:
+                mom0[iy,ix],mom0_err[iy,ix],noise[iy,ix] = pixel.mom0,pixel.mom0_err,pixel.noise
+        return(mom0,mom0_err,noise)
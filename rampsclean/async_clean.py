@@ -0,0 +1,70 @@
+"""
+Asyncio front-end for cleaning spectra.
+
+The cleaning and moment work (clean_cube.clean_pixel) is
+sent to a thread or process executor, so the event loop
+of asyncio-based acquisition and archive tools never
+blocks on NumPy/SciPy. At most max_in_flight spectra are
+submitted at once: reading further spectra waits until
+a slot is free (backpressure). Cancelling clean_many
+cancels every spectrum that has not started yet.
+"""
+import asyncio
+import concurrent.futures
+import functools
+import clean_cube
+
+
+async def aiter_spectra(spectra):
+    """
+    Iterate over an async or ordinary iterable of spectra
+
+    Ordinary iterables are consumed on the event loop, so
+    they should not do slow I/O; use an async iterable for that.
+    """
+    if hasattr(spectra,"__aiter__"):
+        async for spec in spectra:
+            yield(spec)
+    else:
+        for spec in spectra:
+            yield(spec)
+
+async def clean_many(spectra,executor=None,max_in_flight=8,**kwargs):
+    """
+    Clean and measure many spectra without blocking the event loop
+
+    spectra is an iterable or async iterable of spectra.
+    executor is any concurrent.futures executor (e.g. a
+    ProcessPoolExecutor); by default a thread pool is made
+    for the call and shut down afterwards. Keywords go to
+    clean_cube.clean_pixel.
+
+    Returns a list with the (cleaned spectrum, mom0, mom0 error,
+    noise) of each spectrum, in input order.
+    """
+    loop = asyncio.get_running_loop()
+    own_executor = executor is None
+    if own_executor:
+        executor = concurrent.futures.ThreadPoolExecutor()
+    slots = asyncio.Semaphore(max_in_flight)
+    work = functools.partial(clean_cube.clean_pixel,**kwargs)
+
+    async def run(spec):
+        try:
+            return(await loop.run_in_executor(executor,work,spec))
+        finally:
+            slots.release()
+
+    tasks = []
+    try:
+        async for spec in aiter_spectra(spectra):
+            await slots.acquire()
+            tasks.append(asyncio.ensure_future(run(spec)))
+        return(await asyncio.gather(*tasks))
+    except BaseException: #Including cancellation of clean_many itself
+        for task in tasks:
+            task.cancel()
+        raise
+    finally:
+        if own_executor:
+            executor.shutdown(wait=False)
@@ -0,0 +1,139 @@
+"""
+On-disk cache for intermediate products.
+
+The median-filtered downsampled spectrum and the
+local-standard-deviation (y) array only depend on the
+input spectrum, filter_width and ww. When a cube is
+re-run with a different basetype or stddevlev they can
+be read back from disk instead of being recomputed.
+
+Entries are content-addressed: the key is a hash of the
+input array together with the name and parameters of
+the stage that produced the entry. The total size of
+the cache is bounded, and the least recently used
+entries are removed first.
+"""
+import numpy as np
+import hashlib
+import os,sys
+import tempfile
+
+
+class DiskCache:
+    """
+    Size-bounded LRU cache of numpy arrays in a directory
+
+    Recency is tracked through the modification time of
+    the entry files, so several processes (or later runs)
+    can share the same directory.
+    """
+
+    def __init__(self,directory,max_bytes=2**30):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        try:
+            os.makedirs(directory)
+        except OSError:
+            pass
+        self.size = sum(os.path.getsize(f) for f,mtime in self.entries())
+
+    def make_key(self,arr,stage,**params):
+        """
+        Hash an input array with a stage name and its parameters
+        """
+        arr = np.ascontiguousarray(arr)
+        h = hashlib.sha1()
+        h.update(str((stage,arr.dtype.str,arr.shape,sorted(params.items()))).encode())
+        h.update(arr.view(np.uint8))
+        return(h.hexdigest())
+
+    def path(self,key):
+        return(os.path.join(self.directory,key+".npy"))
+
+    def entries(self):
+        """
+        List (filename,mtime) for all entries, oldest first
+        """
+        out = []
+        for f in os.listdir(self.directory):
+            if f.endswith(".npy"):
+                f = os.path.join(self.directory,f)
+                try:
+                    out.append((f,os.path.getmtime(f)))
+                except OSError: #Removed by another process
+                    pass
+        out.sort(key=lambda e: e[1])
+        return(out)
+
+    def get(self,key):
+        """
+        Return the cached array, or None if it is not in the cache
+        """
+        filename = self.path(key)
+        try:
+            arr = np.load(filename)
+            os.utime(filename,None) #Mark as recently used
+        except (IOError,OSError,ValueError):
+            return(None)
+        return(arr)
+
+    def put(self,key,arr):
+        """
+        Store an array, evicting old entries if the cache is too big
+        """
+        fd,tmpname = tempfile.mkstemp(dir=self.directory,suffix=".tmp")
+        with os.fdopen(fd,'wb') as f:
+            np.save(f,arr)
+        filename = self.path(key)
+        if os.path.exists(filename):
+            self.size -= os.path.getsize(filename)
+        os.replace(tmpname,filename) #Atomic, so readers never see partial entries
+        self.size += os.path.getsize(filename)
+        if self.size > self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        """
+        Remove least recently used entries until under max_bytes
+        """
+        entries = self.entries()
+        self.size = sum(os.path.getsize(f) for f,mtime in entries)
+        for f,mtime in entries:
+            if self.size <= self.max_bytes:
+                break
+            try:
+                nbytes = os.path.getsize(f)
+                os.remove(f)
+                self.size -= nbytes
+            except OSError:
+                pass
+
+    def cached(self,func,arr,stage,**params):
+        """
+        Return func(arr,**params), computing and storing it if needed
+        """
+        key = self.make_key(arr,stage,**params)
+        result = self.get(key)
+        if result is None:
+            result = func(arr,**params)
+            self.put(key,result)
+        return(result)
+
+
+class MemoryCache(DiskCache):
+    """
+    Unbounded in-memory cache with the DiskCache interface
+
+    For passing intermediate products between the stages
+    of one call, e.g. the downsampled spectra and y-arrays
+    of transitions.clean_transitions, without touching disk.
+    """
+
+    def __init__(self):
+        self.arrays = {}
+
+    def get(self,key):
+        return(self.arrays.get(key))
+
+    def put(self,key,arr):
+        self.arrays[key] = arr
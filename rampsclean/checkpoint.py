@@ -0,0 +1,133 @@
+"""
+Checkpoints for resuming interrupted cube runs.
+
+A checkpoint is a directory next to the (memory-mapped)
+output cube. It holds the mom0, mom0 error and noise maps
+as a memory-mapped .npy file and a JSON manifest listing
+the tiles that are finished, with a checksum of each
+tile's output and the hash of the parameters of the run.
+
+A tile is recorded only after its output and maps have
+been flushed to disk, and the manifest is replaced
+atomically (written to a temporary file and renamed),
+so after a crash the manifest never lists a tile whose
+output is incomplete. On restart, listed tiles whose
+output still matches its checksum are skipped; tiles
+whose output was lost or changed are cleaned again. If
+the parameters changed, the old checkpoint is ignored.
+"""
+import numpy as np
+import hashlib
+import json
+import mmap
+import os
+import tempfile
+import zlib
+
+#Keywords that do not change the results
+IGNORED_PARAMS = ("cache","outdir","diagnostics")
+
+
+def param_hash(**params):
+    """
+    Hash of the parameters of a run (arrays are hashed by content)
+    """
+    h = hashlib.sha1()
+    for key in sorted(params):
+        if key in IGNORED_PARAMS:
+            continue
+        value = params[key]
+        h.update(key.encode())
+        if isinstance(value,np.ndarray):
+            value = np.ascontiguousarray(value)
+            h.update(str((value.dtype.str,value.shape)).encode())
+            h.update(value.view(np.uint8))
+        else:
+            h.update(repr(value).encode())
+    return(h.hexdigest())
+
+def mapped_file(arr):
+    """
+    The mmap behind a memory-mapped array (np.memmap or FITS data), or None
+    """
+    while arr is not None:
+        if isinstance(arr,mmap.mmap):
+            return(arr)
+        if isinstance(arr,np.memmap) and arr._mmap is not None:
+            return(arr._mmap)
+        arr = getattr(arr,"base",None)
+    return(None)
+
+def tile_key(ys,xs):
+    return("%d:%d,%d:%d" % (ys.start,ys.stop,xs.start,xs.stop))
+
+
+class Checkpoint:
+    """
+    Manifest of finished tiles and the moment maps of a cube run
+    """
+
+    def __init__(self,directory,param_hash,ny,nx):
+        self.directory = directory
+        self.param_hash = param_hash
+        self.filename = os.path.join(directory,"manifest.json")
+        try:
+            os.makedirs(directory)
+        except OSError:
+            pass
+        self.tiles = {}
+        try:
+            with open(self.filename) as f:
+                manifest = json.load(f)
+            if manifest["param_hash"] == param_hash:
+                self.tiles = manifest["tiles"]
+        except (IOError,OSError,ValueError,KeyError):
+            pass
+        maps_file = os.path.join(directory,"maps.npy")
+        maps = None
+        if self.tiles:
+            try:
+                maps = np.load(maps_file,mmap_mode='r+')
+            except (IOError,OSError,ValueError):
+                pass
+        if maps is None or maps.shape != (3,ny,nx):
+            self.tiles = {}
+            maps = np.lib.format.open_memmap(maps_file,mode='w+',shape=(3,ny,nx))
+            maps[...] = np.nan
+        self.maps = maps
+        if not self.tiles:
+            self.save()
+
+    def checksum(self,ys,xs,out):
+        """
+        CRC of the output and maps of a tile
+        """
+        crc = zlib.crc32(np.ascontiguousarray(out[:,ys,xs]).view(np.uint8))
+        return(zlib.crc32(np.ascontiguousarray(self.maps[:,ys,xs]).view(np.uint8),crc))
+
+    def is_done(self,ys,xs,out):
+        """
+        True if the tile is finished and its output is intact
+        """
+        crc = self.tiles.get(tile_key(ys,xs))
+        return(crc is not None and crc == self.checksum(ys,xs,out))
+
+    def record(self,ys,xs,out):
+        """
+        Flush a finished tile to disk and add it to the manifest
+        """
+        mapped_file(out).flush()
+        self.maps.flush()
+        self.tiles[tile_key(ys,xs)] = self.checksum(ys,xs,out)
+        self.save()
+
+    def save(self):
+        """
+        Atomically replace the manifest on disk
+        """
+        fd,tmpname = tempfile.mkstemp(dir=self.directory,suffix=".tmp")
+        with os.fdopen(fd,'w') as f:
+            json.dump({"param_hash":self.param_hash,"tiles":self.tiles},f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmpname,self.filename)
@@ -0,0 +1,329 @@
+"""
+Clean a full RAMPS cube and make moment maps.
+
+The cube is in FITS axis order as seen by numpy,
+(spectral, y, x). It is processed in spatial tiles
+that hold the full spectral axis, so that only one
+tile of the (possibly memory-mapped) input has to be
+in memory at a time. Each spectrum goes through
+baseline_and_deglitch followed by the moment 0
+calculation in moments.
+
+With warm_start=True the pixels in a tile are visited
+in a serpentine (boustrophedon) order, so each pixel
+follows a spatial neighbour, and the spline knots and
+poly order of that neighbour seed the next fit.
+"""
+import numpy as np
+import collections
+import concurrent.futures
+import functools
+import checkpoint
+import clean_spectrum
+import moments
+import shared
+
+
+def make_tiles(ny,nx,tile_shape=(16,16)):
+    """
+    List the (y,x) slices of the spatial tiles covering a map
+    """
+    ty,tx = tile_shape
+    tiles = []
+    for y0 in range(0,ny,ty):
+        for x0 in range(0,nx,tx):
+            tiles.append((slice(y0,min(y0+ty,ny)),slice(x0,min(x0+tx,nx))))
+    return(tiles)
+
+def traversal_order(ty,tx,warm_start=False):
+    """
+    Order in which to visit the flattened pixels of a tile
+
+    Row by row, reversing every other row when warm starting
+    so that consecutive pixels are always neighbours.
+    """
+    order = np.arange(ty*tx).reshape(ty,tx)
+    if warm_start:
+        order[1::2] = order[1::2,::-1]
+    return(order.ravel())
+
+def clean_pixel(spec,filter_width=7,ww=20,line_mask=None,**kwargs):
+    """
+    Clean one spectrum and calculate its mom0
+
+    Returns the cleaned spectrum, mom0, its error and the
+    noise estimate. Blank and all-NaN spectra give NaN for
+    all of these. Keywords go to baseline_and_deglitch.
+    """
+    full_resolution = kwargs.get("full_resolution",False)
+    nout = clean_spectrum.output_length(len(spec),filter_width,full_resolution)
+    if clean_spectrum.prescreen_spectra(spec) < clean_spectrum.PARTIAL_NAN:
+        return(np.full(nout,np.nan),np.nan,np.nan,np.nan)
+    cleaned = clean_spectrum.baseline_and_deglitch(spec,filter_width=filter_width,ww=ww,
+                                        line_mask=line_mask,**kwargs)
+    signal_spec,mom0,mom0_err,noise = pixel_moments(cleaned,filter_width=filter_width,ww=ww,
+                                        line_mask=line_mask,full_resolution=full_resolution)
+    return(cleaned,mom0,mom0_err,noise)
+
+def pixel_moments(cleaned,filter_width=7,ww=20,line_mask=None,full_resolution=False):
+    """
+    Signal mask and mom0 of a spectrum cleaned by baseline_and_deglitch
+
+    line_mask is the prior line mask given to the clean (one
+    value per input channel). Returns the masked signal
+    spectrum (see moments.identify_signal_estimate_noise),
+    mom0, its error and the noise estimate.
+    """
+    mom_ww,downsample_fact = clean_spectrum.moment_settings(ww,filter_width,full_resolution)
+    mom_mask = line_mask
+    if line_mask is not None and not full_resolution:
+        mom_mask = clean_spectrum.downsample_mask(line_mask,filter_width)
+    signal_spec,noise = moments.identify_signal_estimate_noise(cleaned,ww=mom_ww,
+                                        line_mask=mom_mask)
+    mom0,mom0_err = moments.get_integrated_intensity(signal_spec,noise,
+                                        downsample_fact=downsample_fact)
+    return(signal_spec,mom0,mom0_err,noise)
+
+def clean_tile(data,filter_width=7,ww=20,warm_start=False,line_mask=None,**kwargs):
+    """
+    Clean all spectra in a tile and calculate their mom0
+
+    data is a (spectral,y,x) array. Returns the cleaned
+    (downsampled, unless full_resolution) tile and maps of
+    mom0, its error and the noise estimate. Blank and 
+    all-NaN pixels are skipped (see 
+    clean_spectrum.prescreen_spectra) and left as NaN.
+
+    line_mask is an optional prior line mask (see
+    clean_spectrum.make_line_mask), either one for the whole
+    tile (1-D) or one per pixel (same shape as data). It
+    replaces signal detection in both the baseline and the
+    moment steps.
+    """
+    nchan,ty,tx = data.shape
+    spectra = np.asarray(data).reshape(nchan,ty*tx).T
+    status = clean_spectrum.prescreen_spectra(spectra)
+    nout = clean_spectrum.output_length(nchan,filter_width,kwargs.get("full_resolution",False))
+    cleaned = np.full((ty*tx,nout),np.nan)
+    mom0 = np.full(ty*tx,np.nan)
+    mom0_err = np.full(ty*tx,np.nan)
+    noise = np.full(ty*tx,np.nan)
+    if line_mask is not None and np.ndim(line_mask) == 3:
+        line_masks = np.asarray(line_mask).reshape(nchan,ty*tx).T
+    state = None
+    for i in traversal_order(ty,tx,warm_start=warm_start):
+        if status[i] < clean_spectrum.PARTIAL_NAN:
+            state = None #Do not carry a fit across a gap
+            continue
+        if warm_start and state is None:
+            state = {}
+        pixel_mask = line_masks[i] if np.ndim(line_mask) == 3 else line_mask
+        cleaned[i],mom0[i],mom0_err[i],noise[i] = clean_pixel(spectra[i],
+                    filter_width=filter_width,ww=ww,line_mask=pixel_mask,
+                    warm_start=state,**kwargs)
+    return(cleaned.T.reshape(nout,ty,tx),mom0.reshape(ty,tx),
+           mom0_err.reshape(ty,tx),noise.reshape(ty,tx))
+
+def make_executor(workers=None,kind="thread"):
+    """
+    Make a thread or process pool for clean_cube
+
+    Threads avoid pickling the tiles and re-importing the
+    package in each worker, and the heavy kernels (median 
+    and Gaussian filters, large NumPy reductions) release 
+    the GIL. Processes also run the pure-Python and FITPACK
+    parts in parallel. benchmarks/bench_executors.py shows
+    which is faster for a given spectrum size.
+    """
+    if kind == "thread":
+        return(concurrent.futures.ThreadPoolExecutor(max_workers=workers))
+    elif kind == "process":
+        return(concurrent.futures.ProcessPoolExecutor(max_workers=workers))
+    raise ValueError("Unknown executor kind: "+str(kind))
+
+def run_tiles(func,tile_kwargs,executor=None,max_in_flight=None):
+    """
+    Call func with each dict of keywords in tile_kwargs, yielding results in order
+
+    With an executor, at most max_in_flight (default twice
+    the number of workers) tiles are submitted at a time, so 
+    only those tiles have to be read into memory.
+    """
+    if executor is None:
+        for kw in tile_kwargs:
+            yield(func(**kw))
+        return
+    if max_in_flight is None:
+        max_in_flight = 2*getattr(executor,"_max_workers",4)
+    pending = collections.deque()
+    for kw in tile_kwargs:
+        pending.append(executor.submit(func,**kw))
+        if len(pending) >= max_in_flight:
+            yield(pending.popleft().result())
+    while pending:
+        yield(pending.popleft().result())
+
+def run_tiles_as_completed(func,tile_kwargs,executor=None,max_in_flight=None):
+    """
+    Like run_tiles, but yield (index,result) pairs as tiles finish
+
+    A slow tile does not hold up the submission of the
+    ones after it, so every idle worker takes the next
+    tile from the pool's shared queue straight away.
+    """
+    if executor is None:
+        for i,kw in enumerate(tile_kwargs):
+            yield(i,func(**kw))
+        return
+    if max_in_flight is None:
+        max_in_flight = 2*getattr(executor,"_max_workers",4)
+    pending = {}
+    for i,kw in enumerate(tile_kwargs):
+        pending[executor.submit(func,**kw)] = i
+        if len(pending) >= max_in_flight:
+            done,not_done = concurrent.futures.wait(pending,
+                                    return_when=concurrent.futures.FIRST_COMPLETED)
+            for f in done:
+                yield(pending.pop(f),f.result())
+    for f in concurrent.futures.as_completed(list(pending)):
+        yield(pending.pop(f),f.result())
+
+def estimate_tile_cost(data,filter_width=7,ww=20,stddevlev=3,basetype="spline",**kwargs):
+    """
+    Cheap estimate of the relative cost of cleaning a tile
+
+    data is the tile subsampled along the spectral axis
+    (cube[::filter_width,ys,xs]), without the median filter.
+    Blank and all-NaN spectra are almost free. Every other
+    spectrum costs 1, plus its NaN fraction (interpolation 
+    and masking), plus, with a fallback cascade of basetypes,
+    the fraction of channels above the y-array threshold
+    times the number of fallbacks, since line-rich spectra
+    are the ones whose first fits get rejected.
+    """
+    n = data.shape[0]
+    spectra = np.asarray(data,dtype=float).reshape(n,-1).T
+    status = clean_spectrum.prescreen_spectra(spectra)
+    fallbacks = 0 if isinstance(basetype,str) else len(basetype)-1
+    w = min(ww) if np.iterable(ww) else ww
+    cost = 0.01*np.sum(status < clean_spectrum.PARTIAL_NAN)
+    for spec in spectra[status >= clean_spectrum.PARTIAL_NAN]:
+        good = np.isfinite(spec)
+        cost += 2-good.mean()
+        if fallbacks and good.sum() > 2*w:
+            y = clean_spectrum.make_local_stddevs(spec[good],[w])[0]
+            cost += fallbacks*np.mean(y > clean_spectrum.get_upperlim(y,w,stddevlev))
+    return(cost)
+
+def clean_shared_tile(cube,out,maps,ys,xs,**kwargs):
+    """
+    Clean one tile of a shared cube, writing the results in place
+
+    cube, out and maps are shared.SharedArray descriptions of
+    the input cube, the cleaned cube and the stacked (mom0,
+    mom0 error, noise) maps, so only they and the tile slices
+    are sent to the worker. Keywords go to clean_tile.
+    """
+    with cube.open() as data:
+        result = clean_tile(data[:,ys,xs],**kwargs)
+    with out.open() as view:
+        view[:,ys,xs] = result[0]
+    with maps.open() as view:
+        view[:,ys,xs] = result[1:]
+
+def clean_cube(cube,filter_width=7,ww=20,tile_shape=(16,16),out=None,executor=None,
+               shared_memory=False,checkpoint_dir=None,schedule=None,**kwargs):
+    """
+    Clean every spectrum in a cube and make moment maps
+
+    out is an optional (cleaned spectral,y,x) array,
+    e.g. a memory-mapped file, for the cleaned cube.
+    executor is an optional thread or process pool (see
+    make_executor) to clean the tiles in parallel. Plots
+    (outdir) use global pyplot state, so they cannot be 
+    combined with an executor.
+    With shared_memory=True (for process pools) the cube and results
+    are not pickled: they are placed in shared memory, or
+    used directly if they are memory-mapped files, and the 
+    workers only get their location (see clean_shared_tile).
+    With checkpoint_dir (and a memory-mapped out) the run can
+    be resumed: finished tiles are recorded in a checkpoint
+    there and skipped when clean_cube is run again with the
+    same parameters (see checkpoint.Checkpoint).
+    With schedule="cost" the tiles are dispatched in order of
+    decreasing estimated cost (estimate_tile_cost), so the
+    expensive ones do not end up last on a single worker;
+    by default they go in map order.
+    Other keywords go to clean_tile and baseline_and_deglitch.
+    Returns the cleaned cube and the mom0, mom0 error and
+    noise maps.
+    """
+    if executor is not None and "outdir" in kwargs:
+        raise ValueError("outdir plots cannot be made in parallel")
+    nchan,ny,nx = cube.shape
+    nout = clean_spectrum.output_length(nchan,filter_width,kwargs.get("full_resolution",False))
+    if out is None:
+        out = np.empty((nout,ny,nx))
+    mom0 = np.empty((ny,nx))
+    mom0_err = np.empty((ny,nx))
+    noise = np.empty((ny,nx))
+    line_mask = kwargs.pop("line_mask",None)
+    tiles = make_tiles(ny,nx,tile_shape)
+    ck = None
+    if checkpoint_dir is not None:
+        if shared_memory or checkpoint.mapped_file(out) is None:
+            raise ValueError("checkpoint_dir needs a memory-mapped out and shared_memory=False")
+        ck = checkpoint.Checkpoint(checkpoint_dir,checkpoint.param_hash(shape=cube.shape,
+                        tile_shape=tuple(tile_shape),filter_width=filter_width,ww=ww,
+                        line_mask=line_mask,**kwargs),ny,nx)
+        mom0,mom0_err,noise = ck.maps
+        tiles = [(ys,xs) for ys,xs in tiles if not ck.is_done(ys,xs,out)]
+    if schedule == "cost":
+        costs = [estimate_tile_cost(cube[::filter_width,ys,xs],filter_width=filter_width,
+                                    ww=ww,**kwargs) for ys,xs in tiles]
+        tiles = [tiles[i] for i in np.argsort(-np.array(costs),kind="stable")]
+    elif schedule is not None:
+        raise ValueError("Unknown schedule: "+str(schedule))
+    if shared_memory and executor is not None:
+        return(clean_cube_shared(cube,tiles,out,executor,filter_width=filter_width,
+                                 ww=ww,line_mask=line_mask,**kwargs))
+    work = functools.partial(clean_tile,filter_width=filter_width,ww=ww,**kwargs)
+    def tile_kwargs():
+        for ys,xs in tiles:
+            tile_mask = line_mask[:,ys,xs] if np.ndim(line_mask) == 3 else line_mask
+            yield({"data":np.asarray(cube[:,ys,xs]),"line_mask":tile_mask})
+    for i,result in run_tiles_as_completed(work,tile_kwargs(),executor=executor):
+        ys,xs = tiles[i]
+        out[:,ys,xs],mom0[ys,xs],mom0_err[ys,xs],noise[ys,xs] = result
+        if ck is not None:
+            ck.record(ys,xs,out)
+    if ck is not None:
+        mom0,mom0_err,noise = np.array(ck.maps)
+    return(out,mom0,mom0_err,noise)
+
+def clean_cube_shared(cube,tiles,out,executor,line_mask=None,**kwargs):
+    """
+    The shared_memory=True path of clean_cube
+    """
+    ny,nx = cube.shape[1:]
+    cube_shared = shared.SharedArray.from_array(cube,mode='r')
+    out_shared = shared.SharedArray.from_array(out,mode='r+')
+    maps_shared = shared.SharedArray.create((3,ny,nx))
+    try:
+        work = functools.partial(clean_shared_tile,cube=cube_shared,out=out_shared,
+                                 maps=maps_shared,**kwargs)
+        def tile_kwargs():
+            for ys,xs in tiles:
+                tile_mask = line_mask[:,ys,xs] if np.ndim(line_mask) == 3 else line_mask
+                yield({"ys":ys,"xs":xs,"line_mask":tile_mask})
+        for result in run_tiles_as_completed(work,tile_kwargs(),executor=executor):
+            pass
+        if out_shared.shm is not None: #out was copied into shared memory
+            with out_shared.open() as view:
+                out[...] = view
+        with maps_shared.open() as view:
+            mom0,mom0_err,noise = view.copy()
+    finally:
+        for s in (cube_shared,out_shared,maps_shared):
+            s.unlink()
+    return(out,mom0,mom0_err,noise)
@@ -31,15 +31,19 @@ and small compared to variations in the baseline.
 """
 from scipy.interpolate import UnivariateSpline 
 from scipy.interpolate import InterpolatedUnivariateSpline 
+from scipy.interpolate import LSQUnivariateSpline 
 from numpy.polynomial import Polynomial as P
 import numpy as np
 import scipy.ndimage as im
 import numpy.ma as ma
 import os,sys
+import time
 import matplotlib.pyplot as plt
 
 
-def baseline_and_deglitch(spec,filter_width=7,ww=20,basetype="spline",**kwargs):
+def baseline_and_deglitch(spec,filter_width=7,ww=20,basetype="spline",cache=None,
+                          spur_channels=None,spike_threshold=None,full_resolution=False,
+                          line_mask=None,**kwargs):
     """
     Do baseline subtraction and remove spikes via median filter
     
@@ -47,18 +51,85 @@ def baseline_and_deglitch(spec,filter_width=7,ww=20,basetype="spline",**kwargs):
     the local-standard-deviation. This has to be set by looking at real data.
     In the L10 data, ww = 80 seems to work well. ww = 20 is fine for the 
     synthetic lines, but these tend to be narrower than reality.
+    ww can also be a sequence of widths, e.g. (20,80), to detect
+    both narrow and broad lines (see mask_spectrum).
+
+    cache is an optional cache.DiskCache (or MemoryCache). If given,
+    the downsampled spectrum and y-array are read from (or stored in)
+    the cache, so re-running with a different basetype or stddevlev
+    skips them.
+    
+    basetype may be a sequence of basetypes to use as a fallback
+    cascade; time_budget and diagnostics are passed on to
+    fit_baseline.
+    
+    If spur_channels (the known spur channels for this VEGAS 
+    configuration, see read_spur_table) or spike_threshold are 
+    given, only those channels are deglitched and the median
+    filter is skipped (see downsample_spectrum).
+    
+    With full_resolution=True the detection and baseline fit are
+    still done on the downsampled spectrum, but the baseline is
+    evaluated at every channel and subtracted from the original
+    spectrum, in which only the spikes are replaced (see
+    remove_spikes; spike_threshold defaults to 5 here). The 
+    result has the full number of channels, so mom0 needs no
+    downsample_fact.
+    
+    line_mask is an optional boolean array (one value per input
+    channel, True where there may be line emission, see 
+    make_line_mask) from prior knowledge of the field. If given,
+    the y-array and threshold are skipped: the baseline is fit
+    to the channels outside line_mask and k_est is estimated
+    from them.
+    
+    warm_start is an optional dict carrying the spline knots and 
+    poly order from a neighbouring pixel (see clean_cube). It is
+    updated in place with this spectrum's fit.
+    
+    NaN channels (e.g. partially blanked spectra at the map edges)
+    are interpolated over for the median filter, masked in the 
+    baseline fit and set to NaN in the output. Batches with fully
+    blank spectra should go through baseline_and_deglitch_batch.
     """
-    #Median filter both removes spikes and increases speed
-    downsampled_spec = im.median_filter(spec,filter_width)[::filter_width]
-    y = make_local_stddev(downsampled_spec,ww=ww)
-    k_est = np.median(y)
-    no_signal_spec = mask_spectrum(y,ww,downsampled_spec,keep_signal=False,**kwargs)
-    if basetype=="spline":
-        baseline = get_spline_baseline(no_signal_spec)
-    elif basetype=="poly":
-        baseline = get_poly_baseline(no_signal_spec,k_est,debug=True,**kwargs)
-    elif basetype == "smoothed_data":
-        baseline = get_smoothed_data_baseline(no_signal_spec)
+    nan_chans = np.isnan(spec)
+    has_nans = nan_chans.any()
+    if has_nans:
+        good = ~nan_chans
+        spec = np.interp(np.arange(spec.size),np.flatnonzero(good),spec[good])
+    if spur_channels is not None:
+        spur_channels = tuple(int(c) for c in spur_channels) #Hashable for the cache
+    if cache is None:
+        downsampled_spec = downsample_spectrum(spec,filter_width=filter_width,
+                    spur_channels=spur_channels,spike_threshold=spike_threshold)
+    else:
+        downsampled_spec = cache.cached(downsample_spectrum,spec,"downsample",
+                    filter_width=filter_width,spur_channels=spur_channels,
+                    spike_threshold=spike_threshold)
+    if has_nans:
+        #Downsampled channels whose filter window touched a NaN
+        bad = downsample_mask(nan_chans,filter_width)
+    if line_mask is not None:
+        #Prior line windows: no detection needed
+        line_ds = downsample_mask(line_mask,filter_width)
+        if has_nans:
+            line_ds = line_ds | bad
+        no_signal_spec = ma.masked_where(line_ds,downsampled_spec)
+        k_est = estimate_noise_line_free(downsampled_spec,~line_ds)
+    else:
+        if cache is None:
+            y = make_local_stddev(downsampled_spec,ww=ww)
+        else:
+            y = cache.cached(make_local_stddev,downsampled_spec,"local_stddev",ww=ww)
+        if has_nans:
+            #Give NaN channels a typical y so they neither bias k_est nor look like signal
+            y = np.array(y,dtype=float)
+            y[...,bad] = np.median(y[...,~bad],axis=-1)[...,None]
+        k_est = np.median(y)
+        no_signal_spec = mask_spectrum(y,ww,downsampled_spec,keep_signal=False,**kwargs)
+        if has_nans:
+            no_signal_spec[bad] = ma.masked
+    baseline = fit_baseline(no_signal_spec,k_est,basetype=basetype,**kwargs)
     if "outdir" in kwargs:
         try:
             os.mkdir(kwargs["outdir"])
@@ -73,19 +144,391 @@ def baseline_and_deglitch(spec,filter_width=7,ww=20,basetype="spline",**kwargs):
         plt.xlabel("Spectral Pixel")
         plt.title("Baseline Fit")
         plt.savefig(kwargs["outdir"]+"/baseline-fit.png")
-    final_spec = downsampled_spec - baseline
+    if full_resolution:
+        if spike_threshold is None:
+            spike_threshold = 5
+        deglitched_spec = remove_spikes(spec,spur_channels,spike_threshold)
+        final_spec = deglitched_spec - upsample_baseline(baseline,spec.size,filter_width)
+        if has_nans:
+            final_spec[nan_chans] = np.nan
+    else:
+        final_spec = downsampled_spec - baseline
+        if has_nans:
+            final_spec[bad] = np.nan
     return(final_spec)
+
+def upsample_baseline(baseline,nchan,filter_width=7):
+    """
+    Evaluate a baseline fit on the downsampled grid at all channels
+    
+    Downsampled channel j is centred on channel j*filter_width.
+    The baseline is smooth, so a cubic interpolation through 
+    the downsampled values reproduces it.
+    """
+    xx = np.arange(baseline.size)*filter_width
+    f = InterpolatedUnivariateSpline(xx,baseline,k=3)
+    return(f(np.arange(nchan)))
+
+BLANK, ALL_NAN, PARTIAL_NAN, VALID = range(4)
+
+def prescreen_spectra(spectra):
+    """
+    Classify each spectrum (row) of a 2-D array
     
-def get_spline_baseline(mspec):
+    Returns an array with one status per row:
+    BLANK (constant, usually zero, spectrum), ALL_NAN,
+    PARTIAL_NAN (some channels NaN) or VALID. This is 
+    vectorized over the whole batch so that the NaN
+    borders of a map cost almost nothing.
+    """
+    spectra = np.asarray(spectra)
+    nan_chans = np.isnan(spectra)
+    n_nan = nan_chans.sum(axis=-1)
+    lo = np.where(nan_chans,np.inf,spectra).min(axis=-1)
+    hi = np.where(nan_chans,-np.inf,spectra).max(axis=-1)
+    status = np.full(n_nan.shape,VALID)
+    status[n_nan > 0] = PARTIAL_NAN
+    status[lo == hi] = BLANK
+    status[n_nan == spectra.shape[-1]] = ALL_NAN
+    return(status)
+
+def baseline_and_deglitch_batch(spectra,filter_width=7,**kwargs):
+    """
+    Run baseline_and_deglitch on each row of a 2-D array
+    
+    Rows are pre-screened with prescreen_spectra. BLANK
+    and ALL_NAN rows skip the fitting entirely and give
+    all-NaN output; PARTIAL_NAN rows are cleaned with
+    their NaN channels masked. Returns the cleaned
+    spectra and the status of each row.
+    """
+    spectra = np.asarray(spectra)
+    status = prescreen_spectra(spectra)
+    nout = output_length(spectra.shape[-1],filter_width,kwargs.get("full_resolution",False))
+    cleaned = np.full((spectra.shape[0],nout),np.nan)
+    for i in np.flatnonzero(status >= PARTIAL_NAN):
+        cleaned[i] = baseline_and_deglitch(spectra[i],filter_width=filter_width,**kwargs)
+    return(cleaned,status)
+
+def make_line_mask(nchan,line_windows=None,line_free_windows=None):
+    """
+    Make a line mask from lists of (start,stop) channel ranges
+    
+    Channels in line_windows are marked as line. If 
+    line_free_windows are given instead, every channel 
+    outside them is marked as line.
+    """
+    if line_free_windows is not None:
+        line_mask = np.ones(nchan,dtype=bool)
+        for start,stop in line_free_windows:
+            line_mask[start:stop] = False
+    else:
+        line_mask = np.zeros(nchan,dtype=bool)
+        for start,stop in line_windows:
+            line_mask[start:stop] = True
+    return(line_mask)
+
+def downsample_mask(mask,filter_width=7):
+    """
+    Downsample a channel mask to match downsample_spectrum
+    
+    A downsampled channel is set if any channel in its filter
+    window is set.
+    """
+    return(im.binary_dilation(mask,structure=np.ones(filter_width))[::filter_width])
+
+def estimate_noise_line_free(spec,line_free):
+    """
+    Estimate the per-channel noise from line-free channels
+    
+    Uses the robust scatter of differences between adjacent
+    line-free channels, which (unlike their standard deviation)
+    is not inflated by a residual baseline.
+    """
+    pairs = line_free[1:] & line_free[:-1]
+    diff = np.diff(spec)[pairs]
+    diff = diff[np.isfinite(diff)]
+    k_est = 1.4826*np.median(np.abs(diff-np.median(diff)))/np.sqrt(2)
+    return(k_est)
+
+def iter_batches(spectra,batch_size=64):
+    """
+    Group an iterable of spectra (or 2-D batches) into 2-D batches
+    
+    Only one batch of spectra is held in memory at a time.
+    """
+    batch = []
+    for item in spectra:
+        item = np.asarray(item)
+        rows = item if item.ndim == 2 else [item]
+        for row in rows:
+            batch.append(row)
+            if len(batch) == batch_size:
+                yield(np.array(batch))
+                batch = []
+    if batch:
+        yield(np.array(batch))
+
+def iter_clean(spectra,batch_size=64,filter_width=7,ww=20,**kwargs):
+    """
+    Clean an iterable of spectra, yielding the results in order
+    
+    spectra can be any iterable (e.g. a generator reading from
+    many files) of spectra and/or 2-D batches of spectra. They 
+    are cleaned in batches of batch_size with 
+    baseline_and_deglitch_batch, so memory use is bounded.
+    For each input spectrum this yields the cleaned spectrum,
+    the signal mask (True for signal, see 
+    moments.identify_signal_estimate_noise) and the noise
+    estimate, as from clean_cube.pixel_moments (so a line_mask
+    is used for the moments too). Blank and all-NaN spectra
+    give NaN results.
+    """
+    import clean_cube
+    for batch in iter_batches(spectra,batch_size):
+        cleaned,status = baseline_and_deglitch_batch(batch,filter_width=filter_width,
+                                                     ww=ww,**kwargs)
+        for spec,st in zip(cleaned,status):
+            if st < PARTIAL_NAN:
+                yield(spec,np.zeros(spec.size,dtype=bool),np.nan)
+            else:
+                signal_spec,mom0,mom0_err,noise_estimate = clean_cube.pixel_moments(spec,
+                            filter_width=filter_width,ww=ww,line_mask=kwargs.get("line_mask"),
+                            full_resolution=kwargs.get("full_resolution",False))
+                yield(spec,~ma.getmaskarray(signal_spec),noise_estimate)
+
+def moment_settings(ww,filter_width=7,full_resolution=False):
+    """
+    ww and downsample_fact to use for the moments of a cleaned spectrum
+    
+    ww (a width or a sequence of widths) is set in downsampled
+    channels, so it is scaled up for full-resolution spectra,
+    which need no downsample_fact.
+    """
+    if full_resolution:
+        if np.iterable(ww):
+            return(tuple(w*filter_width for w in ww),1)
+        return(ww*filter_width,1)
+    return(ww,filter_width)
+
+def output_length(nchan,filter_width=7,full_resolution=False):
+    """
+    Number of channels in a cleaned spectrum
+    """
+    if full_resolution:
+        return(nchan)
+    return(len(range(0,nchan,filter_width)))
+
+def downsample_spectrum(spec,filter_width=7,spur_channels=None,spike_threshold=None):
+    """
+    Median filter and downsample a spectrum
+    
+    Median filter both removes spikes and increases speed.
+    
+    If the spur channels are known (spur_channels) and/or
+    spike_threshold is set, the spikes are removed directly
+    with remove_spikes and the spectrum is downsampled with
+    a running mean over the same window instead, so no
+    median pass is needed.
+    """
+    if spur_channels is None and spike_threshold is None:
+        downsampled_spec = im.median_filter(spec,filter_width)[::filter_width]
+    else:
+        spec = remove_spikes(spec,spur_channels,spike_threshold)
+        downsampled_spec = im.uniform_filter1d(spec,filter_width)[::filter_width]
+    return(downsampled_spec)
+
+def remove_spikes(spec,spur_channels=None,spike_threshold=None):
+    """
+    Replace spur channels and spikes by interpolation
+    
+    spur_channels are the fixed channels where VEGAS puts spurs
+    for a given configuration. With spike_threshold, other
+    single-channel spikes are found where the spectrum departs
+    from the mean of its two neighbours by more than 
+    spike_threshold times the (robust) scatter of that
+    difference. Real lines are many channels wide, so they
+    are left alone.
+    """
+    spec = np.array(spec,dtype=float)
+    bad = np.zeros(spec.size,dtype=bool)
+    if spur_channels is not None:
+        bad[np.asarray(spur_channels,dtype=int)] = True
+    if spike_threshold is not None:
+        resid = spec[1:-1] - 0.5*(spec[:-2]+spec[2:])
+        scatter = 1.4826*np.median(np.abs(resid-np.median(resid)))
+        bad[1:-1] |= np.abs(resid) > spike_threshold*scatter
+    if bad.any():
+        good = ~bad
+        spec[bad] = np.interp(np.flatnonzero(bad),np.flatnonzero(good),spec[good])
+    return(spec)
+
+def read_spur_table(filename):
+    """
+    Read a table of spur channels for each VEGAS configuration
+    
+    Each line is a configuration name followed by its spur
+    channels; lines starting with # are comments. Returns a 
+    dictionary of configuration name -> array of channels.
+    """
+    table = {}
+    with open(filename) as f:
+        for line in f:
+            words = line.split("#")[0].split()
+            if words:
+                table[words[0]] = np.array(words[1:],dtype=int)
+    return(table)
+    
+def fit_baseline(no_signal_spec,k_est,basetype="spline",time_budget=None,diagnostics=None,
+                 max_knots=None,**kwargs):
+    """
+    Fit a baseline of the requested type to the masked spectrum
+    
+    The debug plot for poly baselines is only made when
+    an outdir is given to write it to.
+    
+    basetype can also be a sequence of basetypes, for example
+    ("spline","poly","smoothed_data"), which is used as a fallback
+    cascade. Each fit is accepted if it does not raise, is finite
+    and passes check_baseline; otherwise the next basetype is
+    tried. Fits cannot be interrupted, so time_budget (seconds)
+    is checked between fits: once it is used up we go straight
+    to the last basetype. The last basetype is always accepted.
+    
+    The knot search of a single spline fit is bounded instead by
+    max_knots (see get_spline_baseline). A spline that hits the
+    cap is not as smooth as asked for, so in a cascade it is
+    usually rejected by check_baseline.
+    
+    If diagnostics is a dict, the basetype that was used, a
+    list of (basetype,accepted,seconds,rms) for every attempt
+    and whether a spline hit max_knots (knot_cap_hit) are 
+    stored in it.
+    """
+    if max_knots is not None and max_knots < 8:
+        raise ValueError("max_knots must be at least 8 for a cubic spline")
+    basetypes = [basetype] if isinstance(basetype,str) else list(basetype)
+    start = time.time()
+    attempts = []
+    fit_info = {"knot_cap_hit":False}
+    for i,bt in enumerate(basetypes):
+        last = (i == len(basetypes)-1)
+        if not last and time_budget is not None and time.time()-start >= time_budget:
+            continue
+        t0 = time.time()
+        if last:
+            baseline = get_baseline(no_signal_spec,k_est,basetype=bt,max_knots=max_knots,
+                                    fit_info=fit_info,**kwargs)
+            ok,rms = check_baseline(no_signal_spec,baseline,k_est)
+            accepted = True
+        else:
+            try:
+                baseline = get_baseline(no_signal_spec,k_est,basetype=bt,max_knots=max_knots,
+                                    fit_info=fit_info,**kwargs)
+                ok,rms = check_baseline(no_signal_spec,baseline,k_est)
+            except (ValueError,np.linalg.LinAlgError):
+                ok,rms = False,np.nan
+            accepted = ok
+        attempts.append((bt,accepted,time.time()-t0,rms))
+        if accepted:
+            break
+    if diagnostics is not None:
+        diagnostics["basetype"] = bt
+        diagnostics["attempts"] = attempts
+        diagnostics["knot_cap_hit"] = fit_info["knot_cap_hit"]
+    return(baseline)
+
+def get_baseline(no_signal_spec,k_est,basetype="spline",max_knots=None,fit_info=None,**kwargs):
+    """
+    Fit a single baseline of the requested type
+    """
+    if basetype=="spline":
+        baseline = get_spline_baseline(no_signal_spec,warm_start=kwargs.get("warm_start"),
+                                       max_knots=max_knots,fit_info=fit_info)
+    elif basetype=="poly":
+        baseline = get_poly_baseline(no_signal_spec,k_est,debug="outdir" in kwargs,**kwargs)
+    elif basetype == "smoothed_data":
+        baseline = get_smoothed_data_baseline(no_signal_spec)
+    else:
+        raise ValueError("Unknown basetype: "+str(basetype))
+    return(baseline)
+
+def check_baseline(mspec,baseline,k_est,rms_factor=2.):
+    """
+    Check whether a baseline fit is sensible
+    
+    The rms error of the fit on the unmasked (line-free)
+    channels should be within a factor of rms_factor of
+    the estimated noise (k_est), as in get_poly_baseline.
+    Returns the verdict and the rms.
+    """
+    if not np.all(np.isfinite(baseline)):
+        return(False,np.nan)
+    good = ~ma.getmaskarray(mspec)
+    resid = ma.getdata(mspec)[good] - baseline[good]
+    rms = np.sqrt(np.mean(resid**2)) if resid.size else np.nan
+    ok = bool(k_est/rms_factor <= rms <= k_est*rms_factor)
+    return(ok,rms)
+    
+def get_spline_baseline(mspec,warm_start=None,warm_tol=0.2,max_knots=None,fit_info=None):
     """
     Spline fit a baseline on the masked spectrum
+    
+    If warm_start is a dict with the interior "knots" of an
+    already-fit neighbouring spectrum, a least-squares spline
+    on those knots is tried first. It is kept if it nearly
+    meets the smoothing condition that UnivariateSpline 
+    iterates towards (residual <= s, here within a fraction
+    warm_tol), which skips the knot search. The knots used
+    are stored back in warm_start.
+    
+    UnivariateSpline adds knots until the smoothing condition
+    is met, with no bound on the time taken. With max_knots,
+    the knot search (FITPACK curfit) stops once the spline has
+    that many knots (counting the 4 repeated knots at each 
+    end) and the least-squares spline on those knots is used.
+    If fit_info is a dict, knot_cap_hit is set in it when
+    that happens.
     """
     xxx = np.arange(mspec.size)
     w = ma.getmaskarray(mspec)
-    spl = UnivariateSpline(xxx, mspec, w=~w)
+    spl = None
+    if warm_start is not None and warm_start.get("knots") is not None:
+        try:
+            spl = LSQUnivariateSpline(xxx, ma.getdata(mspec), warm_start["knots"], w=~w)
+            #UnivariateSpline uses s = len(w) by default
+            if not spl.get_residual() <= mspec.size*(1+warm_tol):
+                spl = None
+        except ValueError:
+            spl = None
+    if spl is None and max_knots is not None:
+        spl,capped = get_capped_spline(xxx,ma.getdata(mspec),(~w).astype(float),max_knots)
+        if capped and fit_info is not None:
+            fit_info["knot_cap_hit"] = True
+    if spl is None:
+        spl = UnivariateSpline(xxx, mspec, w=~w)
+    if warm_start is not None:
+        warm_start["knots"] = spl.get_knots()[1:-1]
     fit_baseline = spl(xxx)
     return(fit_baseline)
     
+def get_capped_spline(x,y,w,max_knots,k=3):
+    """
+    Smoothing spline (s = len(w), as UnivariateSpline) with at most max_knots knots
+    
+    Returns the spline and whether the knot cap was hit.
+    """
+    try:
+        from scipy.interpolate import _dfitpack as dfitpack
+    except ImportError: #SciPy < 1.14
+        from scipy.interpolate import dfitpack
+    data = dfitpack.fpcurf0(x,y,k,w=w,s=float(len(w)),nest=max_knots)
+    n,t,c,ier = data[7],data[8],data[9],data[-1]
+    if ier > 1:
+        raise ValueError("Spline fit failed (FITPACK ier=%d)" % ier)
+    spl = UnivariateSpline._from_tck((t[:n],c[:n],k))
+    return(spl,ier == 1)
+    
 def get_smoothed_data_baseline(mspec):
     """
     Calculate the baseline as a smoothed version of the input data
@@ -103,7 +546,7 @@ def get_smoothed_data_baseline(mspec):
     return(fit_baseline)
     
     
-def get_poly_baseline(mspec,k_est,debug=True,**kwargs):
+def get_poly_baseline(mspec,k_est,debug=True,warm_start=None,**kwargs):
     """
     Fit for the best polynomial baseline according to BIC
     
@@ -112,8 +555,15 @@ def get_poly_baseline(mspec,k_est,debug=True,**kwargs):
     also have an rms error within a factor of two of 
     the estimated noise (k_est). If this is not the case
     then the baseline fit is most likely bad. 
+    
+    If warm_start is a dict with the "poly_order" of a 
+    neighbouring spectrum, only that order and the orders
+    either side of it are searched. The chosen order is
+    stored back in warm_start.
     """
     d = np.arange(0,7)
+    if warm_start is not None and warm_start.get("poly_order") is not None:
+        d = d[abs(d-warm_start["poly_order"]) <= 1]
     rms_err = np.zeros(d.shape)
     all_polys = []
     #k_est = 0.2/np.sqrt(7)
@@ -147,8 +597,9 @@ def get_poly_baseline(mspec,k_est,debug=True,**kwargs):
         plt.savefig(kwargs["outdir"]+"/debugplot.png")
         
         plt.close(fig)
-    best_poly_order = np.argmin(AIC)
-    best_poly = all_polys[best_poly_order]
+    best_poly = all_polys[np.argmin(AIC)]
+    if warm_start is not None:
+        warm_start["poly_order"] = d[np.argmin(AIC)]
     return(best_poly(xx))
         
         
@@ -162,23 +613,37 @@ def mask_spectrum(y,ww,spec,stddevlev=3,keep_signal=True,**kwargs):
     Identify regions with significant signal based on y-array
     and standard deviation level. Mask significant signal either 
     in or out, depending on flag.
+    
+    If ww is a sequence of window widths (multi-scale mode), y
+    holds one y-array per width (see make_local_stddev) and a
+    channel is signal if it is significant at any of the scales,
+    each with its own k_est and std_y.
     """
-    k_est = np.median(y)
-    std_y = k_est/(np.sqrt(2*ww*2)) #extra 2 here because ww is half the real window 
-    upperlim = k_est+std_y*stddevlev
-    if keep_signal:
-        mspec = ma.masked_where(y < upperlim,spec)
+    if np.iterable(ww):
+        upperlim = [get_upperlim(yi,wwi,stddevlev) for yi,wwi in zip(y,ww)]
+        is_signal = np.zeros(np.shape(spec),dtype=bool)
+        for yi,ul in zip(y,upperlim):
+            is_signal |= yi > ul
+        if keep_signal:
+            mspec = ma.masked_where(~is_signal,spec)
+        else:
+            mspec = ma.masked_where(is_signal,spec)
     else:
-        mspec = ma.masked_where(y > upperlim,spec)
+        upperlim = get_upperlim(y,ww,stddevlev)
+        if keep_signal:
+            mspec = ma.masked_where(y < upperlim,spec)
+        else:
+            mspec = ma.masked_where(y > upperlim,spec)
     if "outdir" in kwargs:
         try:
             os.mkdir(kwargs["outdir"])
         except OSError:
             pass
         plt.figure()
-        plt.plot(y,color="blue",alpha=0.5,)
-        plt.xlim(0,len(y))
-        plt.axhline(upperlim,color='red',ls=":")
+        for yi,ul in zip(np.atleast_2d(y),np.atleast_1d(upperlim)):
+            line, = plt.plot(yi,alpha=0.5,)
+            plt.axhline(ul,color=line.get_color(),ls=":")
+        plt.xlim(0,np.shape(y)[-1])
         plt.ylabel("Local Standard Deviation (y-array)")
         plt.xlabel("Spectral Pixel")
         plt.title("Local Standard Deviation Masking")
@@ -186,6 +651,15 @@ def mask_spectrum(y,ww,spec,stddevlev=3,keep_signal=True,**kwargs):
         
     return(mspec)
 
+def get_upperlim(y,ww,stddevlev=3):
+    """
+    Threshold on the y-array above which we have signal
+    """
+    k_est = np.median(y)
+    std_y = k_est/(np.sqrt(2*ww*2)) #extra 2 here because ww is half the real window 
+    upperlim = k_est+std_y*stddevlev
+    return(upperlim)
+
 def rolling_window(a,window):
     """
     Magic code to quickly create a second dimension
@@ -201,8 +675,37 @@ def make_local_stddev(orig_spec,ww=300):
     """
     Make an array that encodes the local standard
     deviation within a window of width ww
+    
+    If ww is a sequence of window widths, return a 2-D
+    array with one y-array per width, all computed from
+    one cumulative-sum pass (see make_local_stddevs).
     """
     import my_pad
+    if np.iterable(ww):
+        return(np.array(make_local_stddevs(orig_spec,ww)))
     ya = rolling_window(orig_spec,ww*2)
     y = my_pad.pad(np.std(ya,-1),(ww-1,ww),mode='edge')
-    return(y)
\ No newline at end of file
+    return(y)
+
+def make_local_stddevs(orig_spec,wws):
+    """
+    Make y-arrays for several window widths at once
+    
+    All windows are computed from one pair of cumulative
+    sums (of the spectrum and its square), so each extra
+    window width costs O(n) instead of O(n ww). The 
+    results match make_local_stddev for each ww.
+    """
+    import my_pad
+    x = np.asarray(orig_spec,dtype=float)
+    x = x - np.mean(x) #Reduce round-off in the sums
+    s1 = np.concatenate(([0.],np.cumsum(x)))
+    s2 = np.concatenate(([0.],np.cumsum(x*x)))
+    ys = []
+    for ww in wws:
+        n = ww*2
+        sum1 = s1[n:] - s1[:-n]
+        sum2 = s2[n:] - s2[:-n]
+        var = np.clip(sum2/n - (sum1/n)**2,0,None)
+        ys.append(my_pad.pad(np.sqrt(var),(ww-1,ww),mode='edge'))
+    return(ys)
@@ -0,0 +1,394 @@
+"""
+Command-line interface for cleaning cubes.
+
+    rampsclean cube.fits [more.fits ...] -o outdir [options]
+
+Each input is a FITS or .npy cube in (spectral,y,x) order.
+It is cleaned with pipeline.clean_cube_pipelined and the
+cleaned cube and the mom0, mom0 error and noise maps are
+written to outdir as <name>_clean, <name>_mom0,
+<name>_mom0_err and <name>_noise, in the input format.
+FITS outputs keep the header (WCS, BUNIT, ...) of the
+input, adjusted for the downsampling (cube_header); the
+maps keep only the spatial WCS (map_header).
+While running, the spectra per second, ETA and the time
+spent reading, cleaning and writing are shown on stderr.
+
+For cluster array jobs, --shard i/N runs part i (counting
+from 0) of N. With at least N inputs the files are shared
+out between the jobs. Otherwise every cube is split into
+N strips of rows and job i writes only its strip, with a
+_shard<i>of<N> suffix on the output names.
+"""
+import os,sys
+#The modules import each other directly. Append (not prepend) so they never
+#shadow installed modules of the same name in a process that imports this one
+if os.path.dirname(os.path.abspath(__file__)) not in sys.path:
+    sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+import argparse
+import re
+import time
+import numpy as np
+import cache
+import clean_cube
+import clean_spectrum
+import pipeline
+import synthetic_cube
+
+
+def parse_shard(text):
+    """
+    Parse "i/N" into (i,N), with 0 <= i < N
+    """
+    try:
+        i,n = [int(v) for v in text.split("/")]
+    except ValueError:
+        raise argparse.ArgumentTypeError("shard must be i/N, e.g. 3/10")
+    if not 0 <= i < n:
+        raise argparse.ArgumentTypeError("shard i/N needs 0 <= i < N")
+    return((i,n))
+
+def parse_window(text):
+    """
+    Parse a "start:stop" channel range
+    """
+    try:
+        start,stop = [int(v) for v in text.split(":")]
+    except ValueError:
+        raise argparse.ArgumentTypeError("channel windows must be start:stop")
+    return((start,stop))
+
+def make_parser():
+    """
+    Command-line options, one for each pipeline parameter
+    """
+    parser = argparse.ArgumentParser(prog="rampsclean",
+                description="Remove baselines and spikes from RAMPS cubes and make moment maps")
+    parser.add_argument("inputs",nargs="+",help="FITS or .npy cubes (spectral,y,x)")
+    parser.add_argument("-o","--outdir",default=".",help="output directory")
+    parser.add_argument("--filter-width",type=int,default=7,
+                        help="median filter width and downsampling factor")
+    parser.add_argument("--ww",type=int,nargs="+",default=[20],
+                        help="half window width(s) for the local standard deviation")
+    parser.add_argument("--basetype",nargs="+",default=["spline"],
+                        choices=["spline","poly","smoothed_data"],
+                        help="baseline type, or a fallback cascade of types")
+    parser.add_argument("--stddevlev",type=float,default=3,
+                        help="signal threshold on the y-array in sigma")
+    parser.add_argument("--time-budget",type=float,default=None,
+                        help="seconds per spectrum before skipping to the last basetype")
+    parser.add_argument("--max-knots",type=int,default=None,
+                        help="cap on the knots of a spline baseline, to bound its fit time")
+    parser.add_argument("--full-resolution",action="store_true",
+                        help="subtract the baseline at full spectral resolution")
+    parser.add_argument("--spike-threshold",type=float,default=None,
+                        help="remove single-channel spikes above this many sigma")
+    parser.add_argument("--spur-table",default=None,help="table of VEGAS spur channels")
+    parser.add_argument("--vegas-config",default=None,
+                        help="configuration to look up in --spur-table")
+    parser.add_argument("--line-windows",type=parse_window,nargs="+",default=None,
+                        metavar="START:STOP",help="channel ranges known to hold lines")
+    parser.add_argument("--line-free-windows",type=parse_window,nargs="+",default=None,
+                        metavar="START:STOP",help="channel ranges known to be line-free")
+    parser.add_argument("--warm-start",action="store_true",
+                        help="seed each fit from its spatial neighbour")
+    parser.add_argument("--tile-shape",type=int,nargs=2,default=[16,16],metavar=("NY","NX"))
+    parser.add_argument("--cache",default=None,help="directory for the intermediate cache")
+    parser.add_argument("--workers",type=int,default=1,help="number of parallel workers")
+    parser.add_argument("--executor",choices=["process","thread"],default="process",
+                        help="kind of worker pool for --workers > 1")
+    parser.add_argument("--memory-budget",type=float,default=1024,
+                        help="MB for the tiles queued between reading, cleaning and writing")
+    parser.add_argument("--shard",type=parse_shard,default=(0,1),metavar="i/N",
+                        help="only run part i (from 0) of N, for array jobs")
+    parser.add_argument("--resume",action="store_true",
+                        help="keep a checkpoint and skip tiles finished by an earlier run")
+    parser.add_argument("-q","--quiet",action="store_true",help="no progress output")
+    return(parser)
+
+def clean_kwargs(args):
+    """
+    Keywords for clean_cube from the parsed arguments
+    """
+    kwargs = {"filter_width":args.filter_width,
+              "ww":args.ww[0] if len(args.ww) == 1 else tuple(args.ww),
+              "basetype":args.basetype[0] if len(args.basetype) == 1 else tuple(args.basetype),
+              "stddevlev":args.stddevlev,
+              "tile_shape":tuple(args.tile_shape)}
+    if args.time_budget is not None:
+        kwargs["time_budget"] = args.time_budget
+    if args.max_knots is not None:
+        kwargs["max_knots"] = args.max_knots
+    if args.full_resolution:
+        kwargs["full_resolution"] = True
+    if args.warm_start:
+        kwargs["warm_start"] = True
+    if args.spike_threshold is not None:
+        kwargs["spike_threshold"] = args.spike_threshold
+    if args.spur_table is not None:
+        table = clean_spectrum.read_spur_table(args.spur_table)
+        if args.vegas_config not in table:
+            raise ValueError("--vegas-config %s is not in %s (it has: %s)"
+                             % (args.vegas_config,args.spur_table,", ".join(sorted(table))))
+        kwargs["spur_channels"] = table[args.vegas_config]
+    if args.cache is not None:
+        kwargs["cache"] = cache.DiskCache(args.cache)
+    return(kwargs)
+
+def shard_units(filenames,shard,ny_of):
+    """
+    List the (filename,rows) to clean in this shard
+
+    rows is a slice of the y axis, or None for the whole cube.
+    ny_of(filename) gives the number of rows of a cube.
+    """
+    i,n = shard
+    if n == 1:
+        return([(f,None) for f in filenames])
+    if len(filenames) >= n:
+        return([(f,None) for f in filenames[i::n]])
+    units = []
+    for f in filenames:
+        edges = np.linspace(0,ny_of(f),n+1).astype(int)
+        if edges[i+1] > edges[i]:
+            units.append((f,slice(edges[i],edges[i+1])))
+    return(units)
+
+def output_name(outdir,filename,product,shard=None):
+    """
+    Name of an output product for an input cube
+    """
+    base = os.path.basename(filename)
+    for ext in (".npy",".fits",".fit",".fts"):
+        if base.endswith(ext):
+            base,fmt = base[:-len(ext)],ext
+            break
+    else:
+        raise ValueError("Unknown cube format for "+filename)
+    if shard is not None:
+        base += "_shard%dof%d" % shard
+    return(os.path.join(outdir,base+"_"+product+fmt))
+
+def read_header(filename):
+    """
+    The primary header of a FITS cube (None for .npy)
+    """
+    if filename.endswith(".npy"):
+        return(None)
+    from astropy.io import fits
+    return(fits.getheader(filename))
+
+def cube_header(header,filter_width=7,full_resolution=False,rows=None):
+    """
+    Header for the cleaned cube from that of the input
+
+    Unless full_resolution, the spectral axis (FITS axis 3) is
+    downsampled: output channel j is centred on input channel
+    j*filter_width, so CDELT3 (or CD3_3) is scaled by
+    filter_width and CRPIX3 moved to match. For a strip of
+    rows (a shard), CRPIX2 is moved to the first row.
+    """
+    if header is None:
+        return(None)
+    header = synthetic_cube.strip_header(header)
+    if not full_resolution:
+        if "CD3_3" in header:
+            for key in ("CD1_3","CD2_3","CD3_3"):
+                if key in header:
+                    header[key] *= filter_width
+        elif "CDELT3" in header:
+            header["CDELT3"] *= filter_width
+        if "CRPIX3" in header:
+            header["CRPIX3"] = 1+(header["CRPIX3"]-1)/filter_width
+    if rows is not None and "CRPIX2" in header:
+        header["CRPIX2"] -= rows.start
+    return(header)
+
+#Keywords of FITS axis 3 (and its WCS alternates A-Z)
+SPECTRAL_WCS = re.compile(r"^((CTYPE|CRVAL|CDELT|CRPIX|CUNIT|CROTA|CNAME|CRDER|CSYER)3"
+                          r"|(PC|CD)(3_\d+|\d+_3)|(PV|PS)3_\d+)[A-Z]?$")
+
+def map_header(header,product,rows=None):
+    """
+    Header for a 2-D map from that of the input cube
+
+    Only the spatial WCS is kept. mom0 and its error are sums
+    over (full resolution) channels, so their BUNIT gets a
+    factor of chan.
+    """
+    if header is None:
+        return(None)
+    header = cube_header(header,rows=rows,full_resolution=True)
+    for key in [k for k in header if SPECTRAL_WCS.match(k)]:
+        header.remove(key,remove_all=True)
+    if "WCSAXES" in header:
+        header["WCSAXES"] = 2
+    if product in ("mom0","mom0_err") and "BUNIT" in header:
+        header["BUNIT"] = header["BUNIT"]+" chan"
+    return(header)
+
+def create_output(filename,shape,resume=False,header=None):
+    """
+    Create an empty memory-mapped .npy or FITS output
+
+    With resume, an existing output of the right shape is
+    opened for update instead. Returns the array and the
+    HDU list to close (None for .npy). header is copied
+    into a new FITS output (see cube_header).
+    """
+    if resume and os.path.exists(filename):
+        if filename.endswith(".npy"):
+            data,hdul = np.load(filename,mmap_mode='r+'),None
+        else:
+            from astropy.io import fits
+            hdul = fits.open(filename,mode='update',memmap=True)
+            data = hdul[0].data
+        if data.shape == tuple(shape):
+            return(data,hdul)
+        if hdul is not None:
+            hdul.close()
+    if filename.endswith(".npy"):
+        return(np.lib.format.open_memmap(filename,mode='w+',dtype=np.float32,shape=shape),None)
+    hdul = synthetic_cube.create_fits_memmap(filename,shape,header=header)
+    return(hdul[0].data,hdul)
+
+def write_map(filename,data,header=None):
+    """
+    Write a 2-D map as .npy or FITS (with header, see map_header)
+    """
+    if filename.endswith(".npy"):
+        np.save(filename,data.astype(np.float32))
+    else:
+        from astropy.io import fits
+        fits.PrimaryHDU(data.astype(np.float32),header=header).writeto(filename,overwrite=True)
+
+
+class Progress:
+    """
+    Live spectra per second, ETA and stage times on one line of stderr
+    """
+
+    def __init__(self,total,stream=None,interval=0.5):
+        self.total = total
+        self.stream = sys.stderr if stream is None else stream
+        self.interval = interval
+        self.done = 0
+        self.start = time.time()
+        self.last = 0.
+        self.times = {"read":0.,"compute":0.,"write":0.}
+        self.finished_times = dict(self.times) #From cubes already done
+
+    def next_cube(self):
+        for stage in self.times:
+            self.finished_times[stage] = self.times[stage]
+
+    def __call__(self,nspec,times):
+        if times is None: #Finished in an earlier run
+            self.total -= nspec
+            return
+        self.done += nspec
+        for stage in self.times:
+            self.times[stage] = self.finished_times[stage]+times[stage]
+        now = time.time()
+        if now-self.last >= self.interval or self.done == self.total:
+            self.last = now
+            self.stream.write("\r"+self.status(now))
+            self.stream.flush()
+
+    def status(self,now=None):
+        if now is None:
+            now = time.time()
+        elapsed = now-self.start
+        rate = self.done/elapsed if elapsed > 0 else 0.
+        eta = (self.total-self.done)/rate if rate > 0 else float("nan")
+        return("%d/%d spectra  %.1f spectra/s  ETA %s  read %.1fs clean %.1fs write %.1fs"
+               % (self.done,self.total,rate,format_seconds(eta),self.times["read"],
+                  self.times["compute"],self.times["write"]))
+
+def format_seconds(seconds):
+    """
+    Format a duration as h:mm:ss
+    """
+    if not np.isfinite(seconds):
+        return("?")
+    seconds = int(round(seconds))
+    return("%d:%02d:%02d" % (seconds//3600,seconds//60%60,seconds%60))
+
+def clean_file(filename,rows,outdir,shard,kwargs,line_windows=None,line_free_windows=None,
+               executor=None,memory_budget=2**30,progress=None,resume=False):
+    """
+    Clean one cube (or a strip of its rows) and write the results
+
+    With resume, a checkpoint is kept next to the outputs
+    (<name>_checkpoint) and tiles finished in an earlier
+    run with the same parameters are skipped.
+    """
+    cube = synthetic_cube.open_cube(filename)
+    header = read_header(filename)
+    if rows is not None:
+        cube = cube[:,rows,:]
+    else:
+        shard = None
+    nchan,ny,nx = cube.shape
+    kwargs = dict(kwargs)
+    if line_windows is not None or line_free_windows is not None:
+        kwargs["line_mask"] = clean_spectrum.make_line_mask(nchan,line_windows,line_free_windows)
+    full_resolution = kwargs.get("full_resolution",False)
+    nout = clean_spectrum.output_length(nchan,kwargs["filter_width"],full_resolution)
+    out,hdul = create_output(output_name(outdir,filename,"clean",shard),(nout,ny,nx),resume,
+                             cube_header(header,kwargs["filter_width"],full_resolution,rows))
+    if resume:
+        kwargs["checkpoint_dir"] = os.path.splitext(output_name(outdir,filename,
+                                                                "checkpoint",shard))[0]
+    try:
+        results = pipeline.clean_cube_pipelined(cube,memory_budget=memory_budget,out=out,
+                                                executor=executor,progress=progress,**kwargs)
+    finally:
+        if hdul is not None:
+            hdul.close()
+    for product,data in zip(("mom0","mom0_err","noise"),results[1:]):
+        write_map(output_name(outdir,filename,product,shard),data,
+                  map_header(header,product,rows))
+
+def main(argv=None):
+    """
+    Entry point of the rampsclean command
+    """
+    parser = make_parser()
+    args = parser.parse_args(argv)
+    if args.spur_table is not None and args.vegas_config is None:
+        parser.error("--spur-table needs --vegas-config")
+    try:
+        kwargs = clean_kwargs(args)
+    except (IOError,ValueError) as e:
+        parser.error(str(e))
+    if not os.path.isdir(args.outdir):
+        os.makedirs(args.outdir)
+    def ny_of(filename):
+        return(synthetic_cube.open_cube(filename).shape[1])
+    units = shard_units(args.inputs,args.shard,ny_of)
+    def nspec_of(filename,rows):
+        shape = synthetic_cube.open_cube(filename).shape
+        return((rows.stop-rows.start if rows is not None else shape[1])*shape[2])
+    total = sum(nspec_of(f,rows) for f,rows in units)
+    progress = None if args.quiet else Progress(total)
+    executor = None
+    if args.workers > 1:
+        executor = clean_cube.make_executor(args.workers,args.executor)
+    try:
+        for filename,rows in units:
+            clean_file(filename,rows,args.outdir,args.shard,kwargs,
+                       line_windows=args.line_windows,line_free_windows=args.line_free_windows,
+                       executor=executor,memory_budget=args.memory_budget*2**20,
+                       progress=progress,resume=args.resume)
+            if progress is not None:
+                progress.next_cube()
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    if progress is not None:
+        sys.stderr.write("\r"+progress.status()+"\n")
+    return(0)
+
+if __name__ == "__main__":
+    sys.exit(main())
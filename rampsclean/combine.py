@@ -0,0 +1,101 @@
+"""
+Combine polarizations and integrations before cleaning.
+
+The KFPA delivers two polarizations per beam, and a
+pixel may be covered by several integrations. Cleaning
+each of these spectra and then averaging costs one
+baseline fit per input spectrum. Here they are first
+averaged with noise weights and the average is cleaned
+once, which cuts the number of fits by the number of
+spectra combined.
+
+Spikes from VEGAS are not necessarily present in every
+input, so there is an option to remove them from each
+input before combining (deglitch_first). Dead or flagged
+inputs (blank or all NaN) are left out of the average.
+"""
+import numpy as np
+import clean_spectrum
+
+
+def estimate_noise(spectra):
+    """
+    Robust per-channel noise of each spectrum (row)
+
+    Uses the scatter of differences between adjacent
+    channels, which is insensitive to the baseline and
+    to (broad) lines. NaN channels are ignored.
+    """
+    diff = np.diff(np.atleast_2d(spectra),axis=-1)
+    mad = np.nanmedian(np.abs(diff-np.nanmedian(diff,axis=-1)[:,None]),axis=-1)
+    return(1.4826*mad/np.sqrt(2))
+
+def deglitch(spec,spur_channels=None,spike_threshold=5):
+    """
+    clean_spectrum.remove_spikes on a spectrum that may have NaN channels
+
+    NaN channels are interpolated over first, as in
+    baseline_and_deglitch, and set back to NaN afterwards.
+    """
+    nan_chans = np.isnan(spec)
+    if nan_chans.any():
+        good = ~nan_chans
+        spec = np.interp(np.arange(spec.size),np.flatnonzero(good),spec[good])
+    spec = clean_spectrum.remove_spikes(spec,spur_channels,spike_threshold)
+    spec[nan_chans] = np.nan
+    return(spec)
+
+def combine_spectra(spectra,weights=None,deglitch_first=False,spur_channels=None,
+                    spike_threshold=5):
+    """
+    Noise-weighted average of several spectra of the same position
+
+    spectra is an (n,nchan) array of polarizations and/or
+    integrations. weights default to 1/noise**2 with the noise
+    from estimate_noise. NaN channels in an input are left out
+    of the average for that channel. Inputs that are blank or
+    all NaN (see clean_spectrum.prescreen_spectra), e.g. a dead
+    polarization, or whose weight is not finite and positive,
+    get zero weight. With deglitch_first each input goes
+    through deglitch first.
+
+    Returns the combined spectrum and its noise estimate.
+    Raises ValueError if no input is usable.
+    """
+    spectra = np.array(spectra,dtype=float)
+    usable = clean_spectrum.prescreen_spectra(spectra) >= clean_spectrum.PARTIAL_NAN
+    if not usable.any():
+        raise ValueError("No usable spectra to combine")
+    if deglitch_first:
+        for i in np.flatnonzero(usable):
+            spectra[i] = deglitch(spectra[i],spur_channels,spike_threshold)
+    if weights is None:
+        weights = np.zeros(spectra.shape[0])
+        with np.errstate(divide='ignore'):
+            weights[usable] = 1./estimate_noise(spectra[usable])**2
+    weights = np.array(weights,dtype=float)
+    usable &= np.isfinite(weights) & (weights > 0)
+    if not usable.any():
+        raise ValueError("No spectra with a finite, positive weight to combine")
+    weights = np.where(usable,weights,0.)[:,None]*np.isfinite(spectra)
+    total_weight = weights.sum(axis=0)
+    with np.errstate(invalid='ignore',divide='ignore'):
+        combined = np.nansum(spectra*weights,axis=0)/total_weight
+        noise = np.median(1./np.sqrt(total_weight[total_weight > 0]))
+    return(combined,noise)
+
+def clean_combined(spectra,weights=None,deglitch_first=False,**kwargs):
+    """
+    Combine spectra with combine_spectra and clean the result once
+
+    Keywords are passed to clean_spectrum.baseline_and_deglitch,
+    including spur_channels and spike_threshold, which are also
+    used for deglitch_first.
+    """
+    combine_kwargs = {}
+    for key in ("spur_channels","spike_threshold"):
+        if kwargs.get(key) is not None:
+            combine_kwargs[key] = kwargs[key]
+    combined,noise = combine_spectra(spectra,weights=weights,deglitch_first=deglitch_first,
+                                     **combine_kwargs)
+    return(clean_spectrum.baseline_and_deglitch(combined,**kwargs))
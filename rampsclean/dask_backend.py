@@ -0,0 +1,67 @@
+"""
+Clean cubes lazily with dask.
+
+The clean and moments chain (clean_cube.clean_tile) is
+applied with map_blocks to a dask array chunked along the
+spatial axes, with the full spectral axis in every chunk.
+Nothing is computed until the results are, so they can
+be combined with further dask operations and run on any
+dask scheduler (threads, processes or distributed)
+without writing intermediate cubes.
+
+dask is an optional dependency; it is only imported
+when clean_dask is called.
+"""
+import numpy as np
+import clean_cube
+import clean_spectrum
+
+
+def clean_block(block,line_mask_block=None,filter_width=7,ww=20,**kwargs):
+    """
+    Clean one chunk, returning the cleaned spectra and maps stacked
+
+    The result has the nout cleaned channels followed by
+    mom0, mom0 error and noise along the first axis.
+    """
+    if line_mask_block is not None:
+        kwargs["line_mask"] = line_mask_block
+    cleaned,mom0,mom0_err,noise = clean_cube.clean_tile(np.asarray(block,dtype=float),
+                                    filter_width=filter_width,ww=ww,**kwargs)
+    return(np.concatenate([cleaned,[mom0],[mom0_err],[noise]]))
+
+def clean_dask(cube,filter_width=7,ww=20,chunks=(16,16),**kwargs):
+    """
+    Lazily clean a cube and make moment maps with dask
+
+    cube is a dask array or anything dask.array.from_array
+    takes (e.g. a memory-mapped cube). It is rechunked to
+    hold the full spectral axis, with chunks giving the
+    spatial chunk shape for arrays that are not already
+    dask arrays. Keywords are as for clean_cube.clean_cube;
+    a 3-D line_mask is chunked like the cube.
+
+    Returns dask arrays for the cleaned cube and the mom0,
+    mom0 error and noise maps. Compute them together
+    (dask.compute) so that every chunk is cleaned once.
+    """
+    import dask.array as da
+    if "outdir" in kwargs:
+        raise ValueError("outdir plots cannot be made in parallel")
+    if isinstance(cube,da.Array):
+        cube = cube.rechunk({0:-1})
+    else:
+        cube = da.from_array(cube,chunks=(-1,)+tuple(chunks))
+    nout = clean_spectrum.output_length(cube.shape[0],filter_width,
+                                        kwargs.get("full_resolution",False))
+    out_chunks = ((nout+3,),)+cube.chunks[1:]
+    line_mask = kwargs.pop("line_mask",None)
+    if np.ndim(line_mask) == 3:
+        line_mask = da.from_array(np.asarray(line_mask),chunks=cube.chunks)
+        stacked = da.map_blocks(clean_block,cube,line_mask,chunks=out_chunks,dtype=float,
+                                filter_width=filter_width,ww=ww,**kwargs)
+    else:
+        stacked = da.map_blocks(clean_block,cube,chunks=out_chunks,dtype=float,
+                                filter_width=filter_width,ww=ww,line_mask=line_mask,
+                                **kwargs)
+    return(stacked[:nout],stacked[nout],stacked[nout+1],stacked[nout+2])
@@ -0,0 +1,214 @@
+"""
+Keep the memory use of cleaning many spectra under a cap.
+
+The peak memory for one spectrum is dominated by one of
+a few temporaries, depending on the settings:
+
+ * make_local_stddev takes np.std over rolling_window,
+   which makes an (n-2ww+1, 2ww) float temporary. This is
+   needed once for the detection (on the downsampled
+   spectrum) and once more in the moments (on the output,
+   which with full_resolution is the full spectrum with
+   ww scaled up by filter_width, so by far the largest).
+ * The spline fit needs the FITPACK workspace (about 16
+   floats per channel); the poly fit a Vandermonde matrix
+   and its least-squares copies for every order tried.
+ * The input spectrum, its median-filtered copy and the
+   output are alive throughout.
+
+Each worker also holds its batch of inputs and outputs,
+and the first spectrum cleaned in a process pays for the
+lazy imports (FIRST_CALL_BYTES).
+
+spectrum_peak_bytes adds these up, plan_batches uses it
+to pick the number of workers and the batch size, and
+iter_clean_capped runs the cleaning with that plan and
+reports the predicted and measured (tracemalloc) peak.
+The interpreter itself is not counted; give its size as
+worker_overhead to include it.
+"""
+import numpy as np
+import functools
+import itertools
+import os
+import tracemalloc
+import clean_cube
+import clean_spectrum
+
+FLOAT = np.dtype(float).itemsize
+FIXED_BYTES = 2**16 #Small arrays and Python objects per spectrum
+FIRST_CALL_BYTES = 2**21 #Lazy imports on the first spectrum cleaned in a process
+
+
+def local_stddev_floats(n,ww):
+    """
+    Floats of temporary space make_local_stddev needs for n channels
+    """
+    if np.iterable(ww):
+        return((4+len(ww))*n) #Cumulative sums (make_local_stddevs)
+    ww = int(ww)
+    return(max(n-2*ww+1,0)*2*ww+2*n)
+
+def fit_floats(n,basetype="spline"):
+    """
+    Floats of workspace the baseline fit needs for n channels
+
+    For a fallback cascade the largest of the basetypes counts.
+    """
+    if not isinstance(basetype,str):
+        return(max(fit_floats(n,bt) for bt in basetype))
+    if basetype == "spline":
+        return(16*n) #FITPACK curfit workspace and copies of x, y and w
+    if basetype == "poly":
+        return(14*n) #Vandermonde matrix (7 orders) and the lstsq copy
+    return(4*n)
+
+def spectrum_peak_bytes(nchan,filter_width=7,ww=20,basetype="spline",
+                        full_resolution=False):
+    """
+    Estimated peak memory (bytes) for cleaning one spectrum
+
+    Covers baseline_and_deglitch followed by the moment mask
+    (moments.identify_signal_estimate_noise), as in iter_clean.
+    """
+    n = clean_spectrum.output_length(nchan,filter_width)
+    nout = clean_spectrum.output_length(nchan,filter_width,full_resolution)
+    mom_ww = clean_spectrum.moment_settings(ww,filter_width,full_resolution)[0]
+    if np.iterable(mom_ww):
+        mom_ww = tuple(mom_ww)
+    always = 3*nchan + n + 2*nout
+    if full_resolution:
+        always += 2*nchan #Deglitched spectrum and upsampled baseline
+    largest = max(local_stddev_floats(n,ww),fit_floats(n,basetype),
+                  local_stddev_floats(nout,mom_ww))
+    return((always+largest)*FLOAT+FIXED_BYTES)
+
+def batch_row_bytes(nchan,filter_width=7,full_resolution=False):
+    """
+    Memory (bytes) per spectrum of a batch: input, output and signal mask
+    """
+    nout = clean_spectrum.output_length(nchan,filter_width,full_resolution)
+    return(2*nchan*FLOAT+nout*(FLOAT+1))
+
+def plan_batches(ram_cap,nchan,nspec=None,max_workers=None,max_batch=256,
+                 kind="process",worker_overhead=0,filter_width=7,ww=20,
+                 basetype="spline",full_resolution=False):
+    """
+    Pick the number of workers and batch size for a RAM cap
+
+    ram_cap (bytes) is shared by all workers. As many workers
+    as fit (up to max_workers, default the number of CPUs)
+    are used, then the batch size is made as large as fits
+    (up to max_batch). With kind="process" every batch in
+    flight is held both by its worker and the parent.
+
+    Returns a dict with "workers", "batch_size" and the
+    "per_spectrum" and total "predicted_peak" bytes.
+    Raises ValueError if one worker with one spectrum
+    does not fit.
+    """
+    per_spectrum = spectrum_peak_bytes(nchan,filter_width=filter_width,ww=ww,
+                                       basetype=basetype,full_resolution=full_resolution)
+    per_row = batch_row_bytes(nchan,filter_width,full_resolution)
+    if kind == "process":
+        per_row *= 2
+    def worker_bytes(batch_size):
+        return(worker_overhead+FIRST_CALL_BYTES+per_spectrum+batch_size*per_row)
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    if nspec is not None:
+        max_workers = max(min(max_workers,nspec),1)
+    workers = min(max_workers,int(ram_cap//worker_bytes(1)))
+    if workers < 1:
+        raise ValueError("ram_cap of %d bytes is below the %d bytes needed for one spectrum"
+                         % (ram_cap,worker_bytes(1)))
+    batch_size = int((ram_cap/workers-worker_bytes(0))//per_row)
+    batch_size = min(batch_size,max_batch)
+    if nspec is not None:
+        batch_size = min(batch_size,-(-nspec//workers))
+    batch_size = max(batch_size,1)
+    return({"workers":workers,"batch_size":batch_size,"per_spectrum":per_spectrum,
+            "predicted_peak":workers*worker_bytes(batch_size)})
+
+def clean_batch(batch,measure=False,**kwargs):
+    """
+    Clean a 2-D batch with iter_clean, optionally measuring the peak
+
+    Returns the list of iter_clean results and, with measure,
+    the peak bytes allocated (tracemalloc) plus the batch itself.
+    Only use measure when nothing else runs in this process
+    (it resets the tracemalloc peak).
+    """
+    if not measure:
+        return(list(clean_spectrum.iter_clean(batch,batch_size=len(batch),**kwargs)),None)
+    tracing = tracemalloc.is_tracing()
+    if not tracing:
+        tracemalloc.start()
+    tracemalloc.reset_peak()
+    start = tracemalloc.get_traced_memory()[0]
+    results = list(clean_spectrum.iter_clean(batch,batch_size=len(batch),**kwargs))
+    peak = tracemalloc.get_traced_memory()[1]-start+batch.nbytes
+    if not tracing:
+        tracemalloc.stop()
+    return(results,peak)
+
+def iter_clean_capped(spectra,ram_cap,kind="process",max_workers=None,
+                      worker_overhead=0,report=None,**kwargs):
+    """
+    Clean an iterable of spectra within a RAM cap (bytes)
+
+    Like clean_spectrum.iter_clean, but the batch size and
+    number of workers (a process or thread pool, see
+    clean_cube.make_executor) come from plan_batches.
+    Keywords are passed to iter_clean.
+
+    If report is a dict, the plan is stored in it and, at the
+    end, the "actual_peak" bytes. For threads (and one
+    worker) this is the tracemalloc peak of the whole run;
+    for processes it is the parent's peak plus the largest
+    batch peak of a worker for every worker, an upper bound
+    as the workers need not peak at the same time. Memory
+    is only traced (tracemalloc, which slows the cleaning
+    down) when report is given.
+    """
+    nspec = len(spectra) if isinstance(spectra,np.ndarray) and spectra.ndim == 2 else None
+    spectra = iter(spectra)
+    try:
+        first = np.asarray(next(spectra))
+    except StopIteration:
+        return
+    settings = dict((k,kwargs[k]) for k in ("filter_width","ww","basetype","full_resolution")
+                    if k in kwargs)
+    plan = plan_batches(ram_cap,first.shape[-1],nspec=nspec,max_workers=max_workers,
+                        kind=kind,worker_overhead=worker_overhead,**settings)
+    if report is not None:
+        report.update(plan)
+    workers = plan["workers"]
+    measure = report is not None
+    worker_measure = measure and workers > 1 and kind == "process"
+    executor = clean_cube.make_executor(workers,kind) if workers > 1 else None
+    work = functools.partial(clean_batch,measure=worker_measure,**kwargs)
+    batches = clean_spectrum.iter_batches(itertools.chain([first],spectra),plan["batch_size"])
+    tracing = tracemalloc.is_tracing()
+    if measure:
+        if not tracing:
+            tracemalloc.start()
+        tracemalloc.reset_peak()
+        start = tracemalloc.get_traced_memory()[0]
+    worker_peak = 0
+    try:
+        tasks = ({"batch":batch} for batch in batches)
+        for results,peak in clean_cube.run_tiles(work,tasks,executor=executor,
+                                                 max_in_flight=workers):
+            if peak is not None:
+                worker_peak = max(worker_peak,peak)
+            for result in results:
+                yield(result)
+        if report is not None:
+            report["actual_peak"] = (tracemalloc.get_traced_memory()[1]-start
+                                     +workers*worker_peak)
+    finally:
+        if measure and not tracing:
+            tracemalloc.stop()
+        if executor is not None:
+            executor.shutdown()
@@ -12,7 +12,7 @@ from scipy import ndimage
 import os,sys
 import matplotlib.pyplot as plt
 
-def identify_signal_estimate_noise(input_spectrum,do_expansion=True,ww=20,**kwargs):
+def identify_signal_estimate_noise(input_spectrum,do_expansion=True,ww=20,line_mask=None,**kwargs):
     """
     Use the local-standard-deviation to identify signal
     
@@ -24,11 +24,30 @@ def identify_signal_estimate_noise(input_spectrum,do_expansion=True,ww=20,**kwar
     in order to remove noise channels and to expand real
     signal channels down to a lower level. Generally this 
     should improve the fidelity of singal recovery.
+    
+    NaN channels (from partially blanked spectra) are
+    never included in the signal.
+    
+    If a prior line_mask (True where there are lines, with
+    one value per channel of input_spectrum) is given, the
+    y-array is skipped: the signal is the channels in 
+    line_mask and the noise is estimated from the rest.
     """
     old_mask = input_spectrum
-    y = clean_spectrum.make_local_stddev(input_spectrum,ww=ww)
-    k_est = np.median(y)
-    signal_spec = clean_spectrum.mask_spectrum(y,ww,input_spectrum,keep_signal=True)
+    bad = ~np.isfinite(input_spectrum)
+    if line_mask is not None:
+        signal_spec = ma.masked_where(~line_mask | bad,input_spectrum)
+        k_est = clean_spectrum.estimate_noise_line_free(input_spectrum,~line_mask & ~bad)
+        do_expansion = False
+    else:
+        if bad.any():
+            input_spectrum = np.where(bad,0.,input_spectrum)
+        y = clean_spectrum.make_local_stddev(input_spectrum,ww=ww)
+        if bad.any():
+            y = np.array(y,dtype=float)
+            y[...,bad] = np.median(y[...,~bad],axis=-1)[...,None]
+        k_est = np.median(y)
+        signal_spec = clean_spectrum.mask_spectrum(y,ww,input_spectrum,keep_signal=True)
     if do_expansion:
         if "outdir" in kwargs:
             old_mask = signal_spec.copy()
@@ -38,6 +57,8 @@ def identify_signal_estimate_noise(input_spectrum,do_expansion=True,ww=20,**kwar
         eroded_mask = ndimage.binary_erosion(basic_mask,structure=np.ones((3)))
         dilated_mask = ndimage.binary_dilation(eroded_mask,structure=np.ones((31)))
         signal_spec.mask = ~dilated_mask
+    if bad.any():
+        signal_spec[bad] = ma.masked
     if "outdir" in kwargs:
         try:
             os.mkdir(kwargs["outdir"])
@@ -73,6 +94,8 @@ def get_integrated_intensity(input_spectrum,noise_estimate,downsample_fact=1.):
                       units of channels).
     """
     mom0 = ma.sum(input_spectrum)
+    if mom0 is ma.masked: #No signal channels at all
+        mom0 = 0.
     num_channels = ma.count(input_spectrum)
     mom0_err = np.sqrt(num_channels)*noise_estimate
     return(mom0*downsample_fact,mom0_err*downsample_fact)
\ No newline at end of file
@@ -0,0 +1,240 @@
+"""
+Overlap reading, cleaning and writing of a cube.
+
+clean_cube reads a tile, cleans it and writes it back
+in turn, so a large memory-mapped cube is alternately
+waiting on the disk and on the CPU. Here the three
+stages run at the same time:
+
+ * a reader thread reads the next tiles into memory,
+ * the main thread hands them to the compute pool (or
+   cleans them itself) and collects the results in order,
+ * a writer thread copies the results into the output
+   cube and moment maps and flushes the output.
+
+The stages are joined by bounded queues, so a fast reader
+cannot run ahead and fill the memory. Their sizes come
+from memory_budget (see queue_sizes).
+"""
+import numpy as np
+import collections
+import functools
+import queue
+import threading
+import time
+import checkpoint
+import clean_cube
+import clean_spectrum
+import memory
+
+DONE = "done" #Marks the end of a queue
+
+
+def queue_sizes(memory_budget,tile_bytes,out_tile_bytes,workers=1,work_bytes=0):
+    """
+    Sizes of the read queue, the compute stage and the write queue
+
+    memory_budget (bytes) covers every tile held by the pipeline.
+    A tile being computed holds its input, its output and the
+    working memory (work_bytes) of its worker; one of each is
+    in flight per worker, more if the budget allows up to two
+    per worker. What is left is split between the read queue
+    (input tiles) and the write queue (output tiles). Every
+    stage gets at least one slot, even if that is over budget.
+
+    Returns (read_depth,in_flight,write_depth).
+    """
+    compute_bytes = tile_bytes+out_tile_bytes+work_bytes
+    in_flight = max(workers,min(2*workers,int(memory_budget//compute_bytes)))
+    left = max(memory_budget-in_flight*compute_bytes,0)
+    read_depth = max(1,int(left/2//tile_bytes))
+    write_depth = max(1,int(left/2//out_tile_bytes))
+    return(read_depth,in_flight,write_depth)
+
+def put(q,item,stop):
+    """
+    Put on a bounded queue, giving up if stop is set
+    """
+    while not stop.is_set():
+        try:
+            q.put(item,timeout=0.1)
+            return(True)
+        except queue.Full:
+            pass
+    return(False)
+
+def read_tiles(cube,tiles,line_mask,read_queue,stop,times):
+    """
+    Reader stage: read each tile (and its line mask) into memory
+    """
+    for ys,xs in tiles:
+        t0 = time.time()
+        data = np.array(cube[:,ys,xs])
+        tile_mask = line_mask[:,ys,xs] if np.ndim(line_mask) == 3 else line_mask
+        times["read"] += time.time()-t0
+        if not put(read_queue,(ys,xs,{"data":data,"line_mask":tile_mask}),stop):
+            return
+    put(read_queue,DONE,stop)
+
+def get(q,stop):
+    """
+    Get from a queue, giving None if stop is set first
+    """
+    while not stop.is_set():
+        try:
+            return(q.get(timeout=0.1))
+        except queue.Empty:
+            pass
+    return(None)
+
+def write_tiles(out,maps,write_queue,stop,times,progress=None,ck=None):
+    """
+    Writer stage: copy results into the output cube and maps
+
+    With a checkpoint.Checkpoint (ck) each tile is recorded.
+    """
+    while True:
+        item = get(write_queue,stop)
+        if item is None:
+            return
+        if item is DONE:
+            break
+        t0 = time.time()
+        ys,xs,result = item
+        out[:,ys,xs] = result[0]
+        for m,r in zip(maps,result[1:]):
+            m[ys,xs] = r
+        if ck is not None:
+            ck.record(ys,xs,out)
+        times["write"] += time.time()-t0
+        if progress is not None:
+            progress(result[1].size,times)
+    t0 = time.time()
+    if checkpoint.mapped_file(out) is not None:
+        checkpoint.mapped_file(out).flush()
+    times["write"] += time.time()-t0
+
+def run_stage(target,args,stop,errors):
+    """
+    Run a stage in a thread, keeping any exception for the main thread
+
+    An exception also sets stop, so the other stages give up.
+    """
+    def run():
+        try:
+            target(*args)
+        except BaseException as e:
+            errors.append(e)
+            stop.set()
+    thread = threading.Thread(target=run,daemon=True)
+    thread.start()
+    return(thread)
+
+def clean_cube_pipelined(cube,memory_budget=2**30,filter_width=7,ww=20,tile_shape=(16,16),
+                         out=None,executor=None,report=None,progress=None,
+                         checkpoint_dir=None,**kwargs):
+    """
+    clean_cube with the reading, cleaning and writing overlapped
+
+    Arguments and results are as for clean_cube.clean_cube,
+    and executor is again an optional thread or process pool.
+    memory_budget (bytes) sets the queue sizes (queue_sizes).
+    If report is a dict, the queue sizes, the seconds spent
+    in each stage ("read", "compute", "write") and the total
+    ("wall") are stored in it; with full overlap the wall
+    time approaches that of the slowest stage.
+    progress is an optional function that is called (from the
+    writer thread) after each tile is written, with the number
+    of spectra in the tile and the stage times so far. Tiles
+    skipped because they are finished in the checkpoint (see
+    clean_cube.clean_cube for checkpoint_dir) are passed to
+    it first, with None for the times.
+    """
+    if executor is not None and "outdir" in kwargs:
+        raise ValueError("outdir plots cannot be made in parallel")
+    start = time.time()
+    nchan,ny,nx = cube.shape
+    full_resolution = kwargs.get("full_resolution",False)
+    nout = clean_spectrum.output_length(nchan,filter_width,full_resolution)
+    if out is None:
+        out = np.empty((nout,ny,nx))
+    maps = [np.empty((ny,nx)) for i in range(3)]
+    line_mask = kwargs.pop("line_mask",None)
+    tiles = clean_cube.make_tiles(ny,nx,tile_shape)
+    ck = None
+    if checkpoint_dir is not None:
+        if checkpoint.mapped_file(out) is None:
+            raise ValueError("checkpoint_dir needs a memory-mapped out")
+        ck = checkpoint.Checkpoint(checkpoint_dir,checkpoint.param_hash(shape=cube.shape,
+                        tile_shape=tuple(tile_shape),filter_width=filter_width,ww=ww,
+                        line_mask=line_mask,**kwargs),ny,nx)
+        maps = list(ck.maps)
+        todo = []
+        for ys,xs in tiles:
+            if not ck.is_done(ys,xs,out):
+                todo.append((ys,xs))
+            elif progress is not None:
+                progress(ck.maps[0,ys,xs].size,None)
+        tiles = todo
+    npix = tile_shape[0]*tile_shape[1]
+    workers = getattr(executor,"_max_workers",1) if executor is not None else 1
+    work_bytes = memory.spectrum_peak_bytes(nchan,filter_width=filter_width,ww=ww,
+                                            basetype=kwargs.get("basetype","spline"),
+                                            full_resolution=full_resolution)
+    read_depth,in_flight,write_depth = queue_sizes(memory_budget,
+                                            npix*nchan*cube.dtype.itemsize,
+                                            npix*(nout+3)*out.dtype.itemsize,
+                                            workers,work_bytes)
+    times = {"read":0.,"compute":0.,"write":0.}
+    if report is not None:
+        report.update({"read_depth":read_depth,"in_flight":in_flight,
+                       "write_depth":write_depth})
+    read_queue = queue.Queue(maxsize=read_depth)
+    write_queue = queue.Queue(maxsize=write_depth)
+    stop = threading.Event()
+    errors = []
+    reader = run_stage(read_tiles,(cube,tiles,line_mask,read_queue,stop,times),stop,errors)
+    writer = run_stage(write_tiles,(out,maps,write_queue,stop,times,progress,ck),
+                       stop,errors)
+    work = functools.partial(clean_cube.clean_tile,filter_width=filter_width,ww=ww,**kwargs)
+    pending = collections.deque()
+    def finish_one():
+        ys,xs,result = pending.popleft()
+        if executor is not None:
+            result = result.result()
+        if not put(write_queue,(ys,xs,result),stop):
+            raise errors[0]
+    try:
+        while True:
+            item = get(read_queue,stop)
+            if item is None:
+                raise errors[0]
+            if item is DONE:
+                break
+            ys,xs,tile_kwargs = item
+            t0 = time.time()
+            if executor is None:
+                pending.append((ys,xs,work(**tile_kwargs)))
+            else:
+                pending.append((ys,xs,executor.submit(work,**tile_kwargs)))
+            if len(pending) >= in_flight:
+                finish_one()
+            times["compute"] += time.time()-t0
+        t0 = time.time()
+        while pending:
+            finish_one()
+        times["compute"] += time.time()-t0
+        put(write_queue,DONE,stop)
+        writer.join()
+        if errors:
+            raise errors[0]
+    finally:
+        stop.set()
+        reader.join()
+        writer.join()
+    if report is not None:
+        report.update(times)
+        report["wall"] = time.time()-start
+    if ck is not None:
+        maps = np.array(ck.maps)
+    return((out,)+tuple(maps))
@@ -0,0 +1,298 @@
+"""
+Warm local server for cleaning spectra interactively.
+
+Every short job otherwise pays for starting Python,
+importing SciPy and this package, and starting workers
+before the first spectrum is cleaned. make_server starts
+a worker pool once (and runs a small clean in each worker
+so that the lazy imports are done too), then serves
+requests on a Unix socket or a localhost TCP port. Client
+keeps a connection open, so reprocessing a region costs
+only the cleaning itself.
+
+Messages are framed in binary: a 12-byte prefix with the
+lengths of a JSON header (4 bytes) and of the payload (8
+bytes, so arrays over 4 GiB are fine), the header,
+and the payload with the raw bytes of the arrays listed
+in the header (dtype and shape of each). A request holds
+a spectrum (nchan), a batch of spectra (nspec,nchan) or a
+cube slice (nchan,ny,nx) and the keywords for
+clean_cube.clean_tile, plus an optional line_mask array.
+The reply holds the cleaned spectra and the mom0, mom0
+error and noise, shaped like the input.
+
+There is no authentication: use a Unix socket in a private
+directory or bind to localhost only.
+"""
+import json
+import socket
+import socketserver
+import struct
+import threading
+import numpy as np
+import clean_cube
+
+PREFIX = struct.Struct("!IQ") #Header and payload lengths
+MAX_HEADER = 2**20
+MAX_PAYLOAD = 2**36 #64 GiB
+
+
+def recv_exact(sock,nbytes):
+    """
+    Read exactly nbytes from a socket (None if it closes first)
+    """
+    buf = bytearray(nbytes)
+    view = memoryview(buf)
+    got = 0
+    while got < nbytes:
+        n = sock.recv_into(view[got:])
+        if n == 0:
+            return(None)
+        got += n
+    return(buf)
+
+def send_message(sock,header,arrays=()):
+    """
+    Send a JSON header and a list of arrays
+    """
+    arrays = [np.ascontiguousarray(a) for a in arrays]
+    header = dict(header,arrays=[[a.dtype.str,list(a.shape)] for a in arrays])
+    header_bytes = json.dumps(header).encode()
+    payload_len = sum(a.nbytes for a in arrays)
+    sock.sendall(PREFIX.pack(len(header_bytes),payload_len)+header_bytes)
+    for a in arrays:
+        sock.sendall(memoryview(a).cast("B"))
+
+def array_specs(arrays):
+    """
+    Check the [dtype,shape] list of a header, returning (dtype,shape,nbytes) for each
+
+    Raises ValueError if it is malformed.
+    """
+    specs = []
+    try:
+        for dtype,shape in arrays:
+            dtype = np.dtype(dtype)
+            shape = tuple(int(n) for n in shape)
+            if dtype.hasobject or dtype.itemsize == 0 or min(shape+(0,)) < 0:
+                raise ValueError("bad array %s %s" % (dtype,shape))
+            nbytes = dtype.itemsize
+            for n in shape:
+                nbytes *= n
+            specs.append((dtype,shape,nbytes))
+    except (TypeError,ValueError) as e:
+        raise ValueError("Malformed array list in message header: %s" % e)
+    return(specs)
+
+def recv_message(sock):
+    """
+    Receive a message, returning (header,arrays), or None at end of stream
+
+    Raises ConnectionError if the stream ends inside a message
+    and ValueError if it is malformed: the header must be a
+    JSON object whose arrays add up to the payload length, which
+    is at most MAX_PAYLOAD. The payload is only allocated once
+    that is checked.
+    """
+    prefix = recv_exact(sock,PREFIX.size)
+    if prefix is None:
+        return(None)
+    header_len,payload_len = PREFIX.unpack(prefix)
+    if header_len > MAX_HEADER:
+        raise ValueError("Message header too long")
+    header = recv_exact(sock,header_len)
+    if header is None:
+        raise ConnectionError("Connection closed in the middle of a message")
+    if payload_len > MAX_PAYLOAD:
+        raise ValueError("Message payload too long")
+    header = json.loads(bytes(header).decode())
+    if not isinstance(header,dict) or not isinstance(header.get("arrays"),list):
+        raise ValueError("Malformed message header")
+    specs = array_specs(header.pop("arrays"))
+    if sum(nbytes for dtype,shape,nbytes in specs) != payload_len:
+        raise ValueError("Payload length does not match the arrays in the header")
+    payload = recv_exact(sock,payload_len)
+    if payload is None:
+        raise ConnectionError("Connection closed in the middle of a message")
+    arrays = []
+    offset = 0
+    for dtype,shape,nbytes in specs:
+        a = np.frombuffer(payload,dtype=dtype,count=nbytes//dtype.itemsize,offset=offset)
+        arrays.append(a.reshape(shape))
+        offset += nbytes
+    return(header,arrays)
+
+def as_cube(data):
+    """
+    View a spectrum, batch of spectra or cube slice as a (nchan,ny,nx) cube
+    """
+    if data.ndim == 1:
+        return(data[:,None,None])
+    if data.ndim == 2:
+        return(data.T[:,:,None])
+    return(data)
+
+def from_cube(data,results):
+    """
+    Shape the results of clean_cube for the kind of input
+    """
+    if data.ndim == 1:
+        return([r[:,0,0] if r.ndim == 3 else r[0,0] for r in results])
+    if data.ndim == 2:
+        return([r[:,:,0].T if r.ndim == 3 else r[:,0] for r in results])
+    return(results)
+
+def warm_up():
+    """
+    Clean a small spectrum so imports and first-call costs are paid
+    """
+    np.random.seed(0)
+    clean_cube.clean_pixel(np.random.randn(1024))
+    return(True)
+
+
+class Handler(socketserver.BaseRequestHandler):
+    """
+    Answer requests on one connection until the client closes it
+    """
+
+    def handle(self):
+        while True:
+            try:
+                message = recv_message(self.request)
+            except OSError:
+                return
+            except ValueError as e:
+                #The stream cannot be trusted after this: reply and hang up
+                try:
+                    send_message(self.request,{"ok":False,"error":"ValueError: %s" % e})
+                except OSError:
+                    pass
+                return
+            if message is None:
+                return
+            header,arrays = message
+            try:
+                reply,out = self.server.process(header,arrays)
+                reply["ok"] = True
+            except Exception as e:
+                reply,out = {"ok":False,"error":"%s: %s" % (type(e).__name__,e)},[]
+            send_message(self.request,reply,out)
+
+
+class ServerMixin:
+    """
+    Worker pool and request processing shared by the Unix and TCP servers
+    """
+
+    def setup_pool(self,workers=None,kind="process"):
+        self.executor = clean_cube.make_executor(workers,kind)
+        num = getattr(self.executor,"_max_workers",1)
+        for f in [self.executor.submit(warm_up) for i in range(num)]:
+            f.result()
+
+    def process(self,header,arrays):
+        op = header.get("op")
+        if op == "ping":
+            return({},[])
+        if op != "clean":
+            raise ValueError("Unknown op: "+str(op))
+        kwargs = dict(header.get("params",{}))
+        tile_shape = tuple(kwargs.pop("tile_shape",(4,4)))
+        data = np.asarray(arrays[0],dtype=float)
+        if len(arrays) > 1:
+            mask = arrays[1]
+            kwargs["line_mask"] = as_cube(mask) if mask.ndim == data.ndim > 1 else mask
+        results = clean_cube.clean_cube(as_cube(data),tile_shape=tile_shape,
+                                        executor=self.executor,**kwargs)
+        return({},from_cube(data,results))
+
+    def server_close(self):
+        super().server_close()
+        self.executor.shutdown()
+
+
+class UnixServer(ServerMixin,socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+
+class TCPServer(ServerMixin,socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def make_server(address,workers=None,kind="process"):
+    """
+    Start the worker pool and bind the server (not yet serving)
+
+    address is a path for a Unix socket or a (host,port) tuple
+    for TCP (port 0 picks a free port; see server_address).
+    Call serve_forever on the result, and shutdown and
+    server_close to stop it.
+    """
+    if isinstance(address,str):
+        server = UnixServer(address,Handler)
+    else:
+        server = TCPServer(tuple(address),Handler)
+    server.setup_pool(workers,kind)
+    return(server)
+
+def start_server(address,workers=None,kind="process"):
+    """
+    make_server and serve from a background thread
+    """
+    server = make_server(address,workers,kind)
+    threading.Thread(target=server.serve_forever,daemon=True).start()
+    return(server)
+
+
+class Client:
+    """
+    Connection to a running server
+    """
+
+    def __init__(self,address):
+        if isinstance(address,str):
+            self.sock = socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+        else:
+            self.sock = socket.socket(socket.AF_INET,socket.SOCK_STREAM)
+            self.sock.setsockopt(socket.IPPROTO_TCP,socket.TCP_NODELAY,1)
+        self.sock.connect(address)
+
+    def request(self,header,arrays=()):
+        send_message(self.sock,header,arrays)
+        message = recv_message(self.sock)
+        if message is None:
+            raise ConnectionError("Server closed the connection")
+        reply,arrays = message
+        if not reply.pop("ok"):
+            raise RuntimeError(reply["error"])
+        return(reply,arrays)
+
+    def ping(self):
+        self.request({"op":"ping"})
+        return(True)
+
+    def clean(self,data,line_mask=None,**kwargs):
+        """
+        Clean a spectrum, batch of spectra or cube slice
+
+        Keywords are as for clean_cube.clean_cube (JSON
+        serializable), with tile_shape setting how the data
+        is split over the workers. Returns the cleaned data
+        and the mom0, mom0 error and noise, shaped like data.
+        """
+        arrays = [np.asarray(data)]
+        if line_mask is not None:
+            arrays.append(np.asarray(line_mask))
+        reply,results = self.request({"op":"clean","params":kwargs},arrays)
+        return(tuple(results))
+
+    def close(self):
+        self.sock.close()
+
+    def __enter__(self):
+        return(self)
+
+    def __exit__(self,*exc):
+        self.close()
@@ -0,0 +1,140 @@
+"""
+Share arrays with worker processes without pickling them.
+
+A SharedArray describes an array that lives either in a
+multiprocessing.shared_memory block or in a memory-mapped
+file. Only the description (name or filename, offset,
+shape and dtype) is pickled and sent to the workers, which
+open a view on the same memory and can read their input
+tile from it and write their results into it in place.
+"""
+import numpy as np
+import contextlib
+import mmap
+from multiprocessing import shared_memory
+import checkpoint
+
+
+def file_region(arr):
+    """
+    (filename,offset,shared) of the file an array is memory-mapped from, or None
+
+    Works for any C-contiguous array backed by an mmap (see
+    checkpoint.mapped_file), e.g. FITS data from astropy, which
+    is a plain ndarray on an mmap.mmap that does not record
+    its file. The file and the offset of the array in it are
+    looked up in /proc/self/maps (Linux only). shared is False
+    for a private (copy-on-write) mapping, whose changes do
+    not reach the file.
+    """
+    if checkpoint.mapped_file(arr) is None or not arr.flags.c_contiguous:
+        return(None)
+    start,stop = arr.ctypes.data,arr.ctypes.data+arr.nbytes
+    try:
+        with open("/proc/self/maps") as f:
+            lines = f.readlines()
+    except (IOError,OSError):
+        return(None)
+    for line in lines:
+        fields = line.rstrip("\n").split(None,5)
+        lo,hi = [int(v,16) for v in fields[0].split("-")]
+        if lo <= start and stop <= hi:
+            if len(fields) < 6 or not fields[5].startswith("/"):
+                return(None)
+            return(fields[5],int(fields[2],16)+start-lo,fields[1][3] == "s")
+    return(None)
+
+
+class SharedArray:
+    """
+    Picklable description of an array in shared memory or a file
+    """
+
+    def __init__(self,shape,dtype,name=None,filename=None,offset=0,mode='r+'):
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.name = name
+        self.filename = filename
+        self.offset = offset
+        self.mode = mode
+        self.shm = None #Only set in the process that owns the block
+
+    @classmethod
+    def create(cls,shape,dtype=float):
+        """
+        Allocate a new shared memory block (owned by this process)
+        """
+        nbytes = max(int(np.prod(shape))*np.dtype(dtype).itemsize,1)
+        shm = shared_memory.SharedMemory(create=True,size=nbytes)
+        shared = cls(shape,dtype,name=shm.name)
+        shared.shm = shm
+        return(shared)
+
+    @classmethod
+    def from_array(cls,arr,mode='r'):
+        """
+        Describe an existing array, copying it to shared memory if needed
+
+        C-contiguous np.memmap arrays are described by their
+        file and offset, so they are never copied, and so are
+        other memory-mapped arrays such as FITS data (see
+        file_region; for mode 'r+' the mapping must be shared).
+        Anything else is copied once into a new shared memory
+        block.
+        """
+        if isinstance(arr,np.memmap) and arr.flags.c_contiguous and arr.filename:
+            #Start of the mmap is the requested offset rounded down to the granularity
+            start = arr.offset - arr.offset % mmap.ALLOCATIONGRANULARITY
+            base = np.frombuffer(arr._mmap,dtype=np.uint8).ctypes.data
+            return(cls(arr.shape,arr.dtype,filename=arr.filename,
+                       offset=start+arr.ctypes.data-base,mode=mode))
+        region = file_region(arr)
+        if region is not None and (mode == 'r' or region[2]):
+            return(cls(arr.shape,arr.dtype,filename=region[0],offset=region[1],mode=mode))
+        shared = cls.create(arr.shape,arr.dtype)
+        with shared.open() as view:
+            view[...] = arr
+        return(shared)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['shm'] = None
+        return(state)
+
+    @contextlib.contextmanager
+    def open(self):
+        """
+        Context manager giving an ndarray view on the shared data
+        """
+        if self.filename is not None:
+            view = np.memmap(self.filename,dtype=self.dtype,mode=self.mode,
+                             offset=self.offset,shape=self.shape)
+            try:
+                yield(view)
+            finally:
+                if self.mode != 'r':
+                    view.flush()
+                del view
+            return
+        if self.shm is not None:
+            shm = self.shm
+        else:
+            #Workers share the owner's resource tracker, so attaching
+            #here does not add another unlink at exit
+            shm = shared_memory.SharedMemory(name=self.name)
+        view = np.ndarray(self.shape,dtype=self.dtype,buffer=shm.buf)
+        try:
+            yield(view)
+        finally:
+            del view
+            if shm is not self.shm:
+                shm.close()
+
+    def unlink(self):
+        """
+        Free a shared memory block made by create (owner only)
+        """
+        if self.shm is not None:
+            self.shm.close()
+            self.shm.unlink()
+            self.shm = None
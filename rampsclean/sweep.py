@@ -0,0 +1,67 @@
+"""
+Sweep the cleaning parameters over a grid.
+
+ww and stddevlev have to be tuned by looking at real
+data, which means running baseline_and_deglitch many
+times on the same spectrum. This module runs the
+whole grid of (ww, stddevlev, basetype) at once and
+shares the intermediate products:
+
+- the spectrum is median filtered and downsampled once
+- the y-arrays for all ww come from one set of
+  cumulative sums (make_local_stddevs)
+- parameter sets that give an identical mask share
+  the baseline fit and the moment calculation
+
+The result is a table (numpy structured array) with
+one row per parameter combination.
+"""
+import numpy as np
+import numpy.ma as ma
+import clean_spectrum
+import moments
+
+sweep_dtype = [('ww',int),('stddevlev',float),('basetype','U16'),
+               ('mask_id',int),('n_masked',int),
+               ('mom0',float),('mom0_err',float),('noise_estimate',float)]
+
+
+def sweep(spec,wws=(20,),stddevlevs=(3,),basetypes=("spline",),
+          filter_width=7,do_expansion=True):
+    """
+    Run baseline_and_deglitch and the mom0 calculation over a parameter grid
+
+    Returns a structured array with columns ww, stddevlev,
+    basetype, mask_id (equal ids mean an identical baseline
+    mask), n_masked (number of channels masked as signal),
+    mom0, mom0_err and noise_estimate. The same ww is used
+    for the baseline and the moment mask.
+    """
+    downsampled_spec = clean_spectrum.downsample_spectrum(spec,filter_width=filter_width)
+    ys = clean_spectrum.make_local_stddevs(downsampled_spec,wws)
+    mask_ids = {}
+    cleaned = {}
+    results = {}
+    rows = []
+    for ww,y in zip(wws,ys):
+        k_est = np.median(y)
+        for stddevlev in stddevlevs:
+            no_signal_spec = clean_spectrum.mask_spectrum(y,ww,downsampled_spec,
+                                    stddevlev=stddevlev,keep_signal=False)
+            mask = ma.getmaskarray(no_signal_spec)
+            mask_id = mask_ids.setdefault(mask.tobytes(),len(mask_ids))
+            for basetype in basetypes:
+                #Only the poly baseline depends on k_est (through the AIC)
+                key = (mask_id,basetype,k_est if basetype == "poly" else None)
+                if key not in cleaned:
+                    baseline = clean_spectrum.fit_baseline(no_signal_spec,k_est,basetype=basetype)
+                    cleaned[key] = downsampled_spec - baseline
+                rkey = key+(ww,)
+                if rkey not in results:
+                    signal_spec,noise_estimate = moments.identify_signal_estimate_noise(
+                                    cleaned[key],do_expansion=do_expansion,ww=ww)
+                    mom0,mom0_err = moments.get_integrated_intensity(
+                                    signal_spec,noise_estimate,downsample_fact=filter_width)
+                    results[rkey] = (mom0,mom0_err,noise_estimate)
+                rows.append((ww,stddevlev,basetype,mask_id,mask.sum())+results[rkey])
+    return(np.array(rows,dtype=sweep_dtype))
@@ -0,0 +1,195 @@
+"""
+Make a synthetic RAMPS-like data cube.
+
+The cube is built one spectrum at a time from
+SyntheticSpectrum and written straight to a
+memory-mapped .npy or FITS file, so that cubes
+larger than the available RAM can be made for
+testing the parallel and streaming parts of the
+pipeline. Only one row of spectra is held in
+memory at a time.
+
+The cube follows the FITS axis order as seen by
+numpy: (spectral, y, x). NH3 lines have a
+spatially varying amplitude (a Gaussian clump),
+position (a linear velocity gradient in x) and
+width (a linear gradient in y). Every pixel has
+its own baseline and spikes, and the map edges
+are blanked with NaNs like a real OTF map.
+"""
+import numpy as np
+import os,sys
+import synthetic_spectrum
+
+
+class SyntheticCube:
+    """
+    Class to make a synthetic cube.
+
+    Holds the map-level parameters and the noise-free
+    integrated intensity (mom0) of every pixel, which
+    is small enough to keep in memory even when the
+    cube itself is not.
+    """
+
+    def __init__(self,parameters=None,seed=None):
+        if not parameters:
+            self.p = {
+                "nx" : 32, #Map properties
+                "ny" : 32,
+                "nan_border" : 2,
+                "nan_jitter" : 2,
+                "spec_length" : 16384, #Spectrum properties
+                "noise_level" : 0.2, #Noise properties
+                "baseline_poly_order" : 2,  #Baseline properties
+                "baseline_poly_params" : np.array([-0.1,+1e-6,-5e-10,+1e-13]),
+                "baseline_scatter" : 0.2,
+                "do_random_baseline" : False,
+                "nh3_amplitude" : 3.0, #NH3 spectrum properties (peak of clump)
+                "nh3_width" : 50.,
+                "nh3_position" : 4000.,
+                "nh3_offset" : 300.,
+                "clump_size" : 0.25, #Fraction of the map size
+                "position_gradient" : 20., #Channels per pixel in x
+                "width_gradient" : 1., #Channels per pixel in y
+                "num_spikes" : 10,
+                "spikes_amp"  : 4.,
+            }
+        else:
+            self.p = parameters
+        if seed is not None:
+            np.random.seed(seed)
+        self.shape = (self.p['spec_length'],self.p['ny'],self.p['nx'])
+        self.blank = self.make_blank_map()
+        self.mom0 = np.zeros((self.p['ny'],self.p['nx']))
+
+    def make_blank_map(self):
+        """
+        Make the map of pixels that are NaN (outside the map)
+
+        Each row is blanked over a border of nan_border pixels
+        plus a random extra amount up to nan_jitter, which gives
+        ragged edges similar to the OTF maps.
+        """
+        ny,nx = self.p['ny'],self.p['nx']
+        border = self.p['nan_border']
+        blank = np.zeros((ny,nx),dtype=bool)
+        for iy in range(ny):
+            left = border + np.random.randint(0,self.p['nan_jitter']+1)
+            right = border + np.random.randint(0,self.p['nan_jitter']+1)
+            blank[iy,:left] = True
+            blank[iy,nx-right:] = True
+        blank[:border,:] = True
+        blank[ny-border:,:] = True
+        return(blank)
+
+    def pixel_parameters(self,ix,iy):
+        """
+        Parameters for the SyntheticSpectrum at pixel (ix,iy)
+        """
+        ny,nx = self.p['ny'],self.p['nx']
+        dx = ix - (nx-1)/2.
+        dy = iy - (ny-1)/2.
+        sigma = self.p['clump_size']*max(nx,ny)
+        p = dict(self.p)
+        p['nh3_amplitude'] = self.p['nh3_amplitude']*np.exp(-(dx**2+dy**2)/(2*sigma**2))
+        p['nh3_position'] = self.p['nh3_position'] + self.p['position_gradient']*dx
+        p['nh3_width'] = max(self.p['nh3_width'] + self.p['width_gradient']*dy,1.)
+        b = np.array(self.p['baseline_poly_params'],dtype=float)
+        p['baseline_poly_params'] = b*(1+self.p['baseline_scatter']*np.random.randn(b.size))
+        return(p)
+
+    def make_spectrum(self,ix,iy):
+        """
+        Make the spectrum at pixel (ix,iy) and record its true mom0
+        """
+        if self.blank[iy,ix]:
+            self.mom0[iy,ix] = np.nan
+            return(np.nan*np.ones(self.p['spec_length']))
+        a = synthetic_spectrum.SyntheticSpectrum(parameters=self.pixel_parameters(ix,iy))
+        spectrum = a.generate_spectrum()
+        self.mom0[iy,ix] = a.calculate_integrated_intensity()[0]
+        return(spectrum)
+
+    def write(self,filename,dtype=np.float32):
+        """
+        Write the cube to a memory-mapped .npy or FITS file.
+
+        The format is chosen from the file extension. The
+        cube is filled one row of spectra at a time and the
+        memory-mapped array is returned.
+        """
+        if filename.endswith(".npy"):
+            data = np.lib.format.open_memmap(filename,mode='w+',dtype=dtype,shape=self.shape)
+            hdul = None
+        elif filename.endswith((".fits",".fit",".fts")):
+            hdul = create_fits_memmap(filename,self.shape,dtype=dtype)
+            data = hdul[0].data
+        else:
+            raise ValueError("Unknown cube format for "+filename)
+        nx = self.p['nx']
+        for iy in range(self.p['ny']):
+            row = np.empty((self.p['spec_length'],nx),dtype=dtype)
+            for ix in range(nx):
+                row[:,ix] = self.make_spectrum(ix,iy)
+            data[:,iy,:] = row
+        if hdul is not None:
+            hdul.close()
+            return(open_cube(filename))
+        data.flush()
+        return(data)
+
+
+def create_fits_memmap(filename,shape,dtype=np.float32,header=None):
+    """
+    Create an empty FITS file of a given shape and open it memory-mapped
+
+    The file is created by writing the header and then
+    seeking to the end of the data, so the array never
+    has to exist in memory. The cards of header (e.g. the
+    WCS and BUNIT of an input cube), other than those that
+    describe the data array itself, are copied into it.
+    """
+    from astropy.io import fits
+    extra = header
+    bitpix = {np.dtype(np.float32):-32,np.dtype(np.float64):-64}[np.dtype(dtype)]
+    header = fits.Header()
+    header['SIMPLE'] = True
+    header['BITPIX'] = bitpix
+    header['NAXIS'] = len(shape)
+    for i,n in enumerate(shape[::-1]):
+        header['NAXIS'+str(i+1)] = n
+    header['EXTEND'] = True
+    if extra is not None:
+        header.extend(strip_header(extra))
+    header.tofile(filename,overwrite=True)
+    nbytes = int(np.prod(shape))*np.dtype(dtype).itemsize
+    nbytes = ((nbytes+2879)//2880)*2880 #FITS blocks are 2880 bytes
+    with open(filename,'rb+') as fobj:
+        fobj.seek(len(header.tostring())+nbytes-1)
+        fobj.write(b'\0')
+    return(fits.open(filename,mode='update',memmap=True))
+
+
+def strip_header(header):
+    """
+    Copy of a FITS header without the cards describing the data array
+
+    Scaling (BSCALE, BZERO, BLANK) and checksums are dropped
+    too, as they do not apply to the new data.
+    """
+    header = header.copy(strip=True)
+    for key in ("BSCALE","BZERO","BLANK","CHECKSUM","DATASUM"):
+        header.remove(key,ignore_missing=True,remove_all=True)
+    return(header)
+
+
+def open_cube(filename,mode='r'):
+    """
+    Open a .npy or FITS cube memory-mapped
+    """
+    if filename.endswith(".npy"):
+        return(np.load(filename,mmap_mode=mode))
+    from astropy.io import fits
+    fmode = {'r':'readonly','r+':'update'}[mode]
+    return(fits.open(filename,mode=fmode,memmap=True)[0].data)
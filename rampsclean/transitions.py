@@ -0,0 +1,154 @@
+"""
+Clean several transitions observed towards one pixel.
+
+RAMPS observes several transitions (NH3 (1,1), (2,2),
+etc.) per pixel in separate spectral windows. The
+signal comes from the same gas, so the line velocities
+are shared. Instead of running the full detection on
+every window, the signal mask of the reference (the
+strongest transition, normally NH3 (1,1)) is mapped in
+velocity onto the other windows and used as their prior
+line mask. This saves the detection work for the weaker
+windows and gives them better masks at low SNR than
+they would get on their own.
+
+Windows of equal length are median filtered and
+downsampled together in one pass. The downsampled spectra
+and y-arrays are kept in a cache.MemoryCache (or the
+cache given) and passed on to baseline_and_deglitch, so
+every window is still cleaned with all of its options
+(NaN channels, spur_channels and spike_threshold,
+full_resolution, ...) without downsampling it again.
+"""
+import numpy as np
+import numpy.ma as ma
+import scipy.ndimage as im
+import cache
+import clean_cube
+import clean_spectrum
+
+
+def map_mask(mask,velocity,new_velocity):
+    """
+    Map a channel mask onto another velocity axis
+
+    Channels of new_velocity are set where the nearest part of
+    the original axis is set; outside it they are not set.
+    """
+    order = np.argsort(velocity)
+    frac = np.interp(new_velocity,velocity[order],mask[order].astype(float),left=0,right=0)
+    return(frac >= 0.5)
+
+def downsample_windows(spectra,filter_width=7,store=None,spur_channels=None,
+                       spike_threshold=None):
+    """
+    Median filter and downsample a list of spectra
+
+    Equal-length spectra are stacked and filtered in
+    one call (a 1-D filter along the spectral axis).
+    With spur_channels or spike_threshold each one goes
+    through downsample_spectrum instead. If store (a
+    cache.DiskCache or MemoryCache) is given, the results
+    are put in it under the keys baseline_and_deglitch
+    looks up.
+    """
+    if spur_channels is not None:
+        spur_channels = tuple(int(c) for c in spur_channels) #Same key as baseline_and_deglitch
+    params = dict(filter_width=filter_width,spur_channels=spur_channels,
+                  spike_threshold=spike_threshold)
+    if (spur_channels is None and spike_threshold is None and
+        len(set(len(s) for s in spectra)) == 1):
+        stack = im.median_filter(np.asarray(spectra),size=(1,filter_width))
+        downsampled = list(stack[:,::filter_width])
+        if store is not None:
+            for spec,ds in zip(spectra,downsampled):
+                store.put(store.make_key(spec,"downsample",**params),ds)
+        return(downsampled)
+    if store is None:
+        return([clean_spectrum.downsample_spectrum(s,**params) for s in spectra])
+    return([store.cached(clean_spectrum.downsample_spectrum,s,"downsample",**params)
+            for s in spectra])
+
+def line_contrast(y):
+    """
+    Peak over median of a y-array (see make_local_stddev)
+
+    The local standard deviation rises above the noise level
+    on a line in proportion to its amplitude, so this is a
+    cheap stand-in for the peak signal-to-noise ratio.
+    """
+    return(np.max(y/np.median(y,axis=-1)[...,None]))
+
+def clean_transitions(spectra,velocities,reference=None,filter_width=7,ww=20,
+                      basetype="spline",stddevlev=3,**kwargs):
+    """
+    Clean all spectral windows of a pixel together
+
+    spectra and velocities are lists with one spectrum and its
+    velocity axis per window. Window `reference` goes through
+    the normal detection; its (expanded) moment signal mask is
+    mapped onto the velocity axes of the other windows and used
+    as their line_mask for both the baseline and the moment.
+    By default the reference is the window with the highest
+    line_contrast. If the reference is blank, every window gets
+    the normal detection. Keywords go to baseline_and_deglitch.
+
+    Returns the list of cleaned spectra and arrays with mom0,
+    its error and the noise estimate per window.
+    """
+    spectra = [np.asarray(s,dtype=float) for s in spectra]
+    kwargs.update(filter_width=filter_width,ww=ww,basetype=basetype,stddevlev=stddevlev)
+    if kwargs.get("cache") is None:
+        kwargs["cache"] = cache.MemoryCache()
+    store = kwargs["cache"]
+    full_resolution = kwargs.get("full_resolution",False)
+    nwin = len(spectra)
+
+    #Shared decimation pass, on the NaN-filled spectra as in baseline_and_deglitch
+    usable = np.flatnonzero([clean_spectrum.prescreen_spectra(s) >= clean_spectrum.PARTIAL_NAN
+                             for s in spectra])
+    filled = []
+    for i in usable:
+        good = np.isfinite(spectra[i])
+        filled.append(np.interp(np.arange(good.size),np.flatnonzero(good),spectra[i][good]))
+    downsampled = downsample_windows(filled,filter_width=filter_width,store=store,
+                                     spur_channels=kwargs.get("spur_channels"),
+                                     spike_threshold=kwargs.get("spike_threshold"))
+    if reference is None:
+        contrast = np.full(nwin,-np.inf)
+        for i,ds in zip(usable,downsampled):
+            y = store.cached(clean_spectrum.make_local_stddev,ds,"local_stddev",ww=ww)
+            bad = clean_spectrum.downsample_mask(np.isnan(spectra[i]),filter_width)
+            contrast[i] = line_contrast(y[...,~bad])
+        reference = int(np.argmax(contrast))
+    cleaned = [None]*nwin
+    mom0 = np.zeros(nwin)
+    mom0_err = np.zeros(nwin)
+    noise = np.zeros(nwin)
+
+    #Full detection on the reference window
+    ref = spectra[reference]
+    ref_mask = None
+    if clean_spectrum.prescreen_spectra(ref) < clean_spectrum.PARTIAL_NAN:
+        cleaned[reference],mom0[reference],mom0_err[reference],noise[reference] = \
+                                    clean_cube.clean_pixel(ref,**kwargs)
+    else:
+        cleaned[reference] = clean_spectrum.baseline_and_deglitch(ref,**kwargs)
+        signal_spec,mom0[reference],mom0_err[reference],noise[reference] = \
+                    clean_cube.pixel_moments(cleaned[reference],filter_width=filter_width,
+                                             ww=ww,full_resolution=full_resolution)
+        ref_mask = ~ma.getmaskarray(signal_spec)
+        ref_velocity = np.asarray(velocities[reference])
+        if not full_resolution:
+            ref_velocity = ref_velocity[::filter_width]
+
+    #Prior mask for everything else
+    for i in range(nwin):
+        if i == reference:
+            continue
+        line_mask = None
+        if ref_mask is not None:
+            line_mask = map_mask(ref_mask,ref_velocity,np.asarray(velocities[i]))
+        cleaned[i],mom0[i],mom0_err[i],noise[i] = clean_cube.clean_pixel(spectra[i],
+                                    line_mask=line_mask,**kwargs)
+    return(cleaned,mom0,mom0_err,noise)
@@ -0,0 +1,249 @@
+"""
+Clean a cube on several nodes that only share a filesystem.
+
+Static sharding (cli --shard) gives every node the same
+number of tiles, so the run takes as long as the node that
+got the most expensive tiles (or is the slowest). Here the
+nodes pull tiles from a queue instead, one at a time, so
+fast nodes and cheap tiles simply lead to more tiles taken.
+
+The queue is a directory made by create_queue:
+
+    job.json        the cube, tile shape and cleaning keywords
+    line_mask.npy   the line mask, if one was given
+    claims/<i>.lock one per tile being (or done) cleaned
+    results/<i>.npz the cleaned tile and its maps
+
+A tile is claimed by creating its lock file, holding a
+token unique to this claim (host, pid and a random id),
+with a hard link, which succeeds for exactly one worker.
+Results are written to a temporary file and renamed, so
+they appear atomically. A lock older than lease seconds
+without a result is taken to belong to a dead worker: it
+is renamed away (again only one worker succeeds) and the
+tile is claimed again. Between reading a lock and renaming
+it, another worker may have replaced it with a fresh one,
+so the token of the renamed lock is checked and a lock
+that turns out not to be the stale one is put back (see
+take_lock). A worker that gives up on a tile releases its
+lock the same way, so it never removes someone else's.
+
+Start run_worker on every node (python workqueue.py DIR)
+and assemble on one of them to collect the results into
+the final cube and maps. assemble also cleans tiles itself
+while it waits, so it finishes even if every node dies.
+"""
+import os,sys
+#The modules import each other directly. Append (not prepend) so they never
+#shadow installed modules of the same name in a process that imports this one
+if os.path.dirname(os.path.abspath(__file__)) not in sys.path:
+    sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+import json
+import socket
+import tempfile
+import time
+import uuid
+import numpy as np
+import clean_cube
+import clean_spectrum
+import synthetic_cube
+
+
+def create_queue(directory,cube_filename,tile_shape=(16,16),**kwargs):
+    """
+    Make the queue directory for cleaning a .npy or FITS cube
+
+    Keywords are passed to clean_cube.clean_tile and must be
+    JSON serializable, except line_mask, which is saved as .npy.
+    """
+    for sub in ("claims","results"):
+        try:
+            os.makedirs(os.path.join(directory,sub))
+        except OSError:
+            pass
+    line_mask = kwargs.pop("line_mask",None)
+    if line_mask is not None:
+        np.save(os.path.join(directory,"line_mask.npy"),line_mask)
+    shape = synthetic_cube.open_cube(cube_filename).shape
+    job = {"cube":os.path.abspath(cube_filename),"shape":list(shape),
+           "tile_shape":list(tile_shape),"kwargs":kwargs}
+    write_atomic(os.path.join(directory,"job.json"),json.dumps(job).encode())
+
+def write_atomic(filename,data):
+    """
+    Write bytes to a file so that it appears all at once
+    """
+    fd,tmpname = tempfile.mkstemp(dir=os.path.dirname(filename),suffix=".tmp")
+    with os.fdopen(fd,'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmpname,filename)
+
+def read_job(directory):
+    """
+    The job description, its tiles and its cleaning keywords
+    """
+    with open(os.path.join(directory,"job.json")) as f:
+        job = json.load(f)
+    nchan,ny,nx = job["shape"]
+    tiles = clean_cube.make_tiles(ny,nx,tuple(job["tile_shape"]))
+    kwargs = job["kwargs"]
+    line_mask_file = os.path.join(directory,"line_mask.npy")
+    if os.path.exists(line_mask_file):
+        kwargs["line_mask"] = np.load(line_mask_file)
+    return(job,tiles,kwargs)
+
+def lock_path(directory,i):
+    return(os.path.join(directory,"claims","%d.lock" % i))
+
+def result_path(directory,i):
+    return(os.path.join(directory,"results","%d.npz" % i))
+
+def read_token(filename):
+    """
+    The token in a lock file, or None if it is gone
+    """
+    try:
+        with open(filename) as f:
+            return(f.read())
+    except (IOError,OSError):
+        return(None)
+
+def take_lock(lock,token):
+    """
+    Move a lock out of the way if it still holds token
+
+    Returns the name it was moved to (for the caller to
+    remove), or None if the lock is gone or holds another
+    token, in which case it is put back (unless yet another
+    lock has been created in the meantime).
+    """
+    taken = "%s.taken.%s" % (lock,uuid.uuid4().hex)
+    try:
+        os.rename(lock,taken)
+    except OSError:
+        return(None)
+    if read_token(taken) == token:
+        return(taken)
+    try: #Not the lock we meant: put it back, never over a newer one
+        os.link(taken,lock)
+    except OSError:
+        pass
+    os.remove(taken)
+    return(None)
+
+def claim(directory,i,lease=3600.):
+    """
+    Try to claim tile i
+
+    Returns the token written to the lock if this worker got
+    the tile (pass it to release), or None.
+    """
+    lock = lock_path(directory,i)
+    token = "%s %d %s\n" % (socket.gethostname(),os.getpid(),uuid.uuid4().hex)
+    #The lock is linked into place with its token, so it is never seen empty
+    tmpname = "%s.%s.tmp" % (lock,uuid.uuid4().hex)
+    with open(tmpname,'w') as f:
+        f.write(token)
+    try:
+        for attempt in range(2):
+            try:
+                os.link(tmpname,lock)
+                return(token)
+            except FileExistsError:
+                pass
+            old_token = read_token(lock)
+            try:
+                age = time.time()-os.path.getmtime(lock)
+            except OSError: #Just broken by another worker
+                continue
+            if old_token is None or age < lease or os.path.exists(result_path(directory,i)):
+                return(None)
+            taken = take_lock(lock,old_token) #Break the stale lock
+            if taken is None:
+                return(None)
+            os.remove(taken)
+        return(None)
+    finally:
+        os.remove(tmpname)
+
+def release(directory,i,token):
+    """
+    Remove the lock of tile i if it is still ours, so another worker can take it
+    """
+    taken = take_lock(lock_path(directory,i),token)
+    if taken is not None:
+        os.remove(taken)
+
+def run_worker(directory,lease=3600.,max_tiles=None):
+    """
+    Clean unclaimed tiles of a queue until none are left
+
+    Returns the number of tiles this worker cleaned.
+    """
+    job,tiles,kwargs = read_job(directory)
+    cube = synthetic_cube.open_cube(job["cube"])
+    line_mask = kwargs.pop("line_mask",None)
+    done = 0
+    for i,(ys,xs) in enumerate(tiles):
+        if max_tiles is not None and done >= max_tiles:
+            break
+        if os.path.exists(result_path(directory,i)):
+            continue
+        token = claim(directory,i,lease)
+        if token is None:
+            continue
+        try:
+            tile_mask = line_mask[:,ys,xs] if np.ndim(line_mask) == 3 else line_mask
+            cleaned,mom0,mom0_err,noise = clean_cube.clean_tile(np.asarray(cube[:,ys,xs]),
+                                                    line_mask=tile_mask,**kwargs)
+        except BaseException:
+            release(directory,i,token) #Let another worker try
+            raise
+        fd,tmpname = tempfile.mkstemp(dir=os.path.join(directory,"results"),suffix=".tmp")
+        with os.fdopen(fd,'wb') as f:
+            np.savez(f,cleaned=cleaned,maps=np.array([mom0,mom0_err,noise]))
+        os.replace(tmpname,result_path(directory,i))
+        done += 1
+    return(done)
+
+def assemble(directory,out=None,timeout=None,poll=1.0,lease=3600.,work=True):
+    """
+    Collect the results of a queue into the cleaned cube and maps
+
+    Waits until every tile has a result. With work=True this
+    process also cleans unclaimed (or stale) tiles while it
+    waits. out is an optional array for the cleaned cube, as
+    in clean_cube.clean_cube. Raises RuntimeError if the
+    results are not all there after timeout seconds.
+    """
+    job,tiles,kwargs = read_job(directory)
+    nchan,ny,nx = job["shape"]
+    nout = clean_spectrum.output_length(nchan,kwargs.get("filter_width",7),
+                                        kwargs.get("full_resolution",False))
+    if out is None:
+        out = np.empty((nout,ny,nx))
+    maps = np.empty((3,ny,nx))
+    todo = set(range(len(tiles)))
+    start = time.time()
+    while todo:
+        for i in sorted(todo):
+            if os.path.exists(result_path(directory,i)):
+                ys,xs = tiles[i]
+                with np.load(result_path(directory,i)) as result:
+                    out[:,ys,xs] = result["cleaned"]
+                    maps[:,ys,xs] = result["maps"]
+                todo.discard(i)
+        if not todo:
+            break
+        if work and run_worker(directory,lease=lease,max_tiles=1):
+            continue
+        if timeout is not None and time.time()-start > timeout:
+            raise RuntimeError("%d tiles still missing after %g s" % (len(todo),timeout))
+        time.sleep(poll)
+    return(out,maps[0],maps[1],maps[2])
+
+if __name__ == "__main__":
+    #Run a worker on this node: python workqueue.py QUEUE_DIR
+    print(run_worker(sys.argv[1]))
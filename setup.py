@@ -1,10 +1,7 @@
 #!/usr/bin/env python
 
-import sys
-if 'build_sphinx' in sys.argv or 'develop' in sys.argv:
-    from setuptools import setup, Command
-else:
-    from distutils.core import setup, Command
+import os,sys
+from setuptools import setup, Command
 
 with open('README.md') as file:
     long_description = file.read()
@@ -21,8 +18,11 @@ class PyTest(Command):
     def finalize_options(self):
         pass
     def run(self):
-        import sys,subprocess
-        errno = subprocess.call([sys.executable, 'runtests.py'])
+        import subprocess
+        #The modules import each other directly, so they need to be on the path
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join(['rampsclean','.',env.get('PYTHONPATH','')])
+        errno = subprocess.call([sys.executable, '-m', 'pytest', 'tests'], env=env)
         raise SystemExit(errno)
 
 
@@ -34,5 +34,7 @@ setup(name='rampsclean',
       author_email='jonathan.b.foster@yale.edu',
       url='https://github.com/jfoster17/rampsclean',
       packages=['rampsclean',],
+      entry_points={'console_scripts': ['rampsclean = rampsclean.cli:main']},
+      extras_require={'dask': ['dask[array]']},
       cmdclass = {'test': PyTest},
      )
\ No newline at end of file
@@ -0,0 +1,43 @@
+import rampsclean.synthetic_spectrum as snythetic_spectrum
+import rampsclean.accumulate as accumulate
+import numpy as np
+import pytest
+
+def test_incremental_map():
+    np.random.seed(8)
+    parameters = {
+        "spec_length" : 16384, #Spectrum properties
+        "noise_level" : 0.80, #Noise properties
+        "baseline_poly_order" : 2,  #Baseline properties
+        "baseline_poly_params" : np.array([-0.1,+1e-6,-5e-10,+1e-13]),
+        "do_random_baseline" : False,
+        "nh3_amplitude" : 1.0, #NH3 spectrum properties
+        "nh3_width" : 50.,
+        "nh3_position" : 4000.,
+        "nh3_offset" : 300.,
+        "num_spikes" : 10,
+        "spikes_amp"  : 4.,
+    }
+    quick_look = accumulate.IncrementalMap(2,3)
+    for i in range(20):
+        a = snythetic_spectrum.SyntheticSpectrum(parameters=parameters)
+        quick_look.add(1,2,a.generate_spectrum())
+    noise_free_mom0,noise_free_mom0_err = a.calculate_integrated_intensity()
+    mom0,mom0_err,noise = quick_look.maps()
+    assert np.isnan(mom0[0,0])
+    assert abs(mom0[1,2]-noise_free_mom0) < 5*mom0_err[1,2]
+    pixel = quick_look.pixels[(1,2)]
+    assert pixel.count == 20
+    assert pixel.num_cleans < pixel.count
+
+def test_blank_integration_skipped():
+    np.random.seed(3)
+    pixel = accumulate.IncrementalSpectrum()
+    pixel.add(0.3*np.random.randn(16384))
+    assert not pixel.add(np.zeros(16384))
+    assert not pixel.add(np.full(16384,np.nan))
+    pixel.add(0.3*np.random.randn(16384))
+    assert pixel.count == 2
+    assert np.isfinite(pixel.mom0)
+    with pytest.raises(ValueError):
+        pixel.add(0.3*np.random.randn(16384),weight=np.inf)
@@ -0,0 +1,43 @@
+import rampsclean.async_clean as async_clean
+import rampsclean.clean_cube as clean_cube
+import numpy as np
+import asyncio
+
+def make_spectra(n):
+    np.random.seed(4)
+    x = np.arange(16384)
+    line = 3.0*np.exp(-(x-4000.)**2/(2*50.**2))
+    return([0.2*np.random.randn(16384)+line+1e-5*x for i in range(n)])
+
+def test_clean_many_in_order():
+    spectra = make_spectra(6)
+    spectra[2] = np.nan*spectra[2]
+    async def main():
+        ticks = []
+        async def ticker():
+            while True:
+                ticks.append(1)
+                await asyncio.sleep(0)
+        tick_task = asyncio.ensure_future(ticker())
+        results = await async_clean.clean_many(iter(spectra),max_in_flight=2)
+        tick_task.cancel()
+        return(results,len(ticks))
+    results,num_ticks = asyncio.run(main())
+    assert num_ticks > len(spectra) #The event loop kept running
+    assert len(results) == 6
+    for spec,result in zip(spectra,results):
+        expected = clean_cube.clean_pixel(spec)
+        assert np.allclose(result[0],expected[0],equal_nan=True)
+        assert np.allclose(result[1:],expected[1:],equal_nan=True)
+
+def test_clean_many_cancel():
+    async def main():
+        task = asyncio.ensure_future(async_clean.clean_many(make_spectra(50),max_in_flight=2))
+        await asyncio.sleep(0.01)
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            return(True)
+        return(False)
+    assert asyncio.run(main())
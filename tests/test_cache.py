@@ -0,0 +1,24 @@
+import rampsclean.cache as cache
+import rampsclean.clean_spectrum as clean_spectrum
+import numpy as np
+import os
+
+def test_cached_baseline_matches(tmpdir):
+    np.random.seed(2)
+    spec = np.random.randn(4096) + np.linspace(0,1,4096)
+    c = cache.DiskCache(str(tmpdir))
+    direct = clean_spectrum.baseline_and_deglitch(spec,basetype="spline")
+    first = clean_spectrum.baseline_and_deglitch(spec,basetype="spline",cache=c)
+    assert len(os.listdir(str(tmpdir))) == 2
+    second = clean_spectrum.baseline_and_deglitch(spec,basetype="smoothed_data",cache=c)
+    assert len(os.listdir(str(tmpdir))) == 2
+    assert np.allclose(direct,first)
+    assert second.shape == first.shape
+
+def test_cache_eviction(tmpdir):
+    c = cache.DiskCache(str(tmpdir),max_bytes=3000)
+    for i in range(5):
+        c.put(str(i),np.zeros(100)+i)
+    assert c.size <= 3000
+    assert c.get("0") is None
+    assert np.all(c.get("4") == 4)
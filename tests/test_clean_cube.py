@@ -0,0 +1,187 @@
+import rampsclean.synthetic_cube as synthetic_cube
+import rampsclean.clean_cube as clean_cube
+import rampsclean.pipeline as pipeline
+import numpy as np
+import json
+import os
+import pytest
+import time
+
+def make_cube(tmpdir):
+    parameters = {
+        "nx" : 8, #Map properties
+        "ny" : 6,
+        "nan_border" : 1,
+        "nan_jitter" : 1,
+        "spec_length" : 16384, #Spectrum properties
+        "noise_level" : 0.2, #Noise properties
+        "baseline_poly_order" : 2,  #Baseline properties
+        "baseline_poly_params" : np.array([-0.1,+1e-6,-5e-10,+1e-13]),
+        "baseline_scatter" : 0.2,
+        "do_random_baseline" : False,
+        "nh3_amplitude" : 3.0, #NH3 spectrum properties
+        "nh3_width" : 50.,
+        "nh3_position" : 4000.,
+        "nh3_offset" : 300.,
+        "clump_size" : 0.5,
+        "position_gradient" : 20.,
+        "width_gradient" : 1.,
+        "num_spikes" : 10,
+        "spikes_amp"  : 4.,
+    }
+    a = synthetic_cube.SyntheticCube(parameters=parameters,seed=3)
+    cube = a.write(str(tmpdir.join("cube.npy")))
+    return(a,cube)
+
+def test_clean_cube(tmpdir):
+    a,cube = make_cube(tmpdir)
+    cleaned,mom0,mom0_err,noise = clean_cube.clean_cube(cube,tile_shape=(4,5))
+    assert cleaned.shape == (len(range(0,16384,7)),6,8)
+    assert np.all(np.isnan(mom0[a.blank]))
+    good = ~a.blank
+    assert np.median(np.abs(mom0[good]-a.mom0[good])/mom0_err[good]) < 3
+
+def test_warm_start_matches_cold(tmpdir):
+    a,cube = make_cube(tmpdir)
+    for basetype in ("spline","poly"):
+        cold = clean_cube.clean_cube(cube,tile_shape=(4,5),basetype=basetype)
+        warm = clean_cube.clean_cube(cube,tile_shape=(4,5),basetype=basetype,warm_start=True)
+        good = ~a.blank
+        assert np.all(np.abs(warm[1][good]-cold[1][good]) <= cold[2][good])
+
+def test_clean_cube_executors(tmpdir):
+    a,cube = make_cube(tmpdir)
+    serial = clean_cube.clean_cube(cube,tile_shape=(2,3))
+    for kind in ("thread","process"):
+        with clean_cube.make_executor(2,kind) as executor:
+            parallel = clean_cube.clean_cube(cube,tile_shape=(2,3),executor=executor)
+        for s,p in zip(serial,parallel):
+            assert np.allclose(s,p,equal_nan=True)
+
+def test_clean_cube_shared(tmpdir):
+    a,cube = make_cube(tmpdir)
+    serial = clean_cube.clean_cube(cube,tile_shape=(2,3))
+    out = np.lib.format.open_memmap(str(tmpdir.join("out.npy")),mode='w+',
+                                    shape=serial[0].shape)
+    from astropy.io import fits
+    fits.PrimaryHDU(np.array(cube)).writeto(str(tmpdir.join("cube.fits")))
+    fits_cube = synthetic_cube.open_cube(str(tmpdir.join("cube.fits")))
+    #FITS data is used in place from its file, not copied to shared memory
+    assert clean_cube.shared.SharedArray.from_array(fits_cube).filename == str(tmpdir.join("cube.fits"))
+    with clean_cube.make_executor(2,"process") as executor:
+        for data,o in ((cube,None),(np.array(cube),None),(cube,out),(fits_cube,None)):
+            shared = clean_cube.clean_cube(data,tile_shape=(2,3),executor=executor,
+                                           shared_memory=True,out=o)
+            for s,p in zip(serial,shared):
+                assert np.allclose(s,p,equal_nan=True)
+    assert np.allclose(np.load(str(tmpdir.join("out.npy"))),serial[0],equal_nan=True)
+
+class SlowCube:
+    """
+    A cube that takes a while to read, like one on a slow disk
+    """
+    def __init__(self,cube,delay=0.05,fail=False):
+        self.cube = cube
+        self.shape = cube.shape
+        self.dtype = cube.dtype
+        self.delay = delay
+        self.fail = fail
+
+    def __getitem__(self,key):
+        time.sleep(self.delay)
+        if self.fail:
+            raise IOError("read failed")
+        return(self.cube[key])
+
+def test_pipelined(tmpdir):
+    a,cube = make_cube(tmpdir)
+    serial = clean_cube.clean_cube(cube,tile_shape=(2,4))
+    out = np.lib.format.open_memmap(str(tmpdir.join("out.npy")),mode='w+',
+                                    shape=serial[0].shape)
+    report = {}
+    piped = pipeline.clean_cube_pipelined(SlowCube(cube),tile_shape=(2,4),out=out,
+                                          report=report)
+    for s,p in zip(serial,piped):
+        assert np.allclose(s,p,equal_nan=True)
+    assert np.allclose(np.load(str(tmpdir.join("out.npy"))),serial[0],equal_nan=True)
+    #Reading overlapped with cleaning
+    assert report["wall"] < report["read"]+report["compute"]
+    with clean_cube.make_executor(2,"thread") as executor:
+        piped = pipeline.clean_cube_pipelined(cube,tile_shape=(2,4),executor=executor,
+                                              memory_budget=2**20)
+    for s,p in zip(serial,piped):
+        assert np.allclose(s,p,equal_nan=True)
+    with pytest.raises(IOError):
+        pipeline.clean_cube_pipelined(SlowCube(cube,fail=True),tile_shape=(2,4))
+
+def test_queue_sizes():
+    assert pipeline.queue_sizes(10,4,4,workers=2) == (1,2,1)
+    read_depth,in_flight,write_depth = pipeline.queue_sizes(1000,10,5,workers=2,work_bytes=85)
+    assert in_flight == 4
+    assert (read_depth,write_depth) == (30,60)
+
+class CrashingCube:
+    """
+    A cube that counts tile reads and can fail after a number of them
+    """
+    def __init__(self,cube,fail_after=None):
+        self.cube = cube
+        self.shape = cube.shape
+        self.dtype = cube.dtype
+        self.fail_after = fail_after
+        self.reads = 0
+
+    def __getitem__(self,key):
+        if self.fail_after is not None and self.reads >= self.fail_after:
+            raise RuntimeError("node preempted")
+        self.reads += 1
+        return(self.cube[key])
+
+def test_checkpoint_resume(tmpdir):
+    a,cube = make_cube(tmpdir)
+    serial = clean_cube.clean_cube(cube,tile_shape=(2,4))
+    for run in (clean_cube.clean_cube,pipeline.clean_cube_pipelined):
+        out = np.lib.format.open_memmap(str(tmpdir.join("out.npy")),mode='w+',
+                                        shape=serial[0].shape)
+        ck = str(tmpdir.join(run.__name__))
+        with pytest.raises(RuntimeError):
+            run(CrashingCube(cube,fail_after=2),tile_shape=(2,4),out=out,checkpoint_dir=ck)
+        with open(os.path.join(ck,"manifest.json")) as f:
+            num_done = len(json.load(f)["tiles"])
+        if run is clean_cube.clean_cube:
+            assert num_done == 2
+        resumed = CrashingCube(cube)
+        result = run(resumed,tile_shape=(2,4),out=out,checkpoint_dir=ck)
+        assert resumed.reads == 6-num_done
+        for s,r in zip(serial,result):
+            assert np.allclose(s,r,equal_nan=True)
+    #A damaged tile is cleaned again
+    out[:,5,7] = 0
+    out.flush()
+    resumed = CrashingCube(cube)
+    result = pipeline.clean_cube_pipelined(resumed,tile_shape=(2,4),out=out,checkpoint_dir=ck)
+    assert resumed.reads == 1
+    assert np.allclose(result[0],serial[0],equal_nan=True)
+    #Other parameters start from scratch
+    resumed = CrashingCube(cube)
+    pipeline.clean_cube_pipelined(resumed,tile_shape=(2,4),out=out,checkpoint_dir=ck,
+                                  basetype="poly")
+    assert resumed.reads == 6
+
+def test_cost_schedule(tmpdir):
+    a,cube = make_cube(tmpdir)
+    serial = clean_cube.clean_cube(cube,tile_shape=(2,4))
+    with clean_cube.make_executor(2,"thread") as executor:
+        scheduled = clean_cube.clean_cube(cube,tile_shape=(2,4),executor=executor,
+                                          schedule="cost")
+    for s,p in zip(serial,scheduled):
+        assert np.allclose(s,p,equal_nan=True)
+    #Blank pixels are cheap; line-rich spectra cost more with a fallback cascade
+    blank = np.full((100,2,2),np.nan)
+    quiet = np.random.randn(2000,2,2)
+    bright = quiet + 5*np.exp(-(np.arange(2000)-1000.)**2/(2*100.**2))[:,None,None]
+    cascade = ("spline","poly")
+    costs = [clean_cube.estimate_tile_cost(d,basetype=cascade) for d in (blank,quiet,bright)]
+    assert costs[0] < costs[1] < costs[2]
+    with pytest.raises(ValueError):
+        clean_cube.clean_cube(cube,schedule="random")
@@ -0,0 +1,75 @@
+import rampsclean.cli as cli
+import rampsclean.clean_cube as clean_cube
+import numpy as np
+import pytest
+
+def make_cube(filename):
+    np.random.seed(6)
+    x = np.arange(4096)
+    line = 3.0*np.exp(-(x-1000.)**2/(2*30.**2))
+    cube = (0.2*np.random.randn(4096,5,3) + (line + 1e-5*x)[:,None,None]).astype(np.float32)
+    if filename.endswith(".npy"):
+        np.save(filename,cube)
+    else:
+        from astropy.io import fits
+        header = fits.Header()
+        for key,value in (("CTYPE1","GLON-CAR"),("CRVAL1",30.),("CDELT1",-0.002),("CRPIX1",2.),
+                          ("CTYPE2","GLAT-CAR"),("CRVAL2",0.),("CDELT2",0.002),("CRPIX2",3.),
+                          ("CTYPE3","VRAD"),("CRVAL3",95.),("CDELT3",0.02),("CRPIX3",1000.),
+                          ("CUNIT3","km/s"),("BUNIT","K")):
+            header[key] = value
+        fits.PrimaryHDU(cube,header=header).writeto(filename)
+    return(cube)
+
+def test_cli(tmpdir,capsys):
+    cube = make_cube(str(tmpdir.join("a.npy")))
+    make_cube(str(tmpdir.join("b.fits")))
+    outdir = str(tmpdir.join("out"))
+    args = [str(tmpdir.join("a.npy")),str(tmpdir.join("b.fits")),"-o",outdir,
+            "--tile-shape","2","2","--ww","20"]
+    assert cli.main(args) == 0
+    status = capsys.readouterr().err.split("\r")[-1]
+    assert status.startswith("30/30 spectra") and "spectra/s" in status
+    expected = clean_cube.clean_cube(cube,tile_shape=(2,2))
+    assert np.allclose(np.load(str(tmpdir.join("out","a_clean.npy"))),expected[0],atol=1e-5)
+    assert np.allclose(np.load(str(tmpdir.join("out","a_mom0.npy"))),expected[1],rtol=1e-5)
+    from astropy.io import fits
+    assert np.allclose(fits.getdata(str(tmpdir.join("out","b_mom0.fits"))),expected[1],rtol=1e-5)
+
+    #The outputs keep the WCS and units of the input
+    from astropy.wcs import WCS
+    in_wcs = WCS(fits.getheader(str(tmpdir.join("b.fits"))))
+    clean_header = fits.getheader(str(tmpdir.join("out","b_clean.fits")))
+    assert clean_header["BUNIT"] == "K" and clean_header["NAXIS3"] == 586
+    out_wcs = WCS(clean_header)
+    for j in (0,1,585):
+        assert np.allclose(out_wcs.pixel_to_world_values(1,2,j),
+                           in_wcs.pixel_to_world_values(1,2,7*j))
+    mom0_header = fits.getheader(str(tmpdir.join("out","b_mom0.fits")))
+    assert mom0_header["BUNIT"] == "K chan" and "CTYPE3" not in mom0_header
+    assert np.allclose(WCS(mom0_header).pixel_to_world_values(1,2),
+                       in_wcs.pixel_to_world_values(1,2,0)[:2])
+
+    #Two shards of one cube cover it in strips of rows
+    for i in range(2):
+        assert cli.main(args[:1]+args[2:]+["--shard","%d/2" % i,"-q"]) == 0
+    strips = [np.load(str(tmpdir.join("out","a_shard%dof2_mom0.npy" % i))) for i in range(2)]
+    assert np.allclose(np.concatenate(strips),expected[1],rtol=1e-5)
+
+def test_unknown_vegas_config(tmpdir,capsys):
+    make_cube(str(tmpdir.join("a.npy")))
+    spur_table = tmpdir.join("spurs.txt")
+    spur_table.write("config1 100 200\n")
+    with pytest.raises(SystemExit):
+        cli.main([str(tmpdir.join("a.npy")),"-o",str(tmpdir),"--spur-table",str(spur_table),
+                  "--vegas-config","config2"])
+    assert "config2 is not in" in capsys.readouterr().err
+
+def test_shard_units():
+    files = ["a.npy","b.npy","c.npy"]
+    assert cli.shard_units(files,(1,2),None) == [("b.npy",None)]
+    assert cli.shard_units(files,(0,1),None) == [(f,None) for f in files]
+    units = cli.shard_units(files,(3,4),lambda f: 10)
+    assert units == [(f,slice(7,10)) for f in files]
+    with pytest.raises(Exception):
+        cli.parse_shard("2/2")
@@ -0,0 +1,55 @@
+import rampsclean.synthetic_spectrum as snythetic_spectrum
+import rampsclean.moments as moments
+import rampsclean.combine as combine
+import numpy as np
+import pytest
+
+def test_combine_polarizations():
+    parameters = {
+        "spec_length" : 16384, #Spectrum properties
+        "noise_level" : 0.30, #Noise properties
+        "baseline_poly_order" : 2,  #Baseline properties
+        "baseline_poly_params" : np.array([-0.1,+1e-6,-5e-10,+1e-13]),
+        "do_random_baseline" : False,
+        "nh3_amplitude" : 3.0, #NH3 spectrum properties
+        "nh3_width" : 50.,
+        "nh3_position" : 4000.,
+        "nh3_offset" : 300.,
+        "num_spikes" : 10,
+        "spikes_amp"  : 4.,
+    }
+    pol_a = snythetic_spectrum.SyntheticSpectrum(parameters=parameters)
+    parameters["noise_level"] = 0.60
+    pol_b = snythetic_spectrum.SyntheticSpectrum(parameters=parameters)
+    noise_free_mom0,noise_free_mom0_err = pol_a.calculate_integrated_intensity()
+    spectra = [pol_a.generate_spectrum(),pol_b.generate_spectrum()]
+    noise = combine.estimate_noise(spectra)
+    assert abs(noise[0]-0.3) < 0.03 and abs(noise[1]-0.6) < 0.06
+    combined,combined_noise = combine.combine_spectra(spectra)
+    assert combined_noise < noise[0]
+    for deglitch_first in (False,True):
+        cleaned_spectrum = combine.clean_combined(spectra,deglitch_first=deglitch_first)
+        signal_spectrum,noise_estimate = moments.identify_signal_estimate_noise(cleaned_spectrum)
+        cleaned_mom0,cleaned_mom0_err = moments.get_integrated_intensity(
+                                    signal_spectrum,noise_estimate,downsample_fact=7)
+        assert abs(cleaned_mom0-noise_free_mom0) < 5*cleaned_mom0_err
+
+def test_combine_dead_polarization():
+    np.random.seed(1)
+    good = 0.3*np.random.randn(4096)
+    combined,noise = combine.combine_spectra([good,np.zeros(4096)])
+    assert np.allclose(combined,good)
+    assert abs(noise-0.3) < 0.03
+    combined,noise = combine.combine_spectra([good,np.full(4096,np.nan)])
+    assert np.allclose(combined,good)
+    with pytest.raises(ValueError):
+        combine.combine_spectra([np.zeros(4096),np.full(4096,np.nan)])
+
+def test_deglitch_first_with_nans():
+    np.random.seed(2)
+    spectra = 0.3*np.random.randn(2,4096)
+    spectra[0,:50] = np.nan
+    spectra[0,2000] += 50.
+    combined,noise = combine.combine_spectra(spectra,deglitch_first=True)
+    assert abs(combined[2000]) < 2.
+    assert np.all(np.isfinite(combined))
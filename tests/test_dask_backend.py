@@ -0,0 +1,42 @@
+import rampsclean.clean_cube as clean_cube
+import rampsclean.clean_spectrum as clean_spectrum
+import numpy as np
+import pytest
+da = pytest.importorskip("dask.array")
+import dask
+import rampsclean.dask_backend as dask_backend
+
+def make_cube():
+    np.random.seed(8)
+    x = np.arange(4096)
+    line = 3.0*np.exp(-(x-1000.)**2/(2*30.**2))
+    cube = 0.2*np.random.randn(4096,5,6) + (line + 1e-5*x)[:,None,None]
+    cube[:,0,0] = np.nan
+    return(cube)
+
+def test_clean_dask():
+    cube = make_cube()
+    expected = clean_cube.clean_cube(cube,tile_shape=(2,4))
+    for scheduler in ("threads","processes"):
+        results = dask.compute(*dask_backend.clean_dask(cube,chunks=(2,4)),scheduler=scheduler)
+        for e,r in zip(expected,results):
+            assert np.allclose(e,r,equal_nan=True)
+    #Chunked along the spectral axis too: rechunked to whole spectra
+    lazy = dask_backend.clean_dask(da.from_array(cube,chunks=(1000,3,3)))
+    assert lazy[0].chunks[0] == (len(range(0,4096,7)),)
+    #Composes lazily with further analysis
+    total = da.nansum(lazy[1])
+    assert np.isclose(total.compute(),np.nansum(expected[1]))
+
+def test_clean_dask_line_mask():
+    cube = make_cube()
+    line_mask = np.zeros(cube.shape,dtype=bool)
+    line_mask[900:1100] = True
+    expected = clean_cube.clean_cube(cube,tile_shape=(2,4),line_mask=line_mask)
+    results = dask.compute(*dask_backend.clean_dask(cube,chunks=(2,4),line_mask=line_mask))
+    for e,r in zip(expected,results):
+        assert np.allclose(e,r,equal_nan=True)
+    mask_1d = clean_spectrum.make_line_mask(4096,[(900,1100)])
+    results = dask.compute(*dask_backend.clean_dask(cube,chunks=(2,4),line_mask=mask_1d))
+    for e,r in zip(expected,results):
+        assert np.allclose(e,r,equal_nan=True)
@@ -0,0 +1,39 @@
+import rampsclean.memory as memory
+import rampsclean.clean_spectrum as clean_spectrum
+import numpy as np
+import pytest
+import tracemalloc
+
+def make_spectra(n):
+    np.random.seed(5)
+    x = np.arange(16384)
+    line = 3.0*np.exp(-(x-4000.)**2/(2*50.**2))
+    return(np.array([0.2*np.random.randn(16384)+line+1e-5*x for i in range(n)]))
+
+def test_plan_batches():
+    small = memory.spectrum_peak_bytes(16384,ww=20)
+    #The moment y-array of a full-resolution spectrum dominates
+    assert memory.spectrum_peak_bytes(16384,ww=20,full_resolution=True) > 10*small
+    for cap in (8e6,20e6,1e9):
+        plan = memory.plan_batches(cap,16384,nspec=100,max_workers=4)
+        assert plan["predicted_peak"] <= cap
+        assert 1 <= plan["workers"] <= 4
+    assert memory.plan_batches(1e9,16384,nspec=100,max_workers=4)["workers"] == 4
+    with pytest.raises(ValueError):
+        memory.plan_batches(1e5,16384)
+
+def test_iter_clean_capped():
+    spectra = make_spectra(6)
+    expected = list(clean_spectrum.iter_clean(spectra))
+    for kind in ("thread","process"):
+        report = {}
+        results = list(memory.iter_clean_capped(spectra,12e6,kind=kind,max_workers=2,
+                                                report=report))
+        assert report["workers"] == 2
+        assert report["actual_peak"] <= report["predicted_peak"] <= 12e6
+        for result,exp in zip(results,expected):
+            assert np.allclose(result[0],exp[0],equal_nan=True)
+            assert np.all(result[1] == exp[1])
+        #Memory is only traced when a report is asked for
+        for result in memory.iter_clean_capped(spectra,12e6,kind=kind,max_workers=2):
+            assert not tracemalloc.is_tracing()
@@ -1,6 +1,7 @@
 import rampsclean.synthetic_spectrum as snythetic_spectrum
 import rampsclean.moments as moments
 import rampsclean.clean_spectrum as clean_spectrum
+import rampsclean.clean_cube as clean_cube
 import numpy.ma as ma
 import numpy as np
 
@@ -107,3 +108,217 @@ def test_mom0_broadlines():
     }
     a = snythetic_spectrum.SyntheticSpectrum(parameters=parameters,outdir="broad_line")
     check_mom0(a,outdir="broad_line")
+    
+    
+def test_mom0_multiscale():
+    parameters = {
+        "spec_length" : 16384, #Spectrum properties
+        "noise_level" : 0.5, #Noise properties
+        "baseline_poly_order" : 2,  #Baseline properties
+        "baseline_poly_params" : np.array([-0.1,+1e-6,-5e-10,+1e-13]),
+        "do_random_baseline" : False,
+        "nh3_amplitude" : 2.0, #NH3 spectrum properties
+        "nh3_width" : 50.,
+        "nh3_position" : 4000.,
+        "nh3_offset" : 300.,
+        "num_spikes" : 10,
+        "spikes_amp"  : 4.,
+    }
+    a = snythetic_spectrum.SyntheticSpectrum(parameters=parameters,outdir="multiscale")
+    check_mom0(a,ww=(10,40,160),outdir="multiscale")
+    
+    
+def test_baseline_fallback_cascade():
+    parameters = {
+        "spec_length" : 16384, #Spectrum properties
+        "noise_level" : 0.20, #Noise properties
+        "baseline_poly_order" : 2,  #Baseline properties
+        "baseline_poly_params" : np.array([-0.1,+1e-6,-5e-10,+1e-13]),
+        "do_random_baseline" : False,
+        "nh3_amplitude" : 3.0, #NH3 spectrum properties
+        "nh3_width" : 50.,
+        "nh3_position" : 4000.,
+        "nh3_offset" : 300.,
+        "num_spikes" : 10,
+        "spikes_amp"  : 4.,
+    }
+    a = snythetic_spectrum.SyntheticSpectrum(parameters=parameters)
+    test_spectrum = a.generate_spectrum()
+    cascade = ("spline","poly","smoothed_data")
+    spline_spectrum = clean_spectrum.baseline_and_deglitch(test_spectrum,basetype="spline")
+    diagnostics = {}
+    cascade_spectrum = clean_spectrum.baseline_and_deglitch(test_spectrum,basetype=cascade,
+                                diagnostics=diagnostics)
+    assert diagnostics["basetype"] == "spline"
+    assert np.allclose(spline_spectrum,cascade_spectrum)
+    #With no time left we go straight to the last (cheapest) basetype
+    diagnostics = {}
+    clean_spectrum.baseline_and_deglitch(test_spectrum,basetype=cascade,
+                                time_budget=0,diagnostics=diagnostics)
+    assert diagnostics["basetype"] == "smoothed_data"
+    assert len(diagnostics["attempts"]) == 1
+
+def test_spline_knot_cap():
+    np.random.seed(4)
+    x = np.arange(2340)
+    mspec = np.ma.masked_where((x > 500) & (x < 700),np.random.randn(2340)+20*np.sin(x/30.))
+    baseline = clean_spectrum.fit_baseline(mspec,1.)
+    diagnostics = {}
+    uncapped = clean_spectrum.fit_baseline(mspec,1.,max_knots=1000,diagnostics=diagnostics)
+    assert not diagnostics["knot_cap_hit"]
+    assert np.allclose(baseline,uncapped)
+    diagnostics = {}
+    clean_spectrum.fit_baseline(mspec,1.,basetype=("spline","smoothed_data"),max_knots=20,
+                                diagnostics=diagnostics)
+    assert diagnostics["knot_cap_hit"]
+    assert diagnostics["basetype"] == "smoothed_data"
+    
+    
+def test_prescreen_batch():
+    parameters = {
+        "spec_length" : 16384, #Spectrum properties
+        "noise_level" : 0.20, #Noise properties
+        "baseline_poly_order" : 2,  #Baseline properties
+        "baseline_poly_params" : np.array([-0.1,+1e-6,-5e-10,+1e-13]),
+        "do_random_baseline" : False,
+        "nh3_amplitude" : 3.0, #NH3 spectrum properties
+        "nh3_width" : 50.,
+        "nh3_position" : 4000.,
+        "nh3_offset" : 300.,
+        "num_spikes" : 10,
+        "spikes_amp"  : 4.,
+    }
+    a = snythetic_spectrum.SyntheticSpectrum(parameters=parameters)
+    test_spectrum = a.generate_spectrum()
+    noise_free_mom0,noise_free_mom0_err = a.calculate_integrated_intensity()
+    edge_spectrum = test_spectrum.copy()
+    edge_spectrum[:1000] = np.nan
+    batch = np.array([test_spectrum,edge_spectrum,np.nan*test_spectrum,0*test_spectrum])
+    cleaned,status = clean_spectrum.baseline_and_deglitch_batch(batch,filter_width=7)
+    assert list(status) == [clean_spectrum.VALID,clean_spectrum.PARTIAL_NAN,
+                            clean_spectrum.ALL_NAN,clean_spectrum.BLANK]
+    assert np.all(np.isnan(cleaned[2:]))
+    assert np.all(np.isfinite(cleaned[0]))
+    signal_spectrum,noise_estimate = moments.identify_signal_estimate_noise(cleaned[1])
+    cleaned_mom0,cleaned_mom0_err = moments.get_integrated_intensity(
+                                    signal_spectrum,noise_estimate,downsample_fact=7)
+    assert abs(cleaned_mom0-noise_free_mom0) < 5*cleaned_mom0_err
+    
+    
+def test_mom0_spur_table(tmpdir):
+    parameters = {
+        "spec_length" : 16384, #Spectrum properties
+        "noise_level" : 0.20, #Noise properties
+        "baseline_poly_order" : 2,  #Baseline properties
+        "baseline_poly_params" : np.array([-0.1,+1e-6,-5e-10,+1e-13]),
+        "do_random_baseline" : False,
+        "nh3_amplitude" : 3.0, #NH3 spectrum properties
+        "nh3_width" : 50.,
+        "nh3_position" : 4000.,
+        "nh3_offset" : 300.,
+        "num_spikes" : 10,
+        "spikes_amp"  : 4.,
+    }
+    a = snythetic_spectrum.SyntheticSpectrum(parameters=parameters)
+    table_file = tmpdir.join("spurs.txt")
+    table_file.write("#config channels\nsynthetic "+" ".join(str(c) for c in a.spike_channels)+"\n")
+    table = clean_spectrum.read_spur_table(str(table_file))
+    assert list(table["synthetic"]) == list(a.spike_channels)
+    check_mom0(a,spur_channels=table["synthetic"])
+    check_mom0(a,spike_threshold=6)
+    
+    
+def test_mom0_full_resolution():
+    parameters = {
+        "spec_length" : 16384, #Spectrum properties
+        "noise_level" : 0.20, #Noise properties
+        "baseline_poly_order" : 2,  #Baseline properties
+        "baseline_poly_params" : np.array([-0.1,+1e-6,-5e-10,+1e-13]),
+        "do_random_baseline" : False,
+        "nh3_amplitude" : 3.0, #NH3 spectrum properties
+        "nh3_width" : 50.,
+        "nh3_position" : 4000.,
+        "nh3_offset" : 300.,
+        "num_spikes" : 10,
+        "spikes_amp"  : 4.,
+    }
+    a = snythetic_spectrum.SyntheticSpectrum(parameters=parameters)
+    test_spectrum = a.generate_spectrum()
+    noise_free_mom0,noise_free_mom0_err = a.calculate_integrated_intensity()
+    cleaned_spectrum = clean_spectrum.baseline_and_deglitch(test_spectrum,filter_width=7,
+                                    full_resolution=True)
+    assert cleaned_spectrum.size == test_spectrum.size
+    signal_spectrum,noise_estimate = moments.identify_signal_estimate_noise(cleaned_spectrum,ww=140)
+    cleaned_mom0,cleaned_mom0_err = moments.get_integrated_intensity(signal_spectrum,noise_estimate)
+    assert abs(cleaned_mom0-noise_free_mom0) < 5*cleaned_mom0_err
+    #Multi-scale widths are each scaled to full resolution
+    assert clean_spectrum.moment_settings((20,80),7,True) == ((140,560),1)
+    cleaned_spectrum,cleaned_mom0,cleaned_mom0_err,noise_estimate = clean_cube.clean_pixel(
+                                    test_spectrum,ww=(20,80),full_resolution=True)
+    assert cleaned_spectrum.size == test_spectrum.size
+    assert abs(cleaned_mom0-noise_free_mom0) < 5*cleaned_mom0_err
+    
+    
+def test_mom0_line_windows():
+    parameters = {
+        "spec_length" : 16384, #Spectrum properties
+        "noise_level" : 0.20, #Noise properties
+        "baseline_poly_order" : 2,  #Baseline properties
+        "baseline_poly_params" : np.array([-0.1,+1e-6,-5e-10,+1e-13]),
+        "do_random_baseline" : False,
+        "nh3_amplitude" : 3.0, #NH3 spectrum properties
+        "nh3_width" : 50.,
+        "nh3_position" : 4000.,
+        "nh3_offset" : 300.,
+        "num_spikes" : 10,
+        "spikes_amp"  : 4.,
+    }
+    a = snythetic_spectrum.SyntheticSpectrum(parameters=parameters)
+    test_spectrum = a.generate_spectrum()
+    noise_free_mom0,noise_free_mom0_err = a.calculate_integrated_intensity()
+    line_mask = clean_spectrum.make_line_mask(test_spectrum.size,
+                                    line_free_windows=[(0,3200),(4800,16384)])
+    cleaned_spectrum = clean_spectrum.baseline_and_deglitch(test_spectrum,filter_width=7,
+                                    line_mask=line_mask)
+    signal_spectrum,noise_estimate = moments.identify_signal_estimate_noise(cleaned_spectrum,
+                                    line_mask=clean_spectrum.downsample_mask(line_mask,7))
+    cleaned_mom0,cleaned_mom0_err = moments.get_integrated_intensity(
+                                    signal_spectrum,noise_estimate,downsample_fact=7)
+    assert abs(cleaned_mom0-noise_free_mom0) < 5*cleaned_mom0_err
+    
+    
+def test_iter_clean():
+    parameters = {
+        "spec_length" : 16384, #Spectrum properties
+        "noise_level" : 0.20, #Noise properties
+        "baseline_poly_order" : 2,  #Baseline properties
+        "baseline_poly_params" : np.array([-0.1,+1e-6,-5e-10,+1e-13]),
+        "do_random_baseline" : False,
+        "nh3_amplitude" : 3.0, #NH3 spectrum properties
+        "nh3_width" : 50.,
+        "nh3_position" : 4000.,
+        "nh3_offset" : 300.,
+        "num_spikes" : 10,
+        "spikes_amp"  : 4.,
+    }
+    a = snythetic_spectrum.SyntheticSpectrum(parameters=parameters)
+    test_spectrum = a.generate_spectrum()
+    cleaned_spectrum = clean_spectrum.baseline_and_deglitch(test_spectrum)
+    signal_spectrum,noise_estimate = moments.identify_signal_estimate_noise(cleaned_spectrum)
+    def spectra():
+        yield test_spectrum
+        yield np.nan*test_spectrum
+        yield np.array([test_spectrum,test_spectrum])
+    results = list(clean_spectrum.iter_clean(spectra(),batch_size=2))
+    assert len(results) == 4
+    for i in (0,2,3):
+        assert np.allclose(results[i][0],cleaned_spectrum)
+        assert np.all(results[i][1] == ~signal_spectrum.mask)
+        assert results[i][2] == noise_estimate
+    assert np.isnan(results[1][2])
+    #A prior line mask is used for the moments too, as in clean_cube
+    line_mask = clean_spectrum.make_line_mask(16384,line_windows=[(3500,4500)])
+    spec,signal_mask,noise = next(clean_spectrum.iter_clean([test_spectrum],line_mask=line_mask))
+    expected = clean_cube.clean_pixel(test_spectrum,line_mask=line_mask)
+    assert noise == expected[3]
+    assert np.all(signal_mask == clean_spectrum.downsample_mask(line_mask))
@@ -0,0 +1,94 @@
+import rampsclean.server as server
+import rampsclean.clean_cube as clean_cube
+import numpy as np
+import json
+import pytest
+import socket
+import time
+
+def make_cube():
+    np.random.seed(9)
+    x = np.arange(4096)
+    line = 3.0*np.exp(-(x-1000.)**2/(2*30.**2))
+    return(0.2*np.random.randn(4096,3,2) + (line + 1e-5*x)[:,None,None])
+
+def check_requests(address):
+    cube = make_cube()
+    expected = clean_cube.clean_cube(cube)
+    with server.Client(address) as client:
+        assert client.ping()
+        results = client.clean(cube,tile_shape=(2,2))
+        for e,r in zip(expected,results):
+            assert np.allclose(e,r,equal_nan=True)
+        batch = cube.reshape(4096,6).T
+        results = client.clean(batch)
+        assert np.allclose(results[0],expected[0].reshape(-1,6).T,equal_nan=True)
+        assert np.allclose(results[1],expected[1].ravel())
+        start = time.time()
+        results = client.clean(cube[:,1,1],ww=20)
+        assert time.time()-start < 0.5 #Warm: no imports or worker start-up
+        assert np.allclose(results[0],expected[0][:,1,1])
+        assert np.isclose(results[1],expected[1][1,1])
+        with pytest.raises(RuntimeError):
+            client.clean(cube[:,1,1],basetype="nonsense")
+        assert client.ping() #The connection survives errors
+
+def test_unix_server(tmpdir):
+    address = str(tmpdir.join("clean.sock"))
+    s = server.start_server(address,workers=2,kind="thread")
+    try:
+        check_requests(address)
+    finally:
+        s.shutdown()
+        s.server_close()
+
+def test_tcp_server():
+    s = server.start_server(("localhost",0),workers=2,kind="process")
+    try:
+        check_requests(s.server_address)
+    finally:
+        s.shutdown()
+        s.server_close()
+
+def raw_message(header,payload_len):
+    header = json.dumps(header).encode()
+    return(server.PREFIX.pack(len(header),payload_len)+header)
+
+def test_malformed_messages(monkeypatch):
+    a,b = socket.socketpair()
+    a.sendall(server.PREFIX.pack(10,100)+b'{"ar')
+    a.close()
+    with pytest.raises(ConnectionError):
+        server.recv_message(b)
+    b.close()
+    errors = []
+    monkeypatch.setattr(server.TCPServer,"handle_error",lambda self,*args: errors.append(args))
+    s = server.start_server(("localhost",0),workers=1,kind="thread")
+    try:
+        #Truncated: the server just hangs up
+        sock = socket.create_connection(s.server_address)
+        sock.sendall(server.PREFIX.pack(10,0)+b"{")
+        sock.shutdown(socket.SHUT_WR)
+        assert sock.recv(1) == b""
+        sock.close()
+        #Malformed: an error reply, then the server hangs up. Nothing is sent
+        #after the header, so the server leaves no unread data behind (which
+        #would reset the connection and could drop the reply)
+        for data in (server.PREFIX.pack(2,100)+b"{}",server.PREFIX.pack(2,0)+b"[]",
+                     raw_message({"arrays":[]},2**60),
+                     raw_message({"arrays":[["zz",[1]]]},8),
+                     raw_message({"arrays":[1]},8),
+                     raw_message({"arrays":[["<f8",[-1]]]},8),
+                     raw_message({"arrays":[["<f8",[2]]]},8)):
+            sock = socket.create_connection(s.server_address)
+            sock.sendall(data)
+            reply,arrays = server.recv_message(sock)
+            assert not reply["ok"] and reply["error"].startswith("ValueError")
+            assert sock.recv(1) == b""
+            sock.close()
+        with server.Client(s.server_address) as client:
+            assert client.ping()
+    finally:
+        s.shutdown()
+        s.server_close()
+    assert errors == []
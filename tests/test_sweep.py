@@ -0,0 +1,34 @@
+import rampsclean.synthetic_spectrum as snythetic_spectrum
+import rampsclean.moments as moments
+import rampsclean.clean_spectrum as clean_spectrum
+import rampsclean.sweep as sweep
+import numpy as np
+
+def test_sweep_matches_single_runs():
+    parameters = {
+        "spec_length" : 16384, #Spectrum properties
+        "noise_level" : 0.20, #Noise properties
+        "baseline_poly_order" : 2,  #Baseline properties
+        "baseline_poly_params" : np.array([-0.1,+1e-6,-5e-10,+1e-13]),
+        "do_random_baseline" : False,
+        "nh3_amplitude" : 3.0, #NH3 spectrum properties
+        "nh3_width" : 50.,
+        "nh3_position" : 4000.,
+        "nh3_offset" : 300.,
+        "num_spikes" : 10,
+        "spikes_amp"  : 4.,
+    }
+    a = snythetic_spectrum.SyntheticSpectrum(parameters=parameters)
+    test_spectrum = a.generate_spectrum()
+    table = sweep.sweep(test_spectrum,wws=(20,40),stddevlevs=(3,4),
+                        basetypes=("spline","smoothed_data"))
+    assert len(table) == 8
+    for row in table:
+        ww = int(row['ww'])
+        cleaned_spectrum = clean_spectrum.baseline_and_deglitch(test_spectrum,ww=ww,
+                                stddevlev=row['stddevlev'],basetype=row['basetype'])
+        signal_spectrum,noise_estimate = moments.identify_signal_estimate_noise(
+                                cleaned_spectrum,ww=ww)
+        cleaned_mom0,cleaned_mom0_err = moments.get_integrated_intensity(
+                                signal_spectrum,noise_estimate,downsample_fact=7)
+        assert np.isclose(row['mom0'],cleaned_mom0)
@@ -0,0 +1,43 @@
+import rampsclean.synthetic_cube as synthetic_cube
+import numpy as np
+
+def small_cube():
+    parameters = {
+        "nx" : 8, #Map properties
+        "ny" : 6,
+        "nan_border" : 1,
+        "nan_jitter" : 1,
+        "spec_length" : 2048, #Spectrum properties
+        "noise_level" : 0.2, #Noise properties
+        "baseline_poly_order" : 2,  #Baseline properties
+        "baseline_poly_params" : np.array([-0.1,+1e-6,-5e-10,+1e-13]),
+        "baseline_scatter" : 0.2,
+        "do_random_baseline" : False,
+        "nh3_amplitude" : 3.0, #NH3 spectrum properties
+        "nh3_width" : 20.,
+        "nh3_position" : 1000.,
+        "nh3_offset" : 150.,
+        "clump_size" : 0.25,
+        "position_gradient" : 10.,
+        "width_gradient" : 1.,
+        "num_spikes" : 5,
+        "spikes_amp"  : 4.,
+    }
+    return(synthetic_cube.SyntheticCube(parameters=parameters,seed=1))
+
+def check_cube(data,a):
+    assert data.shape == (2048,6,8)
+    nan_pixels = np.all(np.isnan(data),axis=0)
+    assert np.all(nan_pixels == a.blank)
+    assert np.all(np.isfinite(data[:,~a.blank]))
+    assert np.all(a.mom0[~a.blank] > 0)
+
+def test_cube_npy(tmpdir):
+    a = small_cube()
+    a.write(str(tmpdir.join("cube.npy")))
+    check_cube(synthetic_cube.open_cube(str(tmpdir.join("cube.npy"))),a)
+
+def test_cube_fits(tmpdir):
+    a = small_cube()
+    data = a.write(str(tmpdir.join("cube.fits")))
+    check_cube(data,a)
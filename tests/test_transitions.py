@@ -0,0 +1,64 @@
+import rampsclean.synthetic_spectrum as snythetic_spectrum
+import rampsclean.transitions as transitions
+import rampsclean.cache as cache
+import rampsclean.clean_spectrum as clean_spectrum
+import numpy as np
+
+def make_window(position,amplitude):
+    parameters = {
+        "spec_length" : 16384, #Spectrum properties
+        "noise_level" : 0.20, #Noise properties
+        "baseline_poly_order" : 2,  #Baseline properties
+        "baseline_poly_params" : np.array([-0.1,+1e-6,-5e-10,+1e-13]),
+        "do_random_baseline" : False,
+        "nh3_amplitude" : amplitude, #NH3 spectrum properties
+        "nh3_width" : 50.,
+        "nh3_position" : position,
+        "nh3_offset" : 300.,
+        "num_spikes" : 10,
+        "spikes_amp"  : 4.,
+    }
+    a = snythetic_spectrum.SyntheticSpectrum(parameters=parameters)
+    test_spectrum = a.generate_spectrum()
+    noise_free_mom0,noise_free_mom0_err = a.calculate_integrated_intensity()
+    velocity = (np.arange(16384)-position)*0.02 #Line at v=0 in both windows
+    return(test_spectrum,velocity,noise_free_mom0)
+
+def test_weak_transition_uses_reference_mask():
+    strong,strong_velocity,strong_mom0 = make_window(4000.,3.0)
+    weak,weak_velocity,weak_mom0 = make_window(6000.,0.5)
+    cleaned,mom0,mom0_err,noise = transitions.clean_transitions([strong,weak],
+                                        [strong_velocity,weak_velocity])
+    assert len(cleaned) == 2
+    assert abs(mom0[0]-strong_mom0) < 5*mom0_err[0]
+    assert abs(mom0[1]-weak_mom0) < 5*mom0_err[1]
+
+def test_nan_edges_and_reference_choice():
+    weak,weak_velocity,weak_mom0 = make_window(6000.,0.5)
+    strong,strong_velocity,strong_mom0 = make_window(4000.,3.0)
+    strong[:100] = np.nan
+    weak[-100:] = np.nan
+    contrast = [transitions.line_contrast(clean_spectrum.make_local_stddev(ds[20:-20]))
+                for ds in transitions.downsample_windows([weak[200:-200],strong[200:-200]])]
+    assert contrast[1] > contrast[0]
+    cleaned,mom0,mom0_err,noise = transitions.clean_transitions([weak,strong],
+                                        [weak_velocity,strong_velocity],spike_threshold=5)
+    assert np.isnan(cleaned[1][0]) and np.isnan(cleaned[0][-1])
+    assert abs(mom0[1]-strong_mom0) < 5*mom0_err[1]
+    assert abs(mom0[0]-weak_mom0) < 5*mom0_err[0]
+
+def test_shared_downsample_pass():
+    strong,strong_velocity,strong_mom0 = make_window(4000.,3.0)
+    weak,weak_velocity,weak_mom0 = make_window(6000.,0.5)
+    store = cache.MemoryCache()
+    downsampled = transitions.downsample_windows([strong,weak],store=store)
+    for spec,ds in zip([strong,weak],downsampled):
+        assert np.array_equal(ds,clean_spectrum.downsample_spectrum(spec))
+    #baseline_and_deglitch picks the stacked result up from the cache
+    assert len(store.arrays) == 2
+    direct = clean_spectrum.baseline_and_deglitch(weak)
+    assert np.allclose(clean_spectrum.baseline_and_deglitch(weak,cache=store),direct)
+    assert len(store.arrays) == 3
+    cleaned,mom0,mom0_err,noise = transitions.clean_transitions([strong,weak],
+                                        [strong_velocity,weak_velocity],cache=store)
+    assert len(store.arrays) == 4 #Only the y-array of the strong window is new
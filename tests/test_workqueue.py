@@ -0,0 +1,86 @@
+import rampsclean.workqueue as workqueue
+import rampsclean.clean_cube as clean_cube
+import numpy as np
+import multiprocessing
+import os
+import time
+
+def make_cube(filename,ny=8,nx=8,offset=0.):
+    np.random.seed(7)
+    x = np.arange(2048)
+    line = 3.0*np.exp(-(x-500.)**2/(2*20.**2))
+    cube = 0.2*np.random.randn(2048,ny,nx) + (line + 1e-5*x)[:,None,None]
+    cube[:,:ny//2] += offset #Marks the expensive tiles in test_load_balance
+    np.save(filename,cube)
+    return(cube)
+
+def run_nodes(directory,num_nodes):
+    context = multiprocessing.get_context("fork")
+    nodes = [context.Process(target=workqueue.run_worker,args=(directory,))
+             for i in range(num_nodes)]
+    for node in nodes:
+        node.start()
+    for node in nodes:
+        node.join()
+        assert node.exitcode == 0
+
+def test_workqueue(tmpdir):
+    cube = make_cube(str(tmpdir.join("cube.npy")))
+    directory = str(tmpdir.join("queue"))
+    workqueue.create_queue(directory,str(tmpdir.join("cube.npy")),tile_shape=(2,3),ww=20)
+    run_nodes(directory,3)
+    results = workqueue.assemble(directory,timeout=10,work=False)
+    expected = clean_cube.clean_cube(cube,tile_shape=(2,3),ww=20)
+    for e,r in zip(expected,results):
+        assert np.allclose(e,r,equal_nan=True)
+
+def test_stale_lock(tmpdir):
+    make_cube(str(tmpdir.join("cube.npy")),ny=2,nx=2)
+    directory = str(tmpdir.join("queue"))
+    workqueue.create_queue(directory,str(tmpdir.join("cube.npy")),tile_shape=(1,2))
+    #A fresh lock is respected, a stale one (dead worker) is broken
+    assert workqueue.claim(directory,0)
+    assert not workqueue.claim(directory,0)
+    old = time.time()-100
+    os.utime(workqueue.lock_path(directory,0),(old,old))
+    assert not workqueue.claim(directory,0,lease=200)
+    assert workqueue.claim(directory,0,lease=50)
+    os.utime(workqueue.lock_path(directory,0),(old,old))
+    results = workqueue.assemble(directory,timeout=10,lease=50)
+    assert np.all(np.isfinite(results[1]))
+
+def test_lock_race(tmpdir):
+    make_cube(str(tmpdir.join("cube.npy")),ny=2,nx=2)
+    directory = str(tmpdir.join("queue"))
+    workqueue.create_queue(directory,str(tmpdir.join("cube.npy")),tile_shape=(1,2))
+    lock = workqueue.lock_path(directory,0)
+    dead = workqueue.claim(directory,0)
+    old = time.time()-100
+    os.utime(lock,(old,old))
+    #Worker B reads the stale lock, then worker A breaks it and claims the tile
+    seen_by_b = workqueue.read_token(lock)
+    token_a = workqueue.claim(directory,0,lease=50)
+    assert token_a and token_a != dead
+    #B must not take A's fresh lock, and the dead worker's release must not remove it
+    assert workqueue.take_lock(lock,seen_by_b) is None
+    workqueue.release(directory,0,dead)
+    assert workqueue.read_token(lock) == token_a
+    workqueue.release(directory,0,token_a)
+    assert os.listdir(os.path.join(directory,"claims")) == []
+
+def test_load_balance(tmpdir,monkeypatch):
+    make_cube(str(tmpdir.join("cube.npy")),offset=100.)
+    directory = str(tmpdir.join("queue"))
+    workqueue.create_queue(directory,str(tmpdir.join("cube.npy")),tile_shape=(2,2))
+    clean_tile = workqueue.clean_cube.clean_tile
+    def uneven_clean_tile(data,**kwargs):
+        if data[0].mean() > 50:
+            time.sleep(0.25)
+        return(clean_tile(data,**kwargs))
+    monkeypatch.setattr(workqueue.clean_cube,"clean_tile",uneven_clean_tile) #Inherited by the forks
+    start = time.time()
+    run_nodes(directory,2)
+    wall = time.time()-start
+    #Static sharding by rows gives all 8 expensive tiles to one node
+    assert wall < 0.75*8*0.25
+    assert len(os.listdir(os.path.join(directory,"results"))) == 16